@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_compute_P
+    ~~~~~~~~~~~~~~~
+
+    Compare time and peak allocations of the allocating and the buffered
+    `CorrelatedModel.compute_P` on a simulated Zero-Inflated Poisson problem.
+
+    Run with `python benchmarks/bench_compute_P.py`.
+"""
+import time
+import tracemalloc
+import numpy as np
+
+from ccount.models import ZeroInflatedPoisson
+
+
+def make_model(m, n, num_groups, num_covs):
+    np.random.seed(0)
+    d = np.array([[num_covs] * n] * 2)
+    Y = np.random.poisson(lam=2., size=(m, n))
+    X = [[np.random.randn(m, num_covs) for j in range(n)] for k in range(2)]
+    group_id = np.random.randint(0, num_groups, size=m)
+    return ZeroInflatedPoisson(m=m, n=n, d=d, Y=Y, X=X, group_id=group_id)
+
+
+def bench(cm, buffered, repeats=20):
+    kwargs = dict(X=cm.X, m=cm.m, group_sizes=cm.group_sizes, offset=cm.offset,
+                  buffered=buffered)
+    # warm up, so that the work buffers exist before measuring
+    cm.compute_P(**kwargs)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(repeats):
+        cm.compute_P(**kwargs)
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    print(f"{'m':>8} {'n':>3} {'mode':>10} {'time (ms)':>10} {'peak alloc (MB)':>16}")
+    for m in [10000, 100000, 1000000]:
+        for n in [1, 2]:
+            cm = make_model(m=m, n=n, num_groups=m // 10, num_covs=5)
+            for buffered in [False, True]:
+                elapsed, peak = bench(cm, buffered)
+                mode = 'buffered' if buffered else 'allocating'
+                print(f"{m:>8} {n:>3} {mode:>10} {1e3 * elapsed:>10.2f} {peak / 2 ** 20:>16.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_dtype
+    ~~~~~~~~~~~
+
+    Compare the throughput and accuracy of the objective and its gradient with
+    the data stored in float64 and in float32 (`CorrelatedModel(dtype=...)`)
+    for every built-in model on simulated data.
+
+    Run with `python benchmarks/bench_dtype.py`.
+"""
+import time
+import numpy as np
+
+from ccount.models import MODEL_DICT
+
+# number of parameters of the models that do not have 2
+NUM_PARAMETERS = {'logistic': 1, 'binomial': 1, 'zero_inflated_negative_binomial': 3}
+
+
+def make_model(model_type, m, n, num_groups, num_covs, dtype):
+    np.random.seed(0)
+    l = NUM_PARAMETERS.get(model_type, 2)
+    d = np.array([[num_covs] * n] * l)
+    kwargs = dict()
+    if model_type == 'logistic':
+        Y = np.random.binomial(n=1, p=0.5, size=(m, n))
+    elif model_type == 'binomial':
+        kwargs['trials'] = np.random.randint(1, 10, size=(m, n))
+        Y = np.random.binomial(n=kwargs['trials'], p=0.4)
+    else:
+        Y = np.random.poisson(lam=2., size=(m, n)) * np.random.binomial(n=1, p=0.7, size=(m, n))
+    X = [[np.random.randn(m, num_covs) for j in range(n)] for k in range(l)]
+    group_id = np.random.randint(0, num_groups, size=m)
+    return MODEL_DICT[model_type](m=m, n=n, d=d, Y=Y, X=X, group_id=group_id, dtype=dtype, **kwargs)
+
+
+def bench(cm, beta, U, repeats=10):
+    # warm up, so that the work buffers exist before measuring
+    cm.neg_log_likelihood(beta=beta, U=U)
+    start = time.perf_counter()
+    for i in range(repeats):
+        val = cm.neg_log_likelihood(beta=beta, U=U)
+    obj_time = (time.perf_counter() - start) / repeats
+    start = time.perf_counter()
+    for i in range(repeats):
+        grad = cm.gradient_beta(beta=beta, U=U, flat=True)
+    grad_time = (time.perf_counter() - start) / repeats
+    return val, grad, obj_time, grad_time
+
+
+def main(m=1000000, n=2):
+    print(f"{'model':>28} {'dtype':>8} {'objective (ms)':>15} {'gradient (ms)':>14} "
+          f"{'objective rel err':>18} {'gradient rel err':>17}")
+    for model_type in MODEL_DICT:
+        results = dict()
+        for dtype in [np.float64, np.float32]:
+            cm = make_model(model_type, m=m, n=n, num_groups=m // 10, num_covs=5, dtype=dtype)
+            np.random.seed(1)
+            beta = 0.1 * np.random.randn(cm.beta_vec.size)
+            U = 0.1 * np.random.randn(*cm.U.shape)
+            results[dtype] = bench(cm, beta, U)
+        val, grad = results[np.float64][:2]
+        for dtype, (dtype_val, dtype_grad, obj_time, grad_time) in results.items():
+            val_err = abs(dtype_val - val) / abs(val)
+            grad_err = np.linalg.norm(dtype_grad - grad) / np.linalg.norm(grad)
+            print(f"{model_type:>28} {np.dtype(dtype).name:>8} {1e3 * obj_time:>15.2f} {1e3 * grad_time:>14.2f} "
+                  f"{val_err:>18.2e} {grad_err:>17.2e}")
+
+
+if __name__ == '__main__':
+    main()
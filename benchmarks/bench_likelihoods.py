@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_likelihoods
+    ~~~~~~~~~~~~~~~~~
+
+    Compare time and peak allocations of the negative log likelihoods in
+    `ccount.likelihoods.NegLogLikelihoods` with the previous kernels, which
+    evaluate both branches on every observation and mask them afterwards,
+    for each family on simulated data with a share of zeros. The kernels get
+    the likelihood context of the data, like in a model, and are
+    also evaluated with numexpr when it is installed, see
+    `ccount.likelihoods.USE_NUMEXPR`.
+
+    Run with `python benchmarks/bench_likelihoods.py`.
+"""
+import time
+import tracemalloc
+import numpy as np
+from scipy.special import loggamma
+
+from ccount import likelihoods
+from ccount.likelihoods import LikelihoodContext, NegLogLikelihoods
+
+
+def masked_hurdle_poisson(Y, P):
+    p = P[0]
+    theta = P[1]
+    ll = (
+        (np.log(p)) * (Y == 0) +
+        (np.log(1 - p) - theta + Y * np.log(theta) - np.log(1 - np.exp(-theta))) * (Y > 0)
+    )
+    return -ll
+
+
+def masked_zi_poisson(Y, P):
+    p = P[0]
+    theta = P[1]
+    ll = (
+        (np.log((p + (1 - p) * np.exp(-theta)))) * (Y == 0) +
+        (np.log(1 - p) - theta + Y * np.log(theta)) * (Y > 0)
+    )
+    return -ll
+
+
+def masked_nbinom(Y, P):
+    theta = P[0]
+    k = P[1] ** -1
+    ll = (
+        loggamma(Y + k) - loggamma(k) +
+        k * np.log(k) - k * np.log(k + theta) +
+        Y * np.log(theta) - Y * np.log(theta + k)
+    )
+    return -ll
+
+
+def masked_zi_nbinom(Y, P):
+    p = P[0]
+    theta = P[1]
+    k = P[2]
+    ll = (
+        (np.log(p + (1 - p) * (1 + k * theta) ** (-1 / k))) * (Y == 0) +
+        (np.log(1 - p) +
+         loggamma(Y + k ** (-1)) -
+         loggamma(k ** (-1)) -
+         k ** (-1) * np.log(1 + k * theta) -
+         Y * np.log(1 + (theta * k) ** (-1))) * (Y > 0)
+    )
+    return -ll
+
+
+FAMILIES = {
+    'hurdle_poisson': masked_hurdle_poisson,
+    'zi_poisson': masked_zi_poisson,
+    'nbinom': masked_nbinom,
+    'zi_nbinom': masked_zi_nbinom,
+}
+
+
+def make_data(family, m, n, zeros):
+    np.random.seed(0)
+    Y = np.random.poisson(lam=2., size=(m, n)) * np.random.binomial(n=1, p=1 - zeros, size=(m, n))
+    P = np.array([np.random.uniform(0.1, 0.9, size=(m, n)), np.random.uniform(0.5, 5., size=(m, n))])
+    if family == 'nbinom':
+        P = P[::-1].copy()
+    elif family == 'zi_nbinom':
+        P = np.concatenate([P, np.random.uniform(0.1, 3., size=(1, m, n))])
+    return Y, P
+
+
+def bench(f, Y, P, repeats=10):
+    f(Y, P)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(repeats):
+        f(Y, P)
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    kernels = ['masked', 'stable'] + (['numexpr'] if likelihoods.numexpr is not None else [])
+    print(f"{'family':>15} {'m':>8} {'zeros':>6} {'kernel':>8} {'time (ms)':>10} {'peak alloc (MB)':>16}")
+    for family, masked in FAMILIES.items():
+        for m in [10000, 100000, 1000000]:
+            for zeros in [0.1, 0.5, 0.9]:
+                Y, P = make_data(family, m=m, n=2, zeros=zeros)
+                data = LikelihoodContext(Y)
+                for name in kernels:
+                    likelihoods.USE_NUMEXPR = name == 'numexpr'
+                    if name == 'masked':
+                        f, observed = masked, Y
+                    else:
+                        f, observed = getattr(NegLogLikelihoods, family), data
+                    with np.errstate(all='ignore'):
+                        elapsed, peak = bench(f, observed, P)
+                    print(f"{family:>15} {m:>8} {zeros:>6.1f} {name:>8} {1e3 * elapsed:>10.2f} "
+                          f"{peak / 2 ** 20:>16.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_suite
+    ~~~~~~~~~~~
+
+    Time the fitting and prediction steps of every model in `MODEL_DICT` on
+    data from `ccount.simulate`, sweeping the number of observations, outcomes,
+    groups, covariates and splines. Every measurement is one JSON object per
+    line with the problem size, the step, its time in seconds, the number of
+    objective and gradient evaluations of the main model from its trace and the
+    peak memory allocated by numpy during the step in bytes, so that runs can be
+    compared to catch regressions and to size jobs.
+
+    Run with `python benchmarks/bench_suite.py --help` for the options, e.g.
+
+        python benchmarks/bench_suite.py --m 1000 10000 --groups 10 100 --output results.jsonl
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from ccount.models import MODEL_DICT
+from ccount.run import ModelRun
+from ccount.simulate import ZIPoissonSimulation
+
+STEPS = ['optimize_params', 'optimize_beta', 'optimize_U', 'compute_D', 'predict', 'bootstrap']
+
+# number of parameters of the models that do not have 2
+NUM_PARAMETERS = {'logistic': 1, 'binomial': 1, 'zero_inflated_negative_binomial': 3}
+
+
+def simulate_df(model_type, m, n, num_groups, num_covs, num_splines, seed=0):
+    """Simulated data frame with covariates x*, spline variables s*, outcomes y*, trials t* and a group column."""
+    np.random.seed(seed)
+    simulation = ZIPoissonSimulation(m=m, n=n, d=[num_covs] * n)
+    simulation.update_params(beta=[0.3 * b for b in simulation.beta], p=0.3)
+    Y = simulation.simulate()
+    if model_type == 'logistic':
+        Y = (Y > 0).astype(int)
+    df = pd.DataFrame({f'y{j}': Y[:, j] for j in range(n)})
+    for j in range(n):
+        df[f't{j}'] = Y[:, j] + np.random.randint(0, 5, size=m)
+    for j in range(n):
+        for c in range(num_covs):
+            df[f'x{j}_{c}'] = simulation.x[j][:, c]
+    for s in range(num_splines):
+        df[f's{s}'] = np.random.rand(m)
+    df['group'] = np.random.randint(0, num_groups, size=m)
+    return df
+
+
+def specification(model_type, n, num_covs, num_splines):
+    """Arguments of ModelRun for the data from simulate_df, with the same covariates for every parameter."""
+    l = NUM_PARAMETERS.get(model_type, 2)
+    fixed_effects = [[[f'x{j}_{c}' for c in range(num_covs)] for j in range(n)] for k in range(l)]
+    spline = None
+    if num_splines > 0:
+        spline = [[[{'name': f's{s}', 'knots_type': 'domain', 'knots_num': 3, 'degree': 3,
+                     'l_linear': False, 'r_linear': False} for s in range(num_splines)]
+                   for j in range(n)] for k in range(l)]
+    spec = dict(
+        model_type=model_type, outcome_variables=[f'y{j}' for j in range(n)],
+        fixed_effects=fixed_effects, random_effect='group', spline=spline
+    )
+    if model_type == 'binomial':
+        spec['trials'] = [f't{j}' for j in range(n)]
+    return spec
+
+
+def measure(setup, function, memory=True):
+    """
+    Time of function on the result of setup, and its peak allocations in a
+    second call on a new setup if memory is True. Setup is not measured.
+    """
+    subject = setup()
+    start = time.perf_counter()
+    function(subject)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        other = setup()
+        tracemalloc.start()
+        function(other)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_case(model_type, m, n, num_groups, num_covs, num_splines, steps=STEPS,
+               max_iters=3, bootstraps=5, memory=True):
+    """Measurements of the steps for one model and problem size."""
+    df = simulate_df(model_type, m, n, num_groups, num_covs, num_splines)
+    spec = specification(model_type, n, num_covs, num_splines)
+    optimize_kwargs = dict(max_iters=max_iters, max_beta_iters=100, max_U_iters=100)
+
+    def new_run(**kwargs):
+        return ModelRun(training_df=df, prediction_df=df, **optimize_kwargs, **spec, **kwargs)
+
+    def fitted_run():
+        run = new_run()
+        run.model.optimize_params(**optimize_kwargs)
+        return run
+
+    # setup and the step to measure, on a ModelRun
+    functions = {
+        'optimize_params': (new_run, lambda run: run.model.optimize_params(**optimize_kwargs)),
+        'optimize_beta': (new_run, lambda run: run.model.opt_interface.optimize_beta(maxiter=100)),
+        'optimize_U': (new_run, lambda run: run.model.opt_interface.optimize_U(maxiter=100)),
+        'compute_D': (fitted_run, lambda run: run.model.opt_interface.compute_D()),
+        'predict': (fitted_run, lambda run: run.predictions(model=run.model)),
+        'bootstrap': (lambda: new_run(bootstraps=bootstraps), lambda run: run.run()),
+    }
+    for step in steps:
+        setup, function = functions[step]
+        counts = dict()
+
+        def counted(run):
+            # evaluations of the main model during the step only, not during setup
+            trace = run.model.trace
+            before = dict(trace.evaluations), dict(trace.gradient_evaluations)
+            function(run)
+            counts['evaluations'] = {key: value - before[0].get(key, 0) for key, value in trace.evaluations.items()}
+            counts['gradient_evaluations'] = {key: value - before[1].get(key, 0)
+                                              for key, value in trace.gradient_evaluations.items()}
+
+        elapsed, peak = measure(setup, counted, memory=memory)
+        yield dict(
+            model=model_type, m=m, n=n, groups=num_groups, covariates=num_covs, splines=num_splines,
+            step=step, time=elapsed, peak_memory=peak, **counts
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', nargs='+', default=list(MODEL_DICT.keys()), choices=list(MODEL_DICT.keys()))
+    parser.add_argument('--m', nargs='+', type=int, default=[1000, 10000])
+    parser.add_argument('--n', nargs='+', type=int, default=[1, 2])
+    parser.add_argument('--groups', nargs='+', type=int, default=[10, 100])
+    parser.add_argument('--covariates', nargs='+', type=int, default=[2])
+    parser.add_argument('--splines', nargs='+', type=int, default=[0, 1])
+    parser.add_argument('--steps', nargs='+', default=STEPS, choices=STEPS)
+    parser.add_argument('--max-iters', type=int, default=3)
+    parser.add_argument('--bootstraps', type=int, default=5)
+    parser.add_argument('--no-memory', action='store_true', help='skip measuring the peak memory')
+    parser.add_argument('--output', default=None, help='file to append the results to, by default stdout')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'a') if args.output is not None else sys.stdout
+    try:
+        for model_type, m, n, num_groups, num_covs, num_splines in itertools.product(
+                args.models, args.m, args.n, args.groups, args.covariates, args.splines):
+            for result in bench_case(model_type, m, n, num_groups, num_covs, num_splines, steps=args.steps,
+                                     max_iters=args.max_iters, bootstraps=args.bootstraps,
+                                     memory=not args.no_memory):
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
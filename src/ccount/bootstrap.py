@@ -0,0 +1,297 @@
+"""
+Engine for fitting bootstrap replicates of a model. A replicate is either the
+row indices drawn from the base model or the number of times that each row is
+drawn, used as multinomial weights on the rows of the base model. The data of
+the base model is placed in shared memory once, every worker process attaches
+to it when it starts, and every task only carries the draws of one replicate
+and only returns its fitted beta, U and D.
+"""
+from copy import copy
+import logging
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+LOG = logging.getLogger(__name__)
+
+# model that the tasks of a worker process are resampled from
+_WORKER_MODEL = None
+# shared memory blocks of the worker model, kept open for its lifetime
+_WORKER_BLOCKS = list()
+
+
+def draw_bootstrap_indices(model, rng=None):
+    """
+    Draws the rows of one bootstrap replicate of a model, sampling the
+    observations of every group with replacement, as many as the group has.
+    The rows of a compressed model are drawn as often as the observations
+    they stand for.
+
+    Args:
+        model: (ccount.core.CorrelatedModel) model with data sorted by group
+        rng: (np.random.Generator) optional random number generator,
+            by default uses the global numpy random state
+
+    Returns:
+        np.ndarray of row indices, sorted by group
+    """
+    uniform = np.random.random_sample(model.num_obs) if rng is None else rng.random(model.num_obs)
+    if model.num_obs == model.m:
+        sizes = model.group_sizes[model.group_index]
+        return model.group_starts[model.group_index] + (uniform * sizes).astype(int)
+    # draw observations, numbered in the order of the rows, and find their rows
+    ends = np.cumsum(model.counts)
+    obs_sizes = np.add.reduceat(model.counts, model.group_starts)
+    obs_starts = ends[model.group_starts] - model.counts[model.group_starts]
+    group = np.repeat(np.arange(model.num_groups), obs_sizes)
+    obs = obs_starts[group] + (uniform * obs_sizes[group]).astype(int)
+    return np.searchsorted(ends, obs, side='right')
+
+
+def draw_bootstrap_weights(model, rng=None):
+    """
+    Draws one bootstrap replicate of a model like draw_bootstrap_indices, as the
+    number of times that each row is drawn, which is multinomial within every group.
+    For a compressed model, the counts are divided by the number of observations
+    of each row, since its weights are those of all of its observations.
+
+    Args:
+        model: (ccount.core.CorrelatedModel) model with data sorted by group
+        rng: (np.random.Generator) optional random number generator,
+            by default uses the global numpy random state
+
+    Returns:
+        np.ndarray of the counts of the rows
+    """
+    counts = np.bincount(draw_bootstrap_indices(model, rng=rng), minlength=model.m)
+    if model.num_obs == model.m:
+        return counts.astype(np.int32)
+    return counts / model.counts
+
+
+BOOTSTRAP_METHODS = {
+    'index': draw_bootstrap_indices,
+    'weights': draw_bootstrap_weights
+}
+
+
+def draw_bootstrap_samples(model, num, method='index', rng=None):
+    """
+    Draws bootstrap replicates of a model.
+
+    Args:
+        model: (ccount.core.CorrelatedModel) model with data sorted by group
+        num: (int) number of replicates
+        method: (str) 'index' for row indices or 'weights' for row counts
+        rng: (np.random.Generator) optional random number generator
+
+    Returns:
+        list of np.ndarray
+    """
+    if method not in BOOTSTRAP_METHODS:
+        raise ValueError(f"Unknown bootstrap method {method}. Pick one of {list(BOOTSTRAP_METHODS.keys())}")
+    return [BOOTSTRAP_METHODS[method](model, rng=rng) for i in range(num)]
+
+
+def replicate_model(model, sample, method='index'):
+    """
+    Model for one bootstrap replicate, sharing the specification of the base model.
+
+    Args:
+        model: (ccount.core.CorrelatedModel) base model
+        sample: (np.ndarray) draws of the replicate, see draw_bootstrap_samples
+        method: (str) 'index' or 'weights'
+
+    Returns:
+        ccount.core.CorrelatedModel
+    """
+    if method == 'weights':
+        return model.reweight(sample)
+    return model.resample(sample)
+
+
+class SharedArray:
+    """
+    Numpy array copied into a block of shared memory, that can be pickled
+    cheaply and re-attached in another process by the name of the block.
+    """
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self.block.name
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.block.buf)[...] = array
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.block = None
+
+    def attach(self):
+        """
+        Returns:
+            np.ndarray viewing the shared memory, valid while the block is open
+        """
+        if self.block is None:
+            self.block = shared_memory.SharedMemory(name=self.name)
+            _WORKER_BLOCKS.append(self.block)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.block.buf)
+
+    def close(self):
+        """Releases the shared memory, only to be called by the process that made it."""
+        self.block.close()
+        self.block.unlink()
+
+
+class SharedModel:
+    """
+    Copy of a model with its data arrays in shared memory. Pickling it only
+    pickles the small parts of the model and the names of the memory blocks.
+    """
+    def __init__(self, model):
+        self.arrays = list()
+        self.model = copy(model)
+        self.model.Y = self.share(model.Y)
+        self.model.W = self.share(model.W)
+        self.model.counts = self.share(model.counts)
+        self.model.group_id = self.share(model.group_id)
+        self.model.offset = [self.share(off) for off in model.offset]
+        self.model.X = [[self.share_X(X_kj) for X_kj in X_k] for X_k in model.X]
+        # rebuilt on attaching and by every resample, so do not send them
+        self.stack = None
+        if model.X_stacked is not None:
+            self.stack = 'sparse' if sparse.issparse(model.X_stacked) else 'dense'
+        self.model.X_stacked = None
+        self.model.P = None
+        self.model.group_index = None
+        self.model.opt_interface = None
+
+    def share(self, array):
+        shared = SharedArray(array)
+        self.arrays.append(shared)
+        return shared
+
+    def share_X(self, X_kj):
+        if sparse.issparse(X_kj):
+            return ('csr', self.share(X_kj.data), self.share(X_kj.indices), self.share(X_kj.indptr), X_kj.shape)
+        return self.share(X_kj)
+
+    @staticmethod
+    def attach_X(X_kj):
+        if isinstance(X_kj, tuple):
+            return sparse.csr_matrix((X_kj[1].attach(), X_kj[2].attach(), X_kj[3].attach()), shape=X_kj[4])
+        return X_kj.attach()
+
+    def attach(self):
+        """
+        Rebuilds the model on the shared memory, in a worker process.
+
+        Returns:
+            ccount.core.CorrelatedModel
+        """
+        model = copy(self.model)
+        model.Y = model.Y.attach()
+        model.W = model.W.attach()
+        model.counts = model.counts.attach()
+        model.group_id = model.group_id.attach()
+        model.offset = [off.attach() for off in model.offset]
+        model.X = [[self.attach_X(X_kj) for X_kj in X_k] for X_k in model.X]
+        model.group_data()
+        if self.stack is not None:
+            model.X_stacked = model.stack_X(X=model.X, stack=self.stack)
+        return model
+
+    def close(self):
+        """Releases all of the shared memory."""
+        for shared in self.arrays:
+            shared.close()
+        self.arrays = list()
+
+
+def initialize_worker(shared_model):
+    global _WORKER_MODEL
+    _WORKER_MODEL = shared_model.attach()
+
+
+def fit_replicate(model, sample, method, optimize_kwargs, warm_start=True):
+    """
+    Fits one bootstrap replicate of a model.
+
+    Args:
+        model: (ccount.core.CorrelatedModel) base model
+        sample: (np.ndarray) draws of the replicate, see draw_bootstrap_samples
+        method: (str) 'index' or 'weights'
+        optimize_kwargs: (dict) arguments for
+            ccount.core.CorrelatedModel.optimize_params
+        warm_start: (bool) start from the parameters of the base model
+            instead of from zero
+
+    Returns:
+        tuple of the flat fixed effects, the random effects and D of the fit
+    """
+    replicate = replicate_model(model, sample, method=method)
+    if warm_start:
+        replicate.warm_start(model)
+    replicate.optimize_params(**optimize_kwargs)
+    return replicate.beta_vec, replicate.U, replicate.D
+
+
+def fit_replicate_in_worker(task):
+    return fit_replicate(_WORKER_MODEL, *task)
+
+
+class BootstrapEngine:
+    """
+    Fits bootstrap replicates of a model, given as draws from the rows of the
+    model, either in this process or in a pool of worker processes that share
+    the data of the model.
+    """
+    def __init__(self, model, pools=1, method='index'):
+        """
+        Args:
+            model: (ccount.core.CorrelatedModel) base model to resample
+            pools: (int) number of worker processes, 1 fits in this process
+            method: (str) 'index' if the replicates are row indices or 'weights'
+                if they are row counts, see draw_bootstrap_samples
+        """
+        if method not in BOOTSTRAP_METHODS:
+            raise ValueError(f"Unknown bootstrap method {method}. Pick one of {list(BOOTSTRAP_METHODS.keys())}")
+        self.model = model
+        self.pools = pools
+        self.method = method
+
+    def fit(self, samples, warm_start=True, **optimize_kwargs):
+        """
+        Fits the replicates.
+
+        Args:
+            samples: (list of np.ndarray) draws of each replicate
+            warm_start: (bool) start every replicate from the current parameters
+                of the base model, e.g. its fit, instead of from zero
+            **optimize_kwargs: arguments for ccount.core.CorrelatedModel.optimize_params
+
+        Returns:
+            list of tuples of the flat fixed effects, the random effects and D of each fit
+        """
+        if self.pools <= 1:
+            results = list()
+            for i, sample in enumerate(samples):
+                LOG.info(f"Optimizing bootstrap model {i}.")
+                results.append(fit_replicate(self.model, sample, self.method, optimize_kwargs, warm_start))
+            return results
+
+        LOG.info(f"Optimizing {len(samples)} bootstrap models with {self.pools} pools.")
+        shared_model = SharedModel(self.model)
+        try:
+            with mp.Pool(self.pools, initializer=initialize_worker, initargs=(shared_model,)) as pool:
+                results = pool.map(fit_replicate_in_worker,
+                                   [(sample, self.method, optimize_kwargs, warm_start) for sample in samples],
+                                   chunksize=1)
+        finally:
+            shared_model.close()
+        return results
@@ -7,22 +7,61 @@
 """
 import logging
 import numpy as np
-from copy import deepcopy
+from copy import copy, deepcopy
+from scipy import linalg, sparse
 
+from ccount import link_functions
 from ccount import optimization
 from ccount import utils
 from ccount.bsplines import spline_design_mat
+from ccount.likelihoods import LikelihoodContext
 
 LOG = logging.getLogger(__name__)
 
 
+class DFactorization:
+    """Factorization of the random effects covariance matrices, giving the
+    pseudo-inverse and log pseudo-determinant of each of them.
+
+    Attributes
+    ----------
+    eigvals : numpy.ndarray
+        Eigenvalues of each covariance matrix, of shape (l, n).
+    eigvecs : numpy.ndarray
+        Eigenvectors of each covariance matrix, of shape (l, n, n).
+    inv : numpy.ndarray
+        Pseudo-inverse of each covariance matrix, same as `numpy.linalg.pinv`.
+    logdet : numpy.ndarray
+        Log of the pseudo-determinant of each covariance matrix, of shape (l,).
+    """
+
+    def __init__(self, D, rcond=1e-15):
+        """Factorize the covariance matrices.
+
+        Parameters
+        ----------
+        D : numpy.ndarray
+            Covariance matrices of shape (l, n, n).
+        rcond : float
+            Eigenvalues smaller than rcond times the largest eigenvalue are
+            treated as zero.
+        """
+        self.eigvals, self.eigvecs = np.linalg.eigh(D)
+        abs_eigvals = np.abs(self.eigvals)
+        nonzero = abs_eigvals > rcond * abs_eigvals.max(axis=1, keepdims=True)
+        inv_eigvals = np.zeros(self.eigvals.shape)
+        inv_eigvals[nonzero] = 1 / self.eigvals[nonzero]
+        self.inv = np.einsum('kij,kj,klj->kil', self.eigvecs, inv_eigvals, self.eigvecs)
+        self.logdet = np.sum(np.log(np.where(nonzero, abs_eigvals, 1.)), axis=1)
+
+
 class CorrelatedModel:
     """Correlated model with multiple outcomes.
 
     Attributes
     ----------
     m : int
-        Number of individuals.
+        Number of individuals, i.e. rows of the data.
     n : int
         Number of outcomes.
     l : int
@@ -34,13 +73,42 @@ class CorrelatedModel:
     X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
         List of list of 2D arrays, storing the covariates for each parameter
         and outcome.
+    counts : numpy.ndarray
+        Number of observations that each row stands for, more than 1 for the
+        rows of a compressed model.
+    num_obs : int
+        Number of observations, that the likelihood is averaged over. Equal to
+        `m` unless the model is compressed.
     g : :obj: `list` of :obj: `function`
         List of inverse link functions for each parameter.
     f : function
         Log likelihood function, better be `numpy.ufunc`.
         Needs to return an an array in the same shape as Y
+    df : function or None
+        Gradient of the negative log likelihood with respect to each parameter.
+        Needs to return an array in the same shape as P.
+    dg : :obj: `list` of :obj: `function` or None
+        List of derivatives of the inverse link functions for each parameter.
+    d2f : function or None
+        Hessian of the negative log likelihood with respect to each pair of
+        parameters. Needs to return an array of shape (l, l, m, n).
+    d2g : :obj: `list` of :obj: `function` or None
+        List of second derivatives of the inverse link functions.
     beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
         Fixed effects for predicting the parameters.
+    beta_vec : numpy.ndarray
+        Flat vector of the fixed effects. The arrays in `beta` are views into it.
+    dtype : numpy.dtype
+        Floating point type that the covariates, outcomes, weights and offsets
+        are stored in, and that the parameters are computed in. The fixed and
+        random effects are always float64, and so are the sums of the likelihood.
+    sparse_X : bool
+        Whether the covariates are stored as `scipy.sparse.csr_matrix`. Sparse
+        covariates are kept un-normalized and are normalized implicitly with
+        `X_scale` and `X_shift` wherever they are used.
+    X_stacked : numpy.ndarray or scipy.sparse.csr_matrix or None
+        Block diagonal design matrix with one block for each parameter and
+        outcome, so that the flattened linear predictor is `X_stacked.dot(beta_vec)`.
     U : array_like
         Random effects for predicting the parameters. Assume random effects
         follow multi-normal distribution.
@@ -51,8 +119,9 @@ class CorrelatedModel:
 
     """
 
-    def __init__(self, m, n, l, d, Y, X, g, f,
-                 spline_specs=None, group_id=None, offset=None, weights=None, add_intercepts=False, normalize_X=True):
+    def __init__(self, m, n, l, d, Y, X, g, f, df=None, dg=None, d2f=None, d2g=None,
+                 spline_specs=None, group_id=None, offset=None, weights=None, add_intercepts=False, normalize_X=True,
+                 stack_X=None, sparse_X=False, dtype=None, compress=False):
         """Correlated Model initialization method.
 
         Parameters
@@ -77,6 +146,18 @@ class CorrelatedModel:
             List of link functions for each parameter.
         f : function
             Negative log likelihood function, better be `numpy.ufunc`.
+        df : function, optional
+            Gradient of the negative log likelihood with respect to P. When
+            both `df` and `dg` are given the fixed effects are fit with analytic
+            gradients, otherwise with complex step differentiation.
+        dg : :obj: `list` of :obj: `function`, optional
+            List of derivatives of the link functions for each parameter.
+        d2f : function, optional
+            Hessian of the negative log likelihood with respect to P. When
+            given together with `df`, `dg` and `d2g`, the random effects are
+            fit group by group with batched Newton steps.
+        d2g : :obj: `list` of :obj: `function`, optional
+            List of second derivatives of the link functions for each parameter.
         group_id: :obj: `numpy.ndarray`, optional
             Optional integer group id, gives the way of grouping the random
             effects. When it is not `None`, it should have length `m`.
@@ -88,6 +169,24 @@ class CorrelatedModel:
             Should be of dimension m x n
         normalize_X: bool
             Whether or not to normalize the covariates
+        stack_X: str, optional
+            Also store the covariates as one block diagonal design matrix, so
+            that the linear predictor and the gradient for the fixed effects are
+            computed with one matrix-vector product each. One of "dense" or
+            "sparse". The dense matrix has l * n * m rows and as many columns
+            as there are fixed effects, so only use it for small problems.
+        sparse_X: bool
+            Store the covariates, including the spline bases, as
+            `scipy.sparse.csr_matrix`. The covariates are then normalized
+            implicitly rather than in place, which keeps them sparse.
+        dtype: numpy.dtype, optional
+            Floating point type to store the data in, e.g. `numpy.float32` to
+            halve the memory traffic of the likelihood. Defaults to float64.
+        compress: bool
+            Collapse rows with the same covariates, group, offsets, outcomes
+            and weights into one row whose weights are multiplied by the number
+            of rows, see `compress_rows`. The fit then scales with the number of
+            unique rows, and gives the same estimates.
         """
         self.model_type = None
         self.parameters = None
@@ -122,12 +221,21 @@ class CorrelatedModel:
         else:
             self.W = weights
 
-        # data
-        self.Y = Y
+        # data, stored in the working precision
+        self.dtype = np.dtype(float if dtype is None else dtype)
+        if self.dtype.kind != 'f':
+            raise ValueError(f"dtype must be a floating point type, got {self.dtype}.")
+        self.Y = Y.astype(self.dtype)
+        self.W = self.W.astype(self.dtype)
+        self.offset = [off.astype(self.dtype) for off in self.offset]
 
         # use this later to grab only the covariate indices that were not on splines
         self.cs = [[list(range(k.shape[1])) if k is not None else list() for k in j] for j in X]
 
+        self.sparse_X = sparse_X
+        if self.sparse_X:
+            X = [[sparse.csr_matrix(k) if k is not None else None for k in j] for j in X]
+
         # create the spline specifications
         if spline_specs is not None:
             self.xs = [[[
@@ -143,14 +251,7 @@ class CorrelatedModel:
             self.xs = None
 
         # create splines
-        if spline_specs is not None:
-            S = [[
-                np.concatenate([
-                    self.xs[k][j][i].design_mat(g['spline_var'])[:, 1:] for i, g in enumerate(g_dict)
-                ], axis=1) if g_dict is not None else None for j, g_dict in enumerate(s)]
-                for k, s in enumerate(spline_specs)]
-        else:
-            S = None
+        S = self.spline_X(spline_specs=spline_specs)
 
         # add on an intercept for each parameter
         # and set the index of the first covariate
@@ -167,29 +268,48 @@ class CorrelatedModel:
             )
             # add on the full design matrix for the splines, if applicable
             # do this before normalizing the covariates
-            X = [[np.concatenate([x, s], axis=1) if s is not None else x for x, s in zip(x_outcome, s_outcome)]
+            X = [[self.concatenate_X([x, s]) if s is not None else x for x, s in zip(x_outcome, s_outcome)]
                  for x_outcome, s_outcome in zip(X, S)]
 
         # center and scale the covariates, but keep the mean and std for use later on
         # if we're not normalizing the covariates, just make the mean 0 and std 1 to avoid
         # if-else computation later.
         if normalize_X:
-            self.X_mean = [[k.mean(axis=0) for k in j] for j in X]
-            self.X_std = [[k.std(axis=0) for k in j] for j in X]
+            self.X_mean = [[np.asarray(k.mean(axis=0)).ravel() for k in j] for j in X]
+            self.X_std = [[np.sqrt(np.maximum(np.asarray(k.multiply(k).mean(axis=0)).ravel() - mean ** 2, 0.))
+                           if sparse.issparse(k) else k.std(axis=0) for k, mean in zip(j, j_mean)]
+                          for j, j_mean in zip(X, self.X_mean)]
         else:
             self.X_mean = [[np.zeros(k.shape[1]) for k in j] for j in X]
             self.X_std = [[np.ones(k.shape[1]) for k in j] for j in X]
 
-        # normalize
-        self.X = self.normalize_X(X=X)
+        # scale and shift that normalize the sparse covariates implicitly,
+        # X_normalized.dot(beta) = X.dot(beta * X_scale) - X_shift.dot(beta)
+        self.X_scale = [[np.concatenate([np.ones(self.ci), 1 / std[self.ci:]]) for std in j] for j in self.X_std]
+        self.X_shift = [[np.concatenate([np.zeros(self.ci), mean[self.ci:] / std[self.ci:]])
+                         for mean, std in zip(j_mean, j_std)]
+                        for j_mean, j_std in zip(self.X_mean, self.X_std)]
 
-        # link and log likelihood functions
+        # normalize, then store in the working precision
+        self.X = [[k.astype(self.dtype) for k in j] for j in self.normalize_X(X=X)]
+
+        # link and log likelihood functions, and their derivatives
         self.g = g
         self.f = f
+        self.df = df
+        self.dg = dg
+        self.d2f = d2f
+        self.d2g = d2g
 
         # check input
         self.check()
 
+        # number of observations that each row stands for, and in total
+        self.counts = np.ones(self.m, dtype=int)
+        self.num_obs = self.m
+        if compress:
+            self.compress_rows()
+
         # group the data, including offset, with group_id
         sort_id = np.argsort(self.group_id)
         self.group_id = self.group_id[sort_id]
@@ -199,25 +319,211 @@ class CorrelatedModel:
         self.Y = self.Y[sort_id]
         self.X = self.sort_X(X=self.X, sort_id=sort_id)
         self.W = self.W[sort_id]
-
+        self.counts = self.counts[sort_id]
+
+        # quantities of the likelihood that only depend on the data
+        self._likelihood_context = LikelihoodContext(self.Y)
+
+        self.group_data()
+
+        # stacked design matrix
+        if stack_X not in [None, 'dense', 'sparse']:
+            raise ValueError(f"stack_X must be one of None, 'dense' or 'sparse', got {stack_X}.")
+        self.X_stacked = self.stack_X(X=self.X, stack=stack_X) if stack_X is not None else None
+        self.X_scale_vec = utils.beta_to_vec(self.X_scale)
+        self.X_shift_vec = utils.beta_to_vec(self.X_shift)
+        self.beta_starts = np.cumsum(self.d.ravel()) - self.d.ravel()
+
+        self.initialize_params()
+
+    def compress_rows(self):
+        """Collapses the rows with the same covariates, group, offsets,
+        outcomes and weights into one row, whose weights are multiplied by the
+        number of rows it stands for, in `counts`. The likelihood is linear in
+        the weights and is averaged over `num_obs`, the number of observations
+        before compressing, so the objective does not change. The covariates
+        are compared after adding the splines and normalizing, so those are the
+        same as without compressing.
+        """
+        columns = [self.group_id[:, None], self.Y, self.W] + list(self.offset)
+        columns += [utils.sparse_row_key(X_kj) if sparse.issparse(X_kj) else X_kj for X_k in self.X for X_kj in X_k]
+        # compare the rows as bytes, which is much faster than np.unique(axis=0)
+        key = np.ascontiguousarray(np.hstack(columns).astype(float))
+        key = key.view(np.dtype((np.void, key.dtype.itemsize * key.shape[1]))).ravel()
+        _, index, counts = np.unique(key, return_index=True, return_counts=True)
+        LOG.info(f"Compressed {self.m} rows into {index.size} unique rows.")
+
+        self.m = int(index.size)
+        self.counts = counts
+        self.group_id = self.group_id[index]
+        self.Y = self.Y[index]
+        self.W = self.W[index] * counts.astype(self.dtype)[:, None]
+        self.offset = [off[index] for off in self.offset]
+        self.X = [[X_kj[index] for X_kj in X_k] for X_k in self.X]
+
+    def group_data(self):
+        """Sets up the sizes and positions of the groups of the random effects,
+        for data that is sorted by group_id."""
         self.unique_group_id, self.group_sizes = np.unique(self.group_id,
                                                            return_counts=True)
         self.num_groups = self.unique_group_id.size
+        self.group_starts = np.cumsum(self.group_sizes) - self.group_sizes
+        self.group_index = np.repeat(np.arange(self.num_groups), self.group_sizes)
 
-        # fixed effects
-        self.beta = [[np.zeros(self.d[k, j])
-                      for j in range(self.n)] for k in range(self.l)]
+    def initialize_params(self):
+        """Sets the fixed effects and random effects to zero and D to the
+        identity, and resets the work arrays and the optimization interface."""
+        # fixed effects, stored as a flat vector with the nested arrays as views
+        self.beta_vec = np.zeros(np.sum(self.d))
+        self.beta = utils.vec_to_beta(self.beta_vec, self.d)
 
         # random effects and its covariance matrix
         self.U = np.zeros((self.l, self.num_groups, self.n))
         self.D = np.array([np.identity(self.n) for k in range(self.l)])
+        self._D_factorization = None
 
         # place holder for parameter
         self.P = np.zeros((self.l, self.m, self.n))
 
+        # work arrays for evaluating the objective, see `work_buffer`
+        self._work_buffers = dict()
+
         # optimization interface
         self.opt_interface = optimization.OptimizationInterface(self)
 
+    @property
+    def trace(self):
+        """Trace of the optimization of the model, see `ccount.telemetry.Trace`."""
+        return self.opt_interface.trace
+
+    def resample(self, index):
+        """Model on a resample of the rows of this model, e.g. a bootstrap
+        replicate. The specification, including the normalization of the
+        covariates and the splines, is shared with this model, and the
+        parameters start from zero like for a new model.
+
+        Parameters
+        ----------
+        index : numpy.ndarray
+            Integer indices of the rows to use, in the order of this model's
+            data, which is sorted by group_id. Rows may repeat. Each index
+            stands for one observation of a compressed row, and the resample of
+            a compressed model is compressed too, with one row for every row
+            that is drawn and the number of draws in `counts`.
+
+        Returns
+        -------
+        CorrelatedModel
+            The resampled model.
+        """
+        num_obs = int(index.size)
+        if self.num_obs != self.m:
+            index, counts = np.unique(index, return_counts=True)
+        else:
+            index = np.sort(index)
+            counts = np.ones(index.size, dtype=int)
+        model = copy(self)
+        model.m = int(index.size)
+        model.num_obs = num_obs
+        model.counts = counts
+        model.Y = self.Y[index]
+        # weights of one of the observations of each row, times its draws
+        model.W = (self.W[index] * (counts / self.counts[index])[:, None]).astype(self.dtype, copy=False)
+        model.offset = [off[index] for off in self.offset]
+        model.group_id = self.group_id[index]
+        model.X = [[X_kj[index] for X_kj in X_k] for X_k in self.X]
+        model.group_data()
+        if self.X_stacked is not None:
+            model.X_stacked = model.stack_X(X=model.X, stack='sparse' if sparse.issparse(self.X_stacked) else 'dense')
+        model.initialize_params()
+        return model
+
+    def reweight(self, weights):
+        """Model that shares the data and specification of this model with
+        its weights multiplied row by row, e.g. a bootstrap replicate given as
+        the number of times that each row is drawn. Parameters start from zero
+        like for a new model.
+
+        Parameters
+        ----------
+        weights : numpy.ndarray
+            Non-negative weight of each row, in the order of this model's data.
+
+        Returns
+        -------
+        CorrelatedModel
+            The reweighted model.
+        """
+        assert weights.shape == (self.m,)
+        assert (weights >= 0).all()
+        model = copy(self)
+        model.W = self.W * weights.astype(self.dtype)[:, None]
+        model.initialize_params()
+        return model
+
+    def replicate(self, beta=None, U=None, D=None, compute_P=True):
+        """Model that shares the data and specification of this model, with
+        its own parameters, e.g. to hold the fit of a bootstrap replicate for
+        making predictions.
+
+        Parameters
+        ----------
+        beta : :obj: `numpy.ndarray`, optional
+            Flat fixed effects. Defaults to those of this model.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for the groups of this model. Defaults to those of this model.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution. Defaults to that of this model.
+        compute_P : bool, optional
+            If False, the parameters of the training data are not computed and
+            the replicate only holds its fit, with `P` set to None. This keeps
+            many replicates, e.g. of the bootstraps, from each holding an
+            array of the size of the data.
+
+        Returns
+        -------
+        CorrelatedModel
+            The replicate.
+        """
+        model = copy(self)
+        if not compute_P:
+            model.P = None
+        model._work_buffers = dict()
+        model.opt_interface = optimization.OptimizationInterface(model)
+        model.update_params(
+            beta=self.beta_vec if beta is None else beta,
+            U=self.U.copy() if U is None else U,
+            D=self.D.copy() if D is None else D,
+            compute_P=compute_P
+        )
+        return model
+
+    def warm_start(self, model):
+        """Start the parameters from those of another model with the same
+        specification, e.g. of the main model for a bootstrap replicate. The
+        random effects are matched by group_id, and groups that the other model
+        does not have start from zero.
+
+        Parameters
+        ----------
+        model : CorrelatedModel
+            Model to take the parameters from.
+        """
+        pos = np.minimum(np.searchsorted(model.unique_group_id, self.unique_group_id),
+                         model.num_groups - 1)
+        found = model.unique_group_id[pos] == self.unique_group_id
+        U = np.zeros(self.U.shape, dtype=model.U.dtype)
+        U[:, found] = model.U[:, pos[found]]
+        self.update_params(beta=model.beta_vec, U=U, D=model.D.copy())
+
+    def __getstate__(self):
+        # the work arrays and the likelihood context are rebuilt on demand,
+        # so do not copy or pickle them
+        state = self.__dict__.copy()
+        state['_work_buffers'] = dict()
+        state['_likelihood_context'] = None
+        return state
+
     def check(self):
         """Check the type, value and size of the inputs."""
         # types
@@ -235,17 +541,27 @@ class CorrelatedModel:
         assert isinstance(self.W, np.ndarray)
 
         assert isinstance(self.Y, np.ndarray)
-        assert self.Y.dtype == np.number
+        assert np.issubdtype(self.Y.dtype, np.number)
         assert isinstance(self.X, list)
         for X_k in self.X:
             assert isinstance(X_k, list)
             for X_kj in X_k:
-                assert isinstance(X_kj, np.ndarray)
-                assert X_kj.dtype == np.number
+                assert isinstance(X_kj, np.ndarray) or sparse.isspmatrix_csr(X_kj)
+                assert np.issubdtype(X_kj.dtype, np.number)
 
         assert isinstance(self.g, list)
         assert all(callable(g_k) for g_k in self.g)
         assert callable(self.f)
+        if self.df is not None:
+            assert callable(self.df)
+        if self.dg is not None:
+            assert isinstance(self.dg, list)
+            assert all(callable(dg_k) for dg_k in self.dg)
+        if self.d2f is not None:
+            assert callable(self.d2f)
+        if self.d2g is not None:
+            assert isinstance(self.d2g, list)
+            assert all(callable(d2g_k) for d2g_k in self.d2g)
         LOG.info("...passed.")
 
         # values
@@ -256,7 +572,7 @@ class CorrelatedModel:
         assert np.all(self.d > 0)
         for k in self.X:
             for j in k:
-                assert np.isfinite(j).all()
+                assert np.isfinite(j.data if sparse.issparse(j) else j).all()
         for offset_k in self.offset:
             assert np.isfinite(offset_k).all()
         assert (self.W >= 0).all()
@@ -272,6 +588,10 @@ class CorrelatedModel:
                    for j in range(self.n))
 
         assert len(self.g) == self.l
+        if self.dg is not None:
+            assert len(self.dg) == self.l
+        if self.d2g is not None:
+            assert len(self.d2g) == self.l
         assert self.group_id.shape == (self.m,)
         assert len(self.offset) == self.l
         for offset_k in self.offset:
@@ -296,6 +616,64 @@ class CorrelatedModel:
                 sorted_X[k][j] = sorted_X[k][j][sort_id]
         return sorted_X
 
+    def stack_X(self, X, stack):
+        """
+        Stacks the list of lists of input arrays into one block diagonal
+        matrix, with the blocks in the same order as `utils.beta_to_vec`.
+        Args:
+            X: list of list of np.ndarray
+            stack: (str) one of "dense" or "sparse"
+
+        Returns:
+            X_stacked: np.ndarray or scipy.sparse.csr_matrix
+        """
+        blocks = [X[k][j] for k in range(self.l) for j in range(self.n)]
+        if stack == 'sparse':
+            return sparse.block_diag(blocks, format='csr')
+        return linalg.block_diag(*[b.toarray() if sparse.issparse(b) else b for b in blocks])
+
+    def spline_X(self, spline_specs):
+        """
+        Spline bases of each parameter and outcome, without their first column.
+        With sparse covariates, every basis is made sparse as soon as it is
+        built, so that the bases of a parameter and outcome are never
+        concatenated into one dense block.
+
+        Args:
+            spline_specs: list of list of list of dict with the 'spline_var' of each spline, or None
+
+        Returns:
+            list of list of np.ndarray or scipy.sparse.csr_matrix, or None
+        """
+        if spline_specs is None:
+            return None
+
+        def basis(spline, spline_var):
+            mat = spline.design_mat(spline_var)[:, 1:]
+            return sparse.csr_matrix(mat) if self.sparse_X else mat
+
+        return [[
+            self.concatenate_X([
+                basis(self.xs[k][j][i], g['spline_var']) for i, g in enumerate(g_dict)
+            ]) if g_dict is not None else None for j, g_dict in enumerate(s)]
+            for k, s in enumerate(spline_specs)]
+
+    @staticmethod
+    def concatenate_X(blocks):
+        """
+        Concatenates covariate matrices column-wise, keeping the result sparse
+        if any of the blocks is sparse.
+
+        Args:
+            blocks: list of np.ndarray or scipy.sparse.csr_matrix
+
+        Returns:
+            np.ndarray or scipy.sparse.csr_matrix
+        """
+        if any(sparse.issparse(b) for b in blocks):
+            return sparse.hstack(blocks, format='csr')
+        return np.concatenate(blocks, axis=1)
+
     def intercept_X(self, X, m):
         """
         Adds on an intercept to the covariates matrices passed in.
@@ -309,12 +687,14 @@ class CorrelatedModel:
         """
         new_X = deepcopy(X)
         intercept = np.ones((m, 1))
+        if self.sparse_X:
+            intercept = sparse.csr_matrix(intercept)
         for i in range(self.l):
             for j in range(self.n):
                 if new_X[i][j] is None:
                     new_X[i][j] = intercept.copy()
                 else:
-                    new_X[i][j] = np.concatenate((intercept, X[i][j]), axis=1)
+                    new_X[i][j] = self.concatenate_X([intercept, X[i][j]])
         return new_X
 
     def normalize_X(self, X):
@@ -322,6 +702,8 @@ class CorrelatedModel:
         Subtracts the mean and divides by the standard deviation
         that are saved in self.X_mean and self.X_std for the covariates.
         Assumes that X has an intercept and that we're not going to normalize that!
+        Sparse covariates are left as they are, they are normalized implicitly
+        with self.X_scale and self.X_shift.
 
         Args:
             X: list of list of np.ndarray
@@ -332,11 +714,265 @@ class CorrelatedModel:
         X_list = deepcopy(X)
         for i in range(self.l):
             for j in range(self.n):
+                if sparse.issparse(X_list[i][j]):
+                    continue
                 X_list[i][j][:, self.ci:] = ((X_list[i][j][:, self.ci:] - self.X_mean[i][j][self.ci:]) /
                                              self.X_std[i][j][self.ci:])
         return X_list
 
-    def compute_P(self, X, m, group_sizes, offset, beta=None, U=None):
+    def design_dot(self, X_kj, beta_kj, k, j):
+        """
+        Product of the normalized covariates for parameter k and outcome j with
+        their fixed effects.
+
+        Args:
+            X_kj: np.ndarray (normalized) or scipy.sparse.csr_matrix (not normalized)
+            beta_kj: np.ndarray, or a 2D np.ndarray with one set of fixed effects per column
+            k: index of the parameter
+            j: index of the outcome
+
+        Returns:
+            np.ndarray of length X_kj.shape[0], with one column per set of fixed effects if beta_kj is 2D
+        """
+        if sparse.issparse(X_kj):
+            scale = self.X_scale[k][j].reshape((-1,) + (1,) * (beta_kj.ndim - 1))
+            beta_scaled = (beta_kj * scale).astype(beta_kj.dtype, copy=False)
+            return X_kj.dot(beta_scaled) - self.X_shift[k][j].dot(beta_kj)
+        return X_kj.dot(beta_kj)
+
+    def design_rdot(self, X_kj, r, k, j):
+        """
+        Product of the transposed normalized covariates for parameter k and
+        outcome j with a vector, e.g. a gradient with respect to the linear predictor.
+
+        Args:
+            X_kj: np.ndarray (normalized) or scipy.sparse.csr_matrix (not normalized)
+            r: np.ndarray of length X_kj.shape[0]
+            k: index of the parameter
+            j: index of the outcome
+
+        Returns:
+            np.ndarray of length X_kj.shape[1]
+        """
+        if sparse.issparse(X_kj):
+            return self.X_scale[k][j] * X_kj.T.dot(r) - self.X_shift[k][j] * np.sum(r)
+        return X_kj.T.dot(r)
+
+    def design_weighted_gram(self, h, k, j, k2):
+        """
+        Product of the transposed normalized covariates for parameter k and
+        outcome j with the rows of the normalized covariates for parameter k2
+        and outcome j scaled by h, i.e. X_kj^T diag(h) X_k2j.
+
+        Args:
+            h: np.ndarray of length m, weights of the rows
+            k: index of the first parameter
+            j: index of the outcome
+            k2: index of the second parameter
+
+        Returns:
+            np.ndarray of shape (d[k, j], d[k2, j])
+        """
+        X1, X2 = self.X[k][j], self.X[k2][j]
+        if not sparse.issparse(X1) and not sparse.issparse(X2):
+            return X1.T.dot(h[:, None] * X2)
+        # with X_normalized = X * X_scale - X_shift, expanded so that the
+        # sparse covariates are never densified
+        X1 = sparse.csr_matrix(X1) if not sparse.issparse(X1) else X1
+        X2 = sparse.csr_matrix(X2) if not sparse.issparse(X2) else X2
+        s1, t1 = (self.X_scale[k][j], self.X_shift[k][j]) if sparse.issparse(self.X[k][j]) else (1., 0.)
+        s2, t2 = (self.X_scale[k2][j], self.X_shift[k2][j]) if sparse.issparse(self.X[k2][j]) else (1., 0.)
+        t1 = np.broadcast_to(t1, X1.shape[1])
+        t2 = np.broadcast_to(t2, X2.shape[1])
+        gram = np.asarray(X1.T.dot(X2.multiply(h[:, None]).tocsr()).todense())
+        return (np.asarray(s1).reshape(-1, 1) * gram * s2 -
+                np.outer(s1 * X1.T.dot(h), t2) - np.outer(t1, s2 * X2.T.dot(h)) +
+                np.sum(h) * np.outer(t1, t2))
+
+    def design_group_sums(self, h, k, j):
+        """
+        Sums over the rows of each group of the normalized covariates for
+        parameter k and outcome j scaled by h.
+
+        Args:
+            h: np.ndarray of length m, weights of the rows
+            k: index of the parameter
+            j: index of the outcome
+
+        Returns:
+            np.ndarray of shape (num_groups, d[k, j])
+        """
+        X_kj = self.X[k][j]
+        if not sparse.issparse(X_kj):
+            return np.add.reduceat(h[:, None] * X_kj, self.group_starts, axis=0)
+        indicator = sparse.csr_matrix((h, (self.group_index, np.arange(self.m))),
+                                      shape=(self.num_groups, self.m))
+        sums = np.asarray(indicator.dot(X_kj).todense())
+        h_sums = np.add.reduceat(h, self.group_starts)
+        return self.X_scale[k][j] * sums - np.outer(h_sums, self.X_shift[k][j])
+
+    def work_buffer(self, name, shape, dtype=float):
+        """Get a preallocated work array owned by the model. Arrays are
+        allocated the first time they are asked for and then reused, so their
+        contents are overwritten by every call that uses them.
+
+        Parameters
+        ----------
+        name : str
+            Name of the buffer.
+        shape : tuple
+            Shape of the buffer.
+        dtype : numpy.dtype, optional
+            Data type of the buffer.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        key = (name, shape, np.dtype(dtype))
+        if key not in self._work_buffers:
+            self._work_buffers[key] = np.empty(shape, dtype=dtype)
+        return self._work_buffers[key]
+
+    def compute_eta(self, X, m, group_sizes, beta=None, U=None, buffered=False):
+        """Compute the linear predictor, before the link functions are applied.
+
+        Parameters
+        ----------
+        X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+            Covariates matrix
+        m : `int`
+            Number of individuals
+        group_sizes : :obj: `np.ndarray` indicating the sizes of each group
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters, either nested or as
+            a flat vector.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        buffered : bool, optional
+            If True, write the result into the work buffers of the model
+            instead of allocating new arrays. The result is then only valid
+            until the next buffered call.
+
+        Returns
+        -------
+        array_like
+            Linear predictor for each parameter, individual and outcome.
+        """
+        if beta is None:
+            beta = self.beta_vec
+        if U is None:
+            U = self.U
+        if U.ndim != 3 or U.shape[1] != group_sizes.size:
+            raise ValueError(f"U must have one row for each of the {group_sizes.size} groups of the data, "
+                             f"got shape {U.shape}.")
+        # random effects that only broadcast against the parameters and
+        # outcomes are added without the buffers
+        buffered = buffered and U.shape == (self.l, group_sizes.size, self.n)
+        stacked = self.X_stacked is not None and X is self.X
+        if stacked and not isinstance(beta, np.ndarray):
+            beta = utils.beta_to_vec(beta)
+        if not stacked and isinstance(beta, np.ndarray):
+            beta = utils.vec_to_beta(beta, self.d)
+
+        # the linear predictor is stored as (l, n, m) so that every dot
+        # product writes into a contiguous block, in the working precision
+        if stacked:
+            dtype = np.result_type(U, beta)
+        else:
+            dtype = np.result_type(U, *[b for b_k in beta for b in b_k])
+        dtype = np.result_type(self.dtype, np.complex64) if dtype.kind == 'c' else self.dtype
+        U = U.astype(dtype, copy=False)
+        shape = (self.l, self.n, m)
+        if buffered:
+            eta = self.work_buffer('eta', shape, dtype)
+        else:
+            eta = np.empty(shape, dtype=dtype)
+        self.design_matvec(X=X, beta=beta, out=eta)
+
+        if not buffered:
+            return eta.transpose(0, 2, 1) + np.repeat(U, group_sizes, axis=1)
+
+        # add the random effects by gathering each group's value for its
+        # segment of rows. The group index is in range by construction and U
+        # has been checked above, so np.take does not need mode='raise',
+        # which would buffer the output
+        if group_sizes is self.group_sizes:
+            group_index = self.group_index
+        else:
+            group_index = np.repeat(np.arange(group_sizes.size), group_sizes)
+        U_rep = self.work_buffer('U', shape, U.dtype)
+        np.take(U.transpose(0, 2, 1), group_index, axis=2, out=U_rep, mode='clip')
+        eta += U_rep
+        return eta.transpose(0, 2, 1)
+
+    def design_matvec(self, X, beta, out):
+        """Product of the normalized covariates with the fixed effects, or
+        with any other vector shaped like them.
+
+        Parameters
+        ----------
+        X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+            Covariates matrix. The stacked design matrix is used when `X` is
+            the covariates of the model.
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray` or :obj: `numpy.ndarray`
+            Nested fixed effects, or a flat vector when using the stacked design matrix.
+        out : :obj: `numpy.ndarray`
+            Array of shape (l, n, m) that the product is written into.
+
+        Returns
+        -------
+        numpy.ndarray
+            The array `out`.
+        """
+        if self.X_stacked is not None and X is self.X:
+            beta = beta.astype(out.dtype, copy=False)
+            beta_scaled = (beta * self.X_scale_vec).astype(out.dtype) if self.sparse_X else beta
+            if sparse.issparse(self.X_stacked) or np.result_type(self.X_stacked, beta) != out.dtype:
+                out.reshape(-1)[:] = self.X_stacked.dot(beta_scaled)
+            else:
+                np.dot(self.X_stacked, beta_scaled, out=out.reshape(-1))
+            if self.sparse_X:
+                shift = np.add.reduceat(beta * self.X_shift_vec, self.beta_starts)
+                out -= shift.reshape((self.l, self.n, 1))
+        else:
+            beta = [[b.astype(out.dtype, copy=False) for b in b_k] for b_k in beta]
+            for k in range(self.l):
+                for j in range(self.n):
+                    if sparse.issparse(X[k][j]) or np.result_type(X[k][j], beta[k][j]) != out.dtype:
+                        out[k, j] = self.design_dot(X[k][j], beta[k][j], k, j)
+                    else:
+                        np.dot(X[k][j], beta[k][j], out=out[k, j])
+        return out
+
+    def design_rmatvec(self, R, flat=False):
+        """Product of the transposed normalized covariates of the model with
+        an array shaped like the linear predictor, e.g. its gradient.
+
+        Parameters
+        ----------
+        R : :obj: `numpy.ndarray`
+            Array of shape (l, m, n).
+        flat : bool, optional
+            Return a flat vector rather than nested like beta.
+
+        Returns
+        -------
+        :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+            Product in the same structure as beta.
+        """
+        if self.X_stacked is not None:
+            R = R.transpose(0, 2, 1)
+            vec = self.X_stacked.T.dot(R.reshape(-1))
+            if self.sparse_X:
+                vec = (self.X_scale_vec * vec -
+                       self.X_shift_vec * np.repeat(R.sum(axis=2).ravel(), self.d.ravel()))
+            return vec if flat else utils.vec_to_beta(vec, self.d)
+        nested = [[self.design_rdot(self.X[k][j], R[k][:, j], k, j)
+                   for j in range(self.n)] for k in range(self.l)]
+        return utils.beta_to_vec(nested) if flat else nested
+
+    def compute_P(self, X, m, group_sizes, offset, beta=None, U=None, buffered=False):
         """Compute the parameter matrix.
 
         Parameters
@@ -352,36 +988,40 @@ class CorrelatedModel:
             Random effects for predicting the parameters. Assume random effects
             follow multi-normal distribution.
         offset: `list` of :obj: `numpy.ndarray`
+        buffered : bool, optional
+            If True, compute P in the work buffers of the model, applying
+            the links and offsets in place. The result is then only valid until
+            the next buffered call.
 
         Returns
         -------
         array_like
             Parameters for each individual and outcome.
         """
-        if beta is None:
-            beta = self.beta
-        if U is None:
-            U = self.U
+        P = self.compute_eta(X=X, m=m, group_sizes=group_sizes, beta=beta, U=U,
+                             buffered=buffered)
+        if buffered:
+            # work on the contiguous (l, n, m) layout of the buffer
+            P_T = P.transpose(0, 2, 1)
+            for k in range(self.l):
+                link_functions.apply_in_place(self.g[k], P_T[k])
+                P_T[k] *= offset[k].T
+            return P
 
-        P = np.array([X[k][j].dot(beta[k][j])
-                      for k in range(self.l)
-                      for j in range(self.n)])
-        P = P.reshape((self.l, self.n, m)).transpose(0, 2, 1)
-        U = np.repeat(U, group_sizes, axis=1)
-        P = P + U
         for k in range(self.l):
             P[k] = self.g[k](P[k])
         for k in range(self.l):
             P[k] = P[k] * offset[k]
         return P
 
-    def update_params(self, beta=None, U=None, D=None, P=None):
+    def update_params(self, beta=None, U=None, D=None, P=None, compute_P=True):
         """Update the variables related to the parameters.
 
         Parameters
         ----------
         beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
-            Fixed effects for predicting the parameters.
+            Fixed effects for predicting the parameters, either nested or as
+            a flat vector.
         U : :obj: `numpy.ndarray`, optional
             Random effects for predicting the parameters. Assume random effects
             follow multi-normal distribution.
@@ -391,17 +1031,24 @@ class CorrelatedModel:
             Parameters for each individual and outcome. If `P` is provided,
             the `self.P` will be overwrite by its value, otherwise,
             the `self.P` will be updated by the fixed and random effects.
+        compute_P : bool, optional
+            If False and `P` is not provided, `self.P` is left as it is.
 
         """
         if beta is not None:
-            self.beta = beta
+            if isinstance(beta, np.ndarray):
+                self.beta_vec = beta.copy()
+            else:
+                self.beta_vec = utils.beta_to_vec(beta)
+            self.beta = utils.vec_to_beta(self.beta_vec, self.d)
         if U is not None:
             self.U = U
         if D is not None:
             self.D = D
+            self._D_factorization = None
         if P is not None:
             self.P = P
-        else:
+        elif compute_P:
             self.P = self.compute_P(
                 X=self.X, m=self.m, group_sizes=self.group_sizes, offset=self.offset
             )
@@ -425,23 +1072,571 @@ class CorrelatedModel:
             Average log likelihood.
         """
         if beta is None:
-            beta = self.beta
+            beta = self.beta_vec
         if U is None:
             U = self.U
-        if D is None:
-            D = self.D
 
         P = self.compute_P(beta=beta, U=U, m=self.m, X=self.X,
-                           group_sizes=self.group_sizes, offset=self.offset)
-        # data negative log likelihood
-        val = np.mean(np.sum(self.f(self.Y, P) * self.W, axis=1))
+                           group_sizes=self.group_sizes, offset=self.offset,
+                           buffered=True)
+        # data negative log likelihood, accumulated in double precision
+        val = np.sum(self.f(self.likelihood_data(self.f), P) * self.W,
+                     dtype=np.result_type(P, np.float64)) / self.num_obs
         # random effects prior
-        for k in range(self.l):
-            val += 0.5*np.mean(np.sum(U[k].dot(np.linalg.pinv(D[k]))*U[k],
-                                      axis=1))
+        val += np.sum(self.prior_U(U=U, D=D))
 
         return val
 
+    def D_factorization(self, D=None):
+        """Get the factorization of the random effects covariance matrices.
+        The factorization of `self.D` is cached until D is updated through
+        `update_params`.
+
+        Parameters
+        ----------
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution. If given,
+            it is factorized without touching the cache.
+
+        Returns
+        -------
+        DFactorization
+        """
+        if D is not None:
+            return DFactorization(D)
+        if self._D_factorization is None:
+            self._D_factorization = DFactorization(self.D)
+        return self._D_factorization
+
+    def prior_U(self, U=None, D=None):
+        """Random effects prior contribution of each group to the negative
+        log likelihood.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of length num_groups.
+        """
+        if U is None:
+            U = self.U
+        D_inv = self.D_factorization(D).inv
+        val = 0.
+        for k in range(self.l):
+            val = val + np.sum(U[k].dot(D_inv[k])*U[k], axis=1)
+        return 0.5*val / self.num_groups
+
+    def gradient_prior_U(self, U=None, D=None):
+        """Gradient of the random effects prior with respect to U.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            Gradient in the same shape as U.
+        """
+        if U is None:
+            U = self.U
+        D_inv = self.D_factorization(D).inv
+        return np.array([U[k].dot(D_inv[k]) for k in range(self.l)]) / self.num_groups
+
+    def likelihood_data(self, function):
+        """Observed data to pass to the likelihood or one of its derivatives.
+        Functions that take a likelihood context, see
+        `ccount.likelihoods.takes_context`, get the context of `Y`, which is
+        only rebuilt when `Y` is replaced, e.g. by `resample`.
+
+        Parameters
+        ----------
+        function : function
+            Likelihood function or one of its derivatives.
+
+        Returns
+        -------
+        ccount.likelihoods.LikelihoodContext or numpy.ndarray
+            Context of the data, or `Y` for functions that do not take one.
+        """
+        if not getattr(function, 'takes_context', False):
+            return self.Y
+        if self._likelihood_context is None or self._likelihood_context.Y is not self.Y:
+            self._likelihood_context = LikelihoodContext(self.Y)
+        return self._likelihood_context
+
+    @property
+    def has_gradient(self):
+        """Whether the analytic gradient of the likelihood is available."""
+        return self.df is not None and self.dg is not None
+
+    @property
+    def has_hessian(self):
+        """Whether the analytic Hessian of the likelihood is available."""
+        return self.has_gradient and self.d2f is not None and self.d2g is not None
+
+    def link_derivatives(self, eta, order=1):
+        """Apply the links and offsets to the linear predictor, together with
+        their derivatives up to `order`.
+
+        Parameters
+        ----------
+        eta : numpy.ndarray
+            Linear predictor, from `compute_eta`.
+        order : int
+            Either 1 or 2.
+
+        Returns
+        -------
+        :obj: `list` of :obj: `numpy.ndarray`
+            P and its derivatives with respect to eta.
+        """
+        result = [np.empty(eta.shape, dtype=eta.dtype) for i in range(order + 1)]
+        links = [self.g, self.dg, self.d2g][:order + 1]
+        for k in range(self.l):
+            for r, link in zip(result, links):
+                r[k] = link[k](eta[k]) * self.offset[k]
+        return result
+
+    def gradient_eta(self, beta=None, U=None):
+        """Gradient of the data negative log likelihood with respect to the
+        linear predictor, using the chain rule through `df` and `dg`.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+
+        Returns
+        -------
+        numpy.ndarray
+            Gradient for each parameter, individual and outcome, in the same
+            shape as P.
+        """
+        eta = self.compute_eta(beta=beta, U=U, m=self.m, X=self.X,
+                               group_sizes=self.group_sizes, buffered=True)
+        P, dP = self.link_derivatives(eta)
+        return self.df(self.likelihood_data(self.df), P) * dP * self.W / self.num_obs
+
+    def hessian_eta(self, beta=None, U=None):
+        """Hessian of the data negative log likelihood with respect to the
+        linear predictor. Each individual and outcome only depends on its own
+        l parameters, so the Hessian is stored as one (l, l) block for each.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (l, l, m, n).
+        """
+        eta = self.compute_eta(beta=beta, U=U, m=self.m, X=self.X,
+                               group_sizes=self.group_sizes, buffered=True)
+        P, dP, d2P = self.link_derivatives(eta, order=2)
+        H = self.d2f(self.likelihood_data(self.d2f), P) * dP[:, None] * dP[None, :]
+        grad_P = self.df(self.likelihood_data(self.df), P)
+        for k in range(self.l):
+            H[k, k] += grad_P[k] * d2P[k]
+        return H * self.W / self.num_obs
+
+    def gradient_beta(self, beta=None, U=None, flat=False):
+        """Gradient of the negative log likelihood with respect to the
+        fixed effects.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        flat : bool, optional
+            Return the gradient as a flat vector rather than nested like beta.
+
+        Returns
+        -------
+        :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+            Gradient in the same structure as beta.
+        """
+        grad_eta = self.gradient_eta(beta=beta, U=U)
+        return self.design_rmatvec(grad_eta, flat=flat)
+
+    def hessian_beta_vector(self, vec, H_eta):
+        """Product of the Hessian of the negative log likelihood with respect to
+        the fixed effects with a vector, X^T H_eta X vec, without forming the Hessian.
+
+        Parameters
+        ----------
+        vec : :obj: `numpy.ndarray`
+            Flat vector shaped like the fixed effects.
+        H_eta : :obj: `numpy.ndarray`
+            Hessian with respect to the linear predictor from `hessian_eta`,
+            of shape (l, l, m, n).
+
+        Returns
+        -------
+        numpy.ndarray
+            Flat vector shaped like the fixed effects.
+        """
+        if self.X_stacked is None:
+            vec = utils.vec_to_beta(vec, self.d)
+        d_eta = self.design_matvec(X=self.X, beta=vec, out=np.empty((self.l, self.n, self.m), dtype=self.dtype))
+        d_eta = d_eta.transpose(0, 2, 1)
+        R = np.einsum('abij,bij->aij', H_eta, d_eta)
+        return self.design_rmatvec(R, flat=True)
+
+    def gradient_U(self, beta=None, U=None, D=None):
+        """Gradient of the negative log likelihood with respect to the
+        random effects.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            Gradient in the same shape as U.
+        """
+        if U is None:
+            U = self.U
+        grad_eta = self.gradient_eta(beta=beta, U=U)
+        grad = np.add.reduceat(grad_eta, self.group_starts, axis=1, dtype=np.float64)
+        return grad + self.gradient_prior_U(U=U, D=D)
+
+    def gradient_beta_U(self, beta=None, U=None, D=None):
+        """Gradients of the negative log likelihood with respect to the fixed
+        and the random effects, sharing one evaluation of the parameters.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Flat gradient for the fixed effects, and the gradient in the same shape as U.
+        """
+        if U is None:
+            U = self.U
+        grad_eta = self.gradient_eta(beta=beta, U=U)
+        grad_beta = self.design_rmatvec(grad_eta, flat=True)
+        grad_U = np.add.reduceat(grad_eta, self.group_starts, axis=1, dtype=np.float64)
+        return grad_beta, grad_U + self.gradient_prior_U(U=U, D=D)
+
+    def hessian_beta_U_vector(self, vec_beta, vec_U, H_eta, D=None):
+        """Product of the joint Hessian of the negative log likelihood with
+        respect to the fixed and random effects with a vector. The joint Hessian
+        has a dense block for the fixed effects, a block diagonal block by group
+        for the random effects, and both are only touched through the Hessian
+        with respect to the linear predictor.
+
+        Parameters
+        ----------
+        vec_beta : :obj: `numpy.ndarray`
+            Flat vector shaped like the fixed effects.
+        vec_U : :obj: `numpy.ndarray`
+            Array shaped like the random effects.
+        H_eta : :obj: `numpy.ndarray`
+            Hessian with respect to the linear predictor from `hessian_eta`,
+            of shape (l, l, m, n).
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Flat product for the fixed effects, and the product in the same shape as U.
+        """
+        if self.X_stacked is None:
+            vec_beta = utils.vec_to_beta(vec_beta, self.d)
+        d_eta = self.design_matvec(X=self.X, beta=vec_beta, out=np.empty((self.l, self.n, self.m), dtype=self.dtype))
+        d_eta = d_eta.transpose(0, 2, 1) + np.take(vec_U, self.group_index, axis=1)
+        R = np.einsum('abij,bij->aij', H_eta, d_eta)
+        H_beta = self.design_rmatvec(R, flat=True)
+        H_U = np.add.reduceat(R, self.group_starts, axis=1, dtype=np.float64)
+        return H_beta, H_U + self.gradient_prior_U(U=vec_U, D=D)
+
+    def group_neg_log_likelihood(self, beta=None, U=None, D=None):
+        """Contribution of each group to the negative log likelihood. Given the
+        fixed effects, each group only depends on its own random effects and
+        the contributions sum to `neg_log_likelihood`.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of length num_groups.
+        """
+        if U is None:
+            U = self.U
+        P = self.compute_P(beta=beta, U=U, m=self.m, X=self.X,
+                           group_sizes=self.group_sizes, offset=self.offset,
+                           buffered=True)
+        dtype = np.result_type(P, np.float64)
+        val = np.add.reduceat(np.sum(self.f(self.likelihood_data(self.f), P) * self.W, axis=1, dtype=dtype),
+                              self.group_starts) / self.num_obs
+        return val + self.prior_U(U=U, D=D)
+
+    def group_hessian_data_U(self, beta=None, U=None, H_eta=None):
+        """Hessian of the data part of the negative log likelihood, without
+        the random effects prior, with respect to the random effects. The
+        Hessian is block diagonal by group, and each block is indexed by the
+        parameter and outcome in the same order as `U[:, i, :]`.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        H_eta : :obj: `numpy.ndarray`, optional
+            Hessian with respect to the linear predictor, if it has already
+            been computed with `hessian_eta` for beta and U.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (num_groups, l*n, l*n).
+        """
+        if H_eta is None:
+            H_eta = self.hessian_eta(beta=beta, U=U)
+        H_eta = np.add.reduceat(H_eta, self.group_starts, axis=2, dtype=np.float64)
+        H = np.zeros((self.num_groups, self.l, self.n, self.l, self.n))
+        for j in range(self.n):
+            H[:, :, j, :, j] = H_eta[:, :, :, j].transpose(2, 0, 1)
+        return H.reshape((self.num_groups, self.l*self.n, self.l*self.n))
+
+    def block_diag_D(self, D_blocks):
+        """Places one (n, n) matrix per parameter on the diagonal of an
+        (l*n, l*n) matrix, in the same order as the group Hessians.
+
+        Parameters
+        ----------
+        D_blocks : :obj: `numpy.ndarray`
+            Array of shape (l, n, n), e.g. D or its inverse.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (l*n, l*n).
+        """
+        return linalg.block_diag(*D_blocks)
+
+    def group_hessian_U(self, beta=None, U=None, D=None, H_eta=None):
+        """Hessian of the negative log likelihood with respect to the random
+        effects. The Hessian is block diagonal by group, and each block is
+        indexed by the parameter and outcome in the same order as `U[:, i, :]`.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+        H_eta : :obj: `numpy.ndarray`, optional
+            Hessian with respect to the linear predictor, if it has already
+            been computed with `hessian_eta` for beta and U.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (num_groups, l*n, l*n).
+        """
+        D_inv = self.D_factorization(D).inv
+        H = self.group_hessian_data_U(beta=beta, U=U, H_eta=H_eta)
+        return H + self.block_diag_D(D_inv) / self.num_groups
+
+    def laplace_group_objective(self, U=None, D=None):
+        """Negative log joint likelihood of each group's data and random
+        effects, for random effects distributed N(0, D), up to a constant.
+        Unlike `group_neg_log_likelihood`, the likelihood is not averaged over
+        the observations, which is the scale the Laplace approximation needs.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of length num_groups.
+        """
+        return (self.num_obs * self.group_neg_log_likelihood(U=U, D=D) +
+                (self.num_groups - self.num_obs) * self.prior_U(U=U, D=D))
+
+    def laplace_gradient_U(self, U=None, D=None):
+        """Gradient of `laplace_group_objective` with respect to the random effects.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        numpy.ndarray
+            Gradient in the same shape as U.
+        """
+        return (self.num_obs * self.gradient_U(U=U, D=D) +
+                (self.num_groups - self.num_obs) * self.gradient_prior_U(U=U, D=D))
+
+    def laplace_hessian_U(self, U=None, D=None, H_data=None):
+        """Hessian of `laplace_group_objective` with respect to the random
+        effects, i.e. the precision of the Laplace approximation of the
+        posterior of each group's random effects.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+        H_data : :obj: `numpy.ndarray`, optional
+            Data Hessian from `group_hessian_data_U` at U, if it is already known.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (num_groups, l*n, l*n).
+        """
+        if H_data is None:
+            H_data = self.group_hessian_data_U(U=U)
+        return self.num_obs * H_data + self.block_diag_D(self.D_factorization(D).inv)
+
+    def laplace_neg_log_marginal(self, U=None, D=None, H=None):
+        """Laplace approximation of the negative log marginal likelihood of D,
+        up to a constant, with the random effects of each group integrated out
+        around U, which should be their mode under D.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`, optional
+            Modes of the random effects.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+        H : :obj: `numpy.ndarray`, optional
+            Hessian from `laplace_hessian_U` at U, if it is already known.
+
+        Returns
+        -------
+        float
+            Approximate negative log marginal likelihood.
+        """
+        if H is None:
+            H = self.laplace_hessian_U(U=U, D=D)
+        _, logdet = np.linalg.slogdet(H)
+        val = np.sum(self.laplace_group_objective(U=U, D=D))
+        val += 0.5 * self.num_groups * np.sum(self.D_factorization(D).logdet)
+        return val + 0.5 * np.sum(logdet)
+
+    def laplace_update_D(self, U, H):
+        """Fixed point update of D for the Laplace approximation of the marginal
+        likelihood, D_k = mean(u_k u_k^T + Sigma_k) over groups, where u are the
+        modes of the random effects and Sigma_k is block k of the inverse of the
+        Hessian at the mode. Unlike the sample covariance of U, this accounts for
+        the uncertainty of the random effects. For fixed modes, the fixed point
+        is a stationary point of `laplace_neg_log_marginal` in D.
+
+        Parameters
+        ----------
+        U : :obj: `numpy.ndarray`
+            Modes of the random effects.
+        H : :obj: `numpy.ndarray`
+            Hessian from `laplace_hessian_U` at U.
+
+        Returns
+        -------
+        numpy.ndarray
+            Updated D, of shape (l, n, n).
+        """
+        cov = np.linalg.inv(H).reshape((self.num_groups, self.l, self.n, self.l, self.n))
+        cov = np.einsum('gkikj->kij', cov)
+        return (np.einsum('kgi,kgj->kij', U, U) + cov) / self.num_groups
+
+    def hessian_beta_U_blocks(self, beta=None, U=None, D=None):
+        """Blocks of the joint Hessian of the negative log likelihood with
+        respect to the fixed and random effects. The random effects block is
+        block diagonal by group, so it is stored as one block per group, and so
+        is the cross block between the fixed effects and each group.
+
+        Parameters
+        ----------
+        beta : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`, optional
+            Fixed effects for predicting the parameters.
+        U : :obj: `numpy.ndarray`, optional
+            Random effects for predicting the parameters.
+        D : :obj: `numpy.ndarray`, optional
+            Covariance matrix for the random effects distribution.
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            Fixed effects block of shape (num_beta, num_beta), cross blocks of
+            shape (num_groups, l*n, num_beta) and random effects blocks of shape
+            (num_groups, l*n, l*n), from `group_hessian_U`.
+        """
+        H_eta = self.hessian_eta(beta=beta, U=U)
+        C = self.group_hessian_U(D=D, H_eta=H_eta)
+        # the linear predictor of parameter k and outcome j only depends on the
+        # fixed effects of the same block, so every pair of parameters of an
+        # outcome is one weighted product of their covariates in one pass
+        num_beta = self.beta_vec.size
+        A = np.zeros((num_beta, num_beta))
+        B = np.zeros((self.num_groups, self.l * self.n, num_beta))
+        H_eta = H_eta.astype(np.float64, copy=False)
+        blocks = [[slice(self.beta_starts[k * self.n + j], self.beta_starts[k * self.n + j] + self.d[k, j])
+                   for j in range(self.n)] for k in range(self.l)]
+        for j in range(self.n):
+            for k in range(self.l):
+                for k2 in range(self.l):
+                    h = H_eta[k, k2, :, j]
+                    if k2 >= k:
+                        A[blocks[k][j], blocks[k2][j]] = self.design_weighted_gram(h, k, j, k2)
+                        A[blocks[k2][j], blocks[k][j]] = A[blocks[k][j], blocks[k2][j]].T
+                    B[:, k * self.n + j, blocks[k2][j]] = self.design_group_sums(h, k2, j)
+        return A, B, C
+
     def optimize_params(self,
                         max_iters=10,
                         optimize_beta=True,
@@ -449,7 +1644,11 @@ class CorrelatedModel:
                         compute_D=True,
                         rel_tol=None,
                         max_beta_iters=1e3,
-                        max_U_iters=1e3):
+                        max_U_iters=1e3,
+                        U_method=None,
+                        beta_method=None,
+                        joint=False,
+                        D_method=None):
         """Optimize the parameters.
 
         Parameters
@@ -471,23 +1670,47 @@ class CorrelatedModel:
         max_U_iters: int, option
             Maximum number of iterations for scipy.optimize for U, in every
             max_iters iteration
+        U_method: str, optional
+            Method for optimizing U, see
+            `ccount.optimization.OptimizationInterface.optimize_U`.
+        beta_method: str, optional
+            Method for optimizing beta, see
+            `ccount.optimization.OptimizationInterface.optimize_beta`.
+        joint: bool, optional
+            Optimize beta and U together in every iteration with
+            `ccount.optimization.OptimizationInterface.optimize_joint`, with
+            at most max_beta_iters iterations, instead of one after the other.
+            Only used when both optimize_beta and optimize_U are True.
+        D_method: str, optional
+            Method for computing D, see
+            `ccount.optimization.OptimizationInterface.compute_D`.
         """
         LOG.info("Optimizing the parameters.")
+        joint = joint and optimize_beta and optimize_U
         for i in range(max_iters):
             LOG.info(f"On iteration {i}...")
             error = 0
-            if optimize_beta:
+            if joint:
+                old_beta = self.beta_vec.copy()
+                old_U = deepcopy(self.U)
+                self.opt_interface.optimize_joint(maxiter=max_beta_iters)
+                beta_error = utils.relative_error(old=old_beta, new=self.beta_vec)
+                U_error = utils.relative_error(old=old_U, new=self.U)
+                error += beta_error + U_error
+                LOG.debug(f"current beta is {self.beta} \nrelative error {beta_error}")
+                LOG.debug(f"current U is {self.U} \nrelative error {U_error}")
+            if optimize_beta and not joint:
                 old_beta = deepcopy(self.beta)
-                self.opt_interface.optimize_beta(maxiter=max_beta_iters)
+                self.opt_interface.optimize_beta(maxiter=max_beta_iters, method=beta_method)
                 beta_error = utils.relative_error(
                     old=utils.beta_to_vec(old_beta),
                     new=utils.beta_to_vec(self.beta)
                 )
                 error += beta_error
                 LOG.debug(f"current beta is {self.beta} \nrelative error {beta_error}")
-            if optimize_U:
+            if optimize_U and not joint:
                 old_U = deepcopy(self.U)
-                self.opt_interface.optimize_U(maxiter=max_U_iters)
+                self.opt_interface.optimize_U(maxiter=max_U_iters, method=U_method)
                 U_error = utils.relative_error(
                     old=old_U, new=self.U
                 )
@@ -495,7 +1718,7 @@ class CorrelatedModel:
                 LOG.debug(f"current U is {self.U} \nrelative error {U_error}")
             if compute_D:
                 old_D = deepcopy(self.D)
-                self.opt_interface.compute_D()
+                self.opt_interface.compute_D(method=D_method)
                 D_error = utils.relative_error(
                     old=np.array([d[np.triu_indices(self.n)] for d in old_D]),
                     new=np.array([d[np.triu_indices(self.n)] for d in self.D])
@@ -525,8 +1748,8 @@ class CorrelatedModel:
         for X_k in X:
             assert isinstance(X_k, list)
             for X_kj in X_k:
-                assert isinstance(X_kj, np.ndarray)
-                assert X_kj.dtype == np.number
+                assert isinstance(X_kj, np.ndarray) or sparse.isspmatrix_csr(X_kj)
+                assert np.issubdtype(X_kj.dtype, np.number)
         assert len(X) == self.l
         assert all(len(X[k]) == self.n for k in range(self.l))
         assert all(X[k][j].shape == (len(group_id), self.d[k, j])
@@ -590,10 +1813,10 @@ class CorrelatedModel:
                            "function for a model. Make sure you are not using this class directly. Subclass it"
                            "and over-write this method in your subclass.")
 
-    def predict(self, X, m, spline_specs, group_id=None, offset=None):
+    def prediction_data(self, X, m, spline_specs, group_id=None, offset=None):
         """
-        Predict the outcome matrix given a new X matrix and optional group IDs. If the group IDs
-        don't fit the group IDs used to fit the model, then no random effects will be added on.
+        Build the design of new data for predictions the same way as the data
+        of the model: adds the spline bases and intercepts and normalizes the covariates.
         Args:
             X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
                 List of list of 2D arrays, storing the covariates for each parameter
@@ -605,22 +1828,20 @@ class CorrelatedModel:
                 Optional integer group id, gives the way of grouping the random
                 effects. When it is not `None`, it should have length `m`.
             offset: `list` of :obj: `numpy.ndarray`, optional
+
+        Returns:
+            tuple of the normalized covariates with intercepts, the group ids and the offsets
         """
         if self.add_intercepts:
             LOG.info("Adding an intercept because it was added in the original model."
                      "If this is incorrect, please take away the existing intercept, or fit a new model.")
-        if spline_specs is not None:
-            S = [[
-                np.concatenate([
-                    self.xs[k][j][i].design_mat(g['spline_var'])[:, 1:] for i, g in enumerate(g_dict)
-                ], axis=1) if g_dict is not None else None for j, g_dict in enumerate(s)]
-                for k, s in enumerate(spline_specs)]
-        else:
-            S = None
+        S = self.spline_X(spline_specs=spline_specs)
 
+        if self.sparse_X:
+            X = [[sparse.csr_matrix(k) if k is not None else None for k in j] for j in X]
         X = self.intercept_X(X=X, m=m)
         if S is not None:
-            X = [[np.concatenate([x, s], axis=1) if s is not None else x for x, s in zip(x_outcome, s_outcome)]
+            X = [[self.concatenate_X([x, s]) if s is not None else x for x, s in zip(x_outcome, s_outcome)]
                  for x_outcome, s_outcome in zip(X, S)]
         normal_X_with_intercept = self.normalize_X(X=X)
         if group_id is None:
@@ -634,6 +1855,27 @@ class CorrelatedModel:
 
         # Check the type and dimensions of X and the groups
         self.check_new_X(X=normal_X_with_intercept, group_id=group_id)
+        return normal_X_with_intercept, group_id, offset
+
+    def predict(self, X, m, spline_specs, group_id=None, offset=None):
+        """
+        Predict the outcome matrix given a new X matrix and optional group IDs. If the group IDs
+        don't fit the group IDs used to fit the model, then no random effects will be added on.
+        Args:
+            X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+                List of list of 2D arrays, storing the covariates for each parameter
+                and outcome (or None instead of array if no covariates)
+            m: int
+                Number of observations
+            spline_specs: :obj: `list` of :obj: `list` of :obj: `list` of `dict`
+            group_id: :obj: `numpy.ndarray`, optional
+                Optional integer group id, gives the way of grouping the random
+                effects. When it is not `None`, it should have length `m`.
+            offset: `list` of :obj: `numpy.ndarray`, optional
+        """
+        normal_X_with_intercept, group_id, offset = self.prediction_data(
+            X=X, m=m, spline_specs=spline_specs, group_id=group_id, offset=offset
+        )
 
         # Compute a new parameter matrix based on X and the group ids,
         # and the existing U and beta from self
@@ -643,6 +1885,137 @@ class CorrelatedModel:
         predictions = self.mean_outcome(P=P)
         return predictions
 
+    def predict_iter(self, X, m, spline_specs, group_id=None, offset=None, chunk_size=100000):
+        """
+        Predict the outcome matrix like `predict`, streaming the observations in
+        chunks of rows so that the memory used is bounded by the chunk size
+        rather than by the number of observations.
+        Args:
+            X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+                List of list of 2D arrays, storing the covariates for each parameter
+                and outcome (or None instead of array if no covariates)
+            m: int
+                Number of observations
+            spline_specs: :obj: `list` of :obj: `list` of :obj: `list` of `dict`
+            group_id: :obj: `numpy.ndarray`, optional
+                Optional integer group id, gives the way of grouping the random
+                effects. When it is not `None`, it should have length `m`.
+            offset: `list` of :obj: `numpy.ndarray`, optional
+            chunk_size: int
+                Number of observations in each chunk
+
+        Yields:
+            np.ndarray of the predictions for the next chunk of observations, of shape (chunk, n)
+        """
+        assert chunk_size > 0
+        if group_id is None:
+            group_id = np.arange(m)
+        for start in range(0, m, chunk_size):
+            rows = slice(start, min(start + chunk_size, m))
+            yield self.predict(
+                X=[[x[rows] if x is not None else None for x in X_k] for X_k in X],
+                m=rows.stop - rows.start,
+                spline_specs=self.slice_spline_specs(spline_specs, rows),
+                group_id=group_id[rows],
+                offset=[off[rows] if off is not None else None for off in offset] if offset is not None else None
+            )
+
+    @staticmethod
+    def slice_spline_specs(spline_specs, rows):
+        """
+        Spline specifications for a subset of the observations.
+
+        Args:
+            spline_specs: :obj: `list` of :obj: `list` of :obj: `list` of `dict`, or None
+            rows: slice or index of the observations
+
+        Returns:
+            copy of spline_specs with the 'spline_var' of each spline subset to rows
+        """
+        if spline_specs is None:
+            return None
+        return [[
+            [dict(g, spline_var=g['spline_var'][rows]) for g in g_dict] if g_dict is not None else None
+            for g_dict in s] for s in spline_specs]
+
+    def new_group_index(self, group_id):
+        """
+        Position of the random effects of new group ids in U, or self.num_groups for
+        groups that were not present in the fitting of the model.
+
+        Args:
+            group_id: :obj: `numpy.ndarray` integer group id of each observation
+
+        Returns:
+            np.ndarray of the positions
+        """
+        pos = np.minimum(np.searchsorted(self.unique_group_id, group_id), self.num_groups - 1)
+        return np.where(self.unique_group_id[pos] == group_id, pos, self.num_groups)
+
+    def predict_draws(self, X, m, spline_specs, betas, Us, group_id=None, offset=None):
+        """
+        Predict the outcome matrix for many sets of parameters at once, e.g. for
+        the fits of the bootstrap replicates of this model, building the design
+        of the new data only once. Groups that were not present in the fitting
+        of the model get no random effects, like in `predict`.
+        Args:
+            X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+                List of list of 2D arrays, storing the covariates for each parameter
+                and outcome (or None instead of array if no covariates)
+            m: int
+                Number of observations
+            spline_specs: :obj: `list` of :obj: `list` of :obj: `list` of `dict`
+            betas: :obj: `numpy.ndarray`
+                Flat fixed effects of each set of parameters, of shape (B, sum(d))
+            Us: :obj: `numpy.ndarray`
+                Random effects of each set of parameters for the groups of this
+                model, of shape (B, l, num_groups, n)
+            group_id: :obj: `numpy.ndarray`, optional
+                Optional integer group id, gives the way of grouping the random
+                effects. When it is not `None`, it should have length `m`.
+            offset: `list` of :obj: `numpy.ndarray`, optional
+
+        Returns:
+            np.ndarray of the predictions of shape (B, m, n)
+        """
+        normal_X_with_intercept, group_id, offset = self.prediction_data(
+            X=X, m=m, spline_specs=spline_specs, group_id=group_id, offset=offset
+        )
+        return self.mean_outcome(P=self.compute_new_P_draws(
+            X=normal_X_with_intercept, group_id=group_id, offset=offset, betas=betas, Us=Us
+        ))
+
+    def compute_new_P_draws(self, X, group_id, offset, betas, Us):
+        """
+        Compute the parameter matrices of new data for many sets of parameters,
+        see `predict_draws`.
+
+        Args:
+            X : :obj: `list` of :obj: `list` of :obj: `numpy.ndarray`
+                Normalized covariates with intercepts
+            group_id: :obj: `numpy.ndarray` integer group id of each observation
+            offset: `list` of :obj: `numpy.ndarray`
+            betas: :obj: `numpy.ndarray` of shape (B, sum(d))
+            Us: :obj: `numpy.ndarray` of shape (B, l, num_groups, n)
+
+        Returns:
+            np.ndarray of shape (l, B, m, n)
+        """
+        betas = np.asarray(betas)
+        m = len(group_id)
+        # append a zero random effect for the groups that the model was not fit on
+        Us = np.concatenate([Us, np.zeros(Us.shape[:2] + (1,) + Us.shape[3:], dtype=Us.dtype)], axis=2)
+        index = self.new_group_index(group_id)
+        P = np.empty((self.l, betas.shape[0], m, self.n), dtype=np.result_type(self.dtype, betas))
+        d = self.d.ravel()
+        for k in range(self.l):
+            for j in range(self.n):
+                start = self.beta_starts[k * self.n + j]
+                beta_kj = betas[:, start:start + d[k * self.n + j]].T
+                P[k, :, :, j] = self.design_dot(X[k][j], beta_kj, k, j).T + Us[:, k, index, j]
+            P[k] = self.g[k](P[k]) * offset[k]
+        return P
+
     def summarize(self, file=None):
         """
         Output summaries of the model results.
@@ -653,7 +2026,9 @@ class CorrelatedModel:
         message.append(f"MODEL SUMMARY FOR {self.model_type.upper()}")
         message.append("------------------------------------------")
         message.append("------------------------------------------")
-        message.append(f"NUM OBSERVATIONS: {self.m}")
+        message.append(f"NUM OBSERVATIONS: {self.num_obs}")
+        if self.m != self.num_obs:
+            message.append(f"NUM UNIQUE ROWS: {self.m}")
         message.append(f"NUM PARAMETERS: {self.n}")
         message.append(f"NUM OUTCOMES: {self.l}")
         message.append("------------------------------------------")
@@ -1,18 +1,133 @@
+import functools
+
 import numpy as np
-from scipy.special import loggamma
+from scipy.special import loggamma, digamma, polygamma, xlogy, xlog1py
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Evaluate the kernels of the likelihoods with numexpr. It is only faster than
+# numpy with several threads or with Intel VML, so it is off by default.
+USE_NUMEXPR = False
+
+# the kernels of the likelihoods as numexpr expressions, of the same arrays as
+# their numpy versions in `NegLogLikelihoods`
+NUMEXPR_KERNELS = {
+    'hurdle_poisson': 'where(zero, -log(p), theta - log1p(-p) - y * log(theta) + log(-expm1(-theta)))',
+    'zi_poisson': 'where(zero, -log(p + exp(log_q - theta)), theta - log_q - y * log(theta))',
+    'zi_nbinom': 'where(zero, -log(p + exp(log_q - s)), s - log_q + y * log1p(k / theta))',
+    'nbinom': 'k * log1p(theta / k) + where(zero, 0., y * log1p(k / theta))',
+    'logistic': 'where(zero, -log1p(-p), -log(p))',
+}
+
+
+def use_numexpr(*arrays):
+    """
+    Whether to evaluate a kernel with numexpr, when USE_NUMEXPR is set and
+    numexpr is installed. Complex arrays, from complex step differentiation,
+    are always evaluated with numpy.
+
+    Args:
+        *arrays: (np.ndarray) parameters of the kernel
+
+    Returns:
+        bool
+    """
+    return USE_NUMEXPR and numexpr is not None and not any(np.iscomplexobj(a) for a in arrays)
+
+
+def evaluate_numexpr(family, **arrays):
+    """
+    Evaluates the kernel of a likelihood with numexpr, in a single pass.
+
+    Args:
+        family: (str) name of the likelihood in `NUMEXPR_KERNELS`
+        **arrays: (np.ndarray) arrays of the kernel
+
+    Returns:
+        np.ndarray
+    """
+    return numexpr.evaluate(NUMEXPR_KERNELS[family], local_dict=arrays)
+
+
+class LikelihoodContext:
+    """
+    Quantities of the likelihoods that only depend on the observed data, so
+    that they are computed once per data set rather than on every evaluation.
+
+    Attributes:
+        Y: (np.ndarray) observed data
+        zero: (np.ndarray) mask of the zero observations
+        positive: (np.ndarray) mask of the non-zero observations
+        zero_index: (tuple of np.ndarray) indices of the zero observations
+        positive_index: (tuple of np.ndarray) indices of the non-zero observations
+        Y_positive: (np.ndarray) the non-zero observations
+        binary: (bool) whether all of the observations are 0 or 1
+    """
+    def __init__(self, Y):
+        """
+        Args:
+            Y: (np.ndarray) observed data
+        """
+        self.Y = Y
+        self.zero = (Y == 0)
+        self.positive = ~self.zero
+        self.zero_index = np.nonzero(self.zero)
+        self.positive_index = np.nonzero(self.positive)
+        self.Y_positive = Y[self.positive_index]
+        self.binary = bool((self.zero | (Y == 1)).all())
+
+
+def takes_context(function):
+    """
+    Decorator for likelihoods and their derivatives that take the observed
+    data as a LikelihoodContext. The context is built when they are called
+    with an array instead, and models pass their own context to the functions
+    that have the attribute `takes_context`.
+    """
+    @functools.wraps(function)
+    def wrapper(Y, P):
+        if not isinstance(Y, LikelihoodContext):
+            Y = LikelihoodContext(np.asarray(Y))
+        return function(Y, P)
+    wrapper.takes_context = True
+    return wrapper
+
+
+def nbinom_zero_nll(theta, alpha):
+    """
+    Minus the log of the probability of a zero under the negative binomial
+    distribution, log(1 + theta * alpha) / alpha. Its limits are used when
+    alpha underflows to 0, where it is theta as for the Poisson distribution,
+    or overflows to inf, where it is 0.
+
+    Args:
+        theta: (np.ndarray) mean of the negative binomial distribution
+        alpha: (np.ndarray) over-dispersion parameter
+
+    Returns:
+        np.ndarray
+    """
+    x = theta * alpha
+    finite = (x != 0) & np.isfinite(x)
+    x = np.where(finite, x, 1.)
+    return theta * np.where(finite, np.log1p(x) / x, np.where(theta * alpha == 0, 1., 0.))
 
 
 class NegLogLikelihoods:
 
     @staticmethod
-    def hurdle_poisson(Y, P):
+    @takes_context
+    def hurdle_poisson(data, P):
         """
         Hurdle Poisson likelihood.
         Structural Zeroes induced by binomial distribution, then Non-Zeroes induced
         by truncated Poisson model.
 
         Args:
-            Y: observed data
+            data: (LikelihoodContext) observed data, or an array of it
             P: list with the following elements:
                 0: the probability of a zero
                 1: mean of the Poisson distribution
@@ -20,21 +135,26 @@ class NegLogLikelihoods:
         assert P.shape[0] == 2
         p = P[0]
         theta = P[1]
-        ll = (
-            (np.log(p)) * (Y == 0) +
-            (np.log(1 - p) - theta + Y * np.log(theta) - np.log(1 - np.exp(-theta))) * (Y > 0)
+        # log(1 - exp(-theta)) = log(-expm1(-theta)) does not round to log(0)
+        # for small theta, and the branch that does not apply is discarded
+        # rather than multiplied by 0, so that its infinities do not give nan
+        if use_numexpr(p, theta):
+            return evaluate_numexpr('hurdle_poisson', zero=data.zero, y=data.Y, p=p, theta=theta)
+        return np.where(
+            data.zero, -np.log(p),
+            theta - np.log1p(-p) - data.Y * np.log(theta) + np.log(-np.expm1(-theta))
         )
-        return -ll
 
     @staticmethod
-    def zi_poisson(Y, P):
+    @takes_context
+    def zi_poisson(data, P):
         """
         Zero-Inflated Poisson likelihood.
         Structural Zeroes induced by either binomial distribution, additional zeroes
         from the Poisson distribution.
 
         Args:
-            Y: observed data
+            data: (LikelihoodContext) observed data, or an array of it
             P: list with the following elements:
                 0: the probability of a structural zero
                 1: mean of the Poisson distribution
@@ -45,42 +165,45 @@ class NegLogLikelihoods:
         assert P.shape[0] == 2
         p = P[0]
         theta = P[1]
-        ll = (
-            (np.log((p + (1 - p) * np.exp(-theta)))) * (Y == 0) +
-            (np.log(1 - p) - theta + Y * np.log(theta)) * (Y > 0)
-        )
-        return -ll
+        # log(1 - p) is shared by the branches, and the zeros are a sum of
+        # positive terms, p + (1 - p) * exp(-theta), that does not cancel
+        log_q = np.log1p(-p)
+        if use_numexpr(p, theta):
+            return evaluate_numexpr('zi_poisson', zero=data.zero, y=data.Y, p=p, log_q=log_q, theta=theta)
+        return np.where(data.zero, -np.log(p + np.exp(log_q - theta)), theta - log_q - data.Y * np.log(theta))
 
     @staticmethod
-    def zi_nbinom(Y, P):
+    @takes_context
+    def zi_nbinom(data, P):
         """
         Zero-Inflated Negative Binomial likelihood.
         Structural Zeroes induced by either binomial distribution, additional zeroes
         from the Negative Binomial distribution.
 
         Args:
-            Y: observed data
+            data: (LikelihoodContext) observed data, or an array of it
             P: list with the following elements:
                 0: the probability of a structural zero
-                1: mean of the Poisson distribution
-                2: over-dispersion parameter for negative binomial
+                1: mean of the negative binomial distribution
+                2: over-dispersion parameter for negative binomial, as in `nbinom`
         """
-        assert P.shape[1] == 3
+        assert P.shape[0] == 3
         p = P[0]
         theta = P[1]
-        k = P[2]
-        ll = (
-            (np.log(p + (1 - p) * (1 + k * theta) ** (-1 / k))) * (Y == 0) +
-            (np.log(1 - p) +
-             loggamma(Y + k ** (-1)) -
-             loggamma(k ** (-1)) -
-             k ** (-1) * np.log(1 + k * theta) -
-             Y * np.log(1 + (theta * k) ** (-1))) * (Y > 0)
-        )
-        return -ll
+        k = P[2] ** -1
+        s = nbinom_zero_nll(theta, P[2])
+        log_q = np.log1p(-p)
+        if use_numexpr(p, theta, k):
+            nll = evaluate_numexpr('zi_nbinom', zero=data.zero, y=data.Y, p=p, log_q=log_q, s=s, k=k, theta=theta)
+        else:
+            nll = np.where(data.zero, -np.log(p + np.exp(log_q - s)), s - log_q + data.Y * np.log1p(k / theta))
+        k = k[data.positive_index]
+        nll[data.positive_index] -= loggamma(data.Y_positive + k) - loggamma(k)
+        return nll
 
     @staticmethod
-    def nbinom(Y, P):
+    @takes_context
+    def nbinom(data, P):
         """
         Negative Binomial likelihood.
 
@@ -89,7 +212,7 @@ class NegLogLikelihoods:
         Mean = 1. And a larger Var means more over-dispersion.
 
         Args:
-            Y: observed data
+            data: (LikelihoodContext) observed data, or an array of it
             P: list with the following elements:
                 0: mean of the Poisson (also negative binomial) distribution
                 1: over-dispersion parameter for negative binomial
@@ -98,16 +221,18 @@ class NegLogLikelihoods:
         theta = P[0]
         k = P[1] ** -1
 
-        ll = (
-            loggamma(Y + k) - loggamma(k) +
-            k * np.log(k) - k * np.log(k + theta) +
-            Y * np.log(theta) - Y * np.log(theta + k)
-        )
-
-        return -ll
+        if use_numexpr(theta, k):
+            nll = evaluate_numexpr('nbinom', zero=data.zero, y=data.Y, k=k, theta=theta)
+        else:
+            nll = k * np.log1p(theta / k) + np.where(data.zero, 0., data.Y * np.log1p(k / theta))
+        # loggamma(Y + k) - loggamma(k) vanishes for the zeros
+        k = k[data.positive_index]
+        nll[data.positive_index] -= loggamma(data.Y_positive + k) - loggamma(k)
+        return nll
 
     @staticmethod
-    def logistic(Y, P):
+    @takes_context
+    def logistic(data, P):
         """
         Logistic regression likelihood where data are 0's and 1's.
         For aggregated data, this function can still be used because
@@ -115,16 +240,327 @@ class NegLogLikelihoods:
         in each row of data.
 
         Args:
-            Y: observed data -- should only be 1's and 0's
+            data: (LikelihoodContext) observed data, or an array of it -- should only be 1's and 0's
             P: list with the following elements:
                 0: probability of the outcome Y == 1
         """
         assert P.shape[0] == 1
         p = P[0]
-        assert ((Y == 1) | (Y == 0)).all()
+        assert data.binary
 
-        ll = (
-                (Y == 1) * np.log(p) + (Y == 0) * np.log(1 - p)
-        )
+        if use_numexpr(p):
+            return evaluate_numexpr('logistic', zero=data.zero, p=p)
+        return np.where(data.zero, -np.log1p(-p), -np.log(p))
+
+    @staticmethod
+    @takes_context
+    def binomial(data, P):
+        """
+        Binomial likelihood for the proportion of successes out of a number of
+        trials, per trial. Multiplied by the number of trials as the weight, it is
+        the binomial likelihood up to a constant.
 
-        return -ll
+        Args:
+            data: (LikelihoodContext) observed proportions, or an array of them
+            P: list with the following elements:
+                0: probability of a success
+        """
+        assert P.shape[0] == 1
+        p = P[0]
+        y = data.Y
+        return -(xlogy(y, p) + xlog1py(1 - y, -p))
+
+
+class NegLogLikelihoodGradients:
+    """
+    Derivatives of the negative log likelihoods in `NegLogLikelihoods`
+    with respect to each of the parameters. Each function takes the same
+    arguments as its likelihood and returns an array in the same shape as P.
+    """
+
+    @staticmethod
+    @takes_context
+    def hurdle_poisson(data, P):
+        """
+        Gradient of the Hurdle Poisson negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: the probability of a zero
+                1: mean of the Poisson distribution
+        """
+        assert P.shape[0] == 2
+        p = P[0]
+        theta = P[1]
+        zero = data.zero
+        Y = data.Y
+        return np.array([
+            np.where(zero, -1 / p, 1 / (1 - p)),
+            np.where(zero, 0., 1 - Y / theta + 1 / np.expm1(theta))
+        ])
+
+    @staticmethod
+    @takes_context
+    def zi_poisson(data, P):
+        """
+        Gradient of the Zero-Inflated Poisson negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: the probability of a structural zero
+                1: mean of the Poisson distribution
+        """
+        assert P.shape[0] == 2
+        p = P[0]
+        theta = P[1]
+        zero = data.zero
+        Y = data.Y
+        e = np.exp(-theta)
+        q = p + (1 - p) * e
+        return np.array([
+            np.where(zero, -(1 - e) / q, 1 / (1 - p)),
+            np.where(zero, (1 - p) * e / q, 1 - Y / theta)
+        ])
+
+    @staticmethod
+    @takes_context
+    def nbinom(data, P):
+        """
+        Gradient of the Negative Binomial negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: mean of the Poisson (also negative binomial) distribution
+                1: over-dispersion parameter for negative binomial
+        """
+        assert P.shape[0] == 2
+        Y = data.Y
+        theta = P[0]
+        k = P[1] ** -1
+        d_theta = Y / theta - (Y + k) / (theta + k)
+        d_k = 1 - np.log1p(theta / k) - (Y + k) / (k + theta)
+        # digamma(Y + k) - digamma(k) vanishes for the zeros
+        k_positive = k[data.positive_index]
+        d_k[data.positive_index] += digamma(data.Y_positive + k_positive) - digamma(k_positive)
+        # chain rule for k = 1 / P[1]
+        return -np.array([d_theta, -k ** 2 * d_k])
+
+    @staticmethod
+    @takes_context
+    def zi_nbinom(data, P):
+        """
+        Gradient of the Zero-Inflated Negative Binomial negative log likelihood.
+        The zeros are -log(p + (1 - p) * exp(-s)), where s is the negative binomial
+        negative log likelihood of a zero, so their gradient is that of `nbinom`
+        scaled by the derivative with respect to s.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: the probability of a structural zero
+                1: mean of the negative binomial distribution
+                2: over-dispersion parameter for negative binomial
+        """
+        assert P.shape[0] == 3
+        p = P[0]
+        zero = data.zero
+        d_nbinom = NegLogLikelihoodGradients.nbinom(data, P[1:])
+        e = np.exp(-nbinom_zero_nll(P[1], P[2]))
+        q = p + (1 - p) * e
+        d_s = np.where(zero, (1 - p) * e / q, 1.)
+        return np.array([
+            np.where(zero, -(1 - e) / q, 1 / (1 - p)),
+            d_s * d_nbinom[0],
+            d_s * d_nbinom[1]
+        ])
+
+    @staticmethod
+    @takes_context
+    def logistic(data, P):
+        """
+        Gradient of the logistic regression negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it -- should only be 1's and 0's
+            P: list with the following elements:
+                0: probability of the outcome Y == 1
+        """
+        assert P.shape[0] == 1
+        p = P[0]
+        return np.array([
+            np.where(data.zero, 1 / (1 - p), -1 / p)
+        ])
+
+    @staticmethod
+    @takes_context
+    def binomial(data, P):
+        """
+        Gradient of the binomial negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed proportions, or an array of them
+            P: list with the following elements:
+                0: probability of a success
+        """
+        assert P.shape[0] == 1
+        p = P[0]
+        y = data.Y
+        return np.array([
+            (1 - y) / (1 - p) - y / p
+        ])
+
+
+class NegLogLikelihoodHessians:
+    """
+    Second derivatives of the negative log likelihoods in `NegLogLikelihoods`
+    with respect to each pair of parameters. Each function takes the same
+    arguments as its likelihood and returns an array of shape (l, l) + Y.shape.
+    """
+
+    @staticmethod
+    @takes_context
+    def hurdle_poisson(data, P):
+        """
+        Hessian of the Hurdle Poisson negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: the probability of a zero
+                1: mean of the Poisson distribution
+        """
+        assert P.shape[0] == 2
+        p = P[0]
+        theta = P[1]
+        zero = data.zero
+        Y = data.Y
+        d_pp = np.where(zero, 1 / p ** 2, 1 / (1 - p) ** 2)
+        d_tt = np.where(zero, 0., Y / theta ** 2 + 1 / (np.expm1(theta) * np.expm1(-theta)))
+        d_pt = np.zeros(Y.shape, dtype=d_pp.dtype)
+        return np.array([[d_pp, d_pt], [d_pt, d_tt]])
+
+    @staticmethod
+    @takes_context
+    def zi_poisson(data, P):
+        """
+        Hessian of the Zero-Inflated Poisson negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: the probability of a structural zero
+                1: mean of the Poisson distribution
+        """
+        assert P.shape[0] == 2
+        p = P[0]
+        theta = P[1]
+        zero = data.zero
+        Y = data.Y
+        e = np.exp(-theta)
+        q = p + (1 - p) * e
+        d_pp = np.where(zero, (1 - e) ** 2 / q ** 2, 1 / (1 - p) ** 2)
+        d_tt = np.where(zero, -p * (1 - p) * e / q ** 2, Y / theta ** 2)
+        d_pt = np.where(zero, -e / q ** 2, 0.)
+        return np.array([[d_pp, d_pt], [d_pt, d_tt]])
+
+    @staticmethod
+    @takes_context
+    def nbinom(data, P):
+        """
+        Hessian of the Negative Binomial negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: mean of the Poisson (also negative binomial) distribution
+                1: over-dispersion parameter for negative binomial
+        """
+        assert P.shape[0] == 2
+        Y = data.Y
+        theta = P[0]
+        k = P[1] ** -1
+        d_k = 1 - np.log1p(theta / k) - (Y + k) / (k + theta)
+        d_kk = 1 / k - 1 / (k + theta) - (theta - Y) / (k + theta) ** 2
+        # the digamma and trigamma differences vanish for the zeros
+        k_positive = k[data.positive_index]
+        Y_positive = data.Y_positive + k_positive
+        d_k[data.positive_index] += digamma(Y_positive) - digamma(k_positive)
+        d_kk[data.positive_index] += polygamma(1, Y_positive) - polygamma(1, k_positive)
+        d_tt = Y / theta ** 2 - (Y + k) / (theta + k) ** 2
+        # chain rule for k = 1 / P[1]
+        d_aa = -(d_kk * k ** 4 + 2 * d_k * k ** 3)
+        d_ta = -(theta - Y) / (theta + k) ** 2 * k ** 2
+        return np.array([[d_tt, d_ta], [d_ta, d_aa]])
+
+    @staticmethod
+    @takes_context
+    def zi_nbinom(data, P):
+        """
+        Hessian of the Zero-Inflated Negative Binomial negative log likelihood,
+        from the derivatives of `nbinom` by the chain rule like the gradient.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it
+            P: list with the following elements:
+                0: the probability of a structural zero
+                1: mean of the negative binomial distribution
+                2: over-dispersion parameter for negative binomial
+        """
+        assert P.shape[0] == 3
+        p = P[0]
+        zero = data.zero
+        d_nbinom = NegLogLikelihoodGradients.nbinom(data, P[1:])
+        d2_nbinom = NegLogLikelihoodHessians.nbinom(data, P[1:])
+        e = np.exp(-nbinom_zero_nll(P[1], P[2]))
+        q = p + (1 - p) * e
+        # derivatives of -log(p + (1 - p) * exp(-s)) with respect to p and s
+        d_s = (1 - p) * e / q
+        d_ss = -p * (1 - p) * e / q ** 2
+        d_ps = -e / q ** 2
+        d_pp = np.where(zero, (1 - e) ** 2 / q ** 2, 1 / (1 - p) ** 2)
+        d_p = [np.where(zero, d_ps * d_nbinom[i], 0.) for i in range(2)]
+        d = [[np.where(zero, d_ss * d_nbinom[i] * d_nbinom[j] + d_s * d2_nbinom[i, j], d2_nbinom[i, j])
+              for j in range(2)] for i in range(2)]
+        return np.array([
+            [d_pp, d_p[0], d_p[1]],
+            [d_p[0], d[0][0], d[0][1]],
+            [d_p[1], d[1][0], d[1][1]]
+        ])
+
+    @staticmethod
+    @takes_context
+    def logistic(data, P):
+        """
+        Hessian of the logistic regression negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed data, or an array of it -- should only be 1's and 0's
+            P: list with the following elements:
+                0: probability of the outcome Y == 1
+        """
+        assert P.shape[0] == 1
+        p = P[0]
+        return np.array([[
+            np.where(data.zero, 1 / (1 - p) ** 2, 1 / p ** 2)
+        ]])
+
+    @staticmethod
+    @takes_context
+    def binomial(data, P):
+        """
+        Hessian of the binomial negative log likelihood.
+
+        Args:
+            data: (LikelihoodContext) observed proportions, or an array of them
+            P: list with the following elements:
+                0: probability of a success
+        """
+        assert P.shape[0] == 1
+        p = P[0]
+        y = data.Y
+        return np.array([[
+            y / p ** 2 + (1 - y) / (1 - p) ** 2
+        ]])
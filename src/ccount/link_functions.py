@@ -1,8 +1,16 @@
 import numpy as np
+from scipy import special
 
 
 def expit(x):
-    return np.exp(x) / (1 + np.exp(x))
+    if not np.iscomplexobj(x):
+        return special.expit(x)
+    # complex step differentiation: exp of a non-positive real part does not
+    # overflow, and both branches are analytic
+    x = np.asarray(x)
+    positive = x.real >= 0
+    e = np.exp(np.where(positive, -x, x))
+    return np.where(positive, 1 / (1 + e), e / (1 + e))
 
 
 def smooth_ReLU(x, x_limit=50):
@@ -12,3 +20,79 @@ def smooth_ReLU(x, x_limit=50):
     result = np.log(1 + np.exp(x))
     result[above_limit] = x[above_limit]
     return result
+
+
+def expit_derivative(x):
+    # expit(-x) = 1 - expit(x) without the cancellation for large x
+    return expit(x) * expit(-x)
+
+
+def smooth_ReLU_derivative(x, x_limit=50):
+    if type(x) != np.array:
+        x = np.asarray(x)
+    above_limit = x > x_limit
+    result = expit(x)
+    result[above_limit] = 1.
+    return result
+
+
+def expit_second_derivative(x):
+    s = expit(x)
+    t = expit(-x)
+    return s * t * (t - s)
+
+
+def smooth_ReLU_second_derivative(x, x_limit=50):
+    if type(x) != np.array:
+        x = np.asarray(x)
+    above_limit = x > x_limit
+    result = expit_derivative(x)
+    result[above_limit] = 0.
+    return result
+
+
+# links by name, for storing the links of a fitted model
+LINKS = {
+    'expit': expit,
+    'smooth_ReLU': smooth_ReLU,
+    'exp': np.exp
+}
+
+
+def link_name(g):
+    """
+    Name of the link function g in LINKS.
+
+    Args:
+        g: link function
+
+    Returns:
+        str
+    """
+    for name, link in LINKS.items():
+        if link is g:
+            return name
+    raise ValueError(f"Link function {g} is not one of {list(LINKS.keys())}.")
+
+
+# kernels that apply the links above in place on real arrays
+IN_PLACE_LINKS = {
+    expit: special.expit,
+    smooth_ReLU: lambda x, out: np.logaddexp(0, x, out=out)
+}
+
+
+def apply_in_place(g, x):
+    """
+    Apply the link function g to the array x in place.
+
+    Args:
+        g: link function
+        x: (np.ndarray) array to transform
+    """
+    if g in IN_PLACE_LINKS and x.dtype.kind == 'f':
+        IN_PLACE_LINKS[g](x, out=x)
+    elif isinstance(g, np.ufunc):
+        g(x, out=x)
+    else:
+        x[...] = g(x)
@@ -2,8 +2,11 @@ import numpy as np
 import logging
 
 from ccount.core import CorrelatedModel
-from ccount.likelihoods import NegLogLikelihoods
-from ccount.link_functions import smooth_ReLU, expit
+from ccount.likelihoods import NegLogLikelihoods, NegLogLikelihoodGradients, NegLogLikelihoodHessians
+from ccount.link_functions import (
+    smooth_ReLU, expit, smooth_ReLU_derivative, expit_derivative,
+    smooth_ReLU_second_derivative, expit_second_derivative
+)
 
 LOG = logging.getLogger(__name__)
 
@@ -15,15 +18,17 @@ class HurdlePoisson(CorrelatedModel):
     Poisson for the
     """
     def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, weights=None, offset=None,
-                 add_intercepts=True, normalize_X=True):
+                 add_intercepts=True, normalize_X=True, stack_X=None, sparse_X=False, dtype=None, compress=False):
         LOG.info("Initializing a Hurdle Poisson Model.")
         assert len(d) == 2
         assert len(X) == 2
         super().__init__(
-            m=m, n=n, d=d, Y=Y.astype(np.number), X=X, spline_specs=spline_specs, group_id=group_id, weights=weights, offset=offset,
-            add_intercepts=add_intercepts, normalize_X=normalize_X,
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs, group_id=group_id, weights=weights, offset=offset,
+            add_intercepts=add_intercepts, normalize_X=normalize_X, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress,
             l=2, g=[expit, np.exp],
-            f=NegLogLikelihoods.hurdle_poisson
+            f=NegLogLikelihoods.hurdle_poisson,
+            df=NegLogLikelihoodGradients.hurdle_poisson, dg=[expit_derivative, np.exp],
+            d2f=NegLogLikelihoodHessians.hurdle_poisson, d2g=[expit_second_derivative, np.exp]
         )
         self.model_type = "Hurdle Poisson"
         self.parameters = [
@@ -44,15 +49,17 @@ class HurdlePoissonSmoothReLU(CorrelatedModel):
     Poisson for the likelihood, link function smooth ReLU
     """
     def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, weights=None, offset=None,
-                 add_intercepts=True, normalize_X=True):
+                 add_intercepts=True, normalize_X=True, stack_X=None, sparse_X=False, dtype=None, compress=False):
         LOG.info("Initializing a Hurdle Poisson Model.")
         assert len(d) == 2
         assert len(X) == 2
         super().__init__(
-            m=m, n=n, d=d, Y=Y.astype(np.number), X=X, spline_specs=spline_specs, group_id=group_id, weights=weights, offset=offset,
-            add_intercepts=add_intercepts, normalize_X=normalize_X,
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs, group_id=group_id, weights=weights, offset=offset,
+            add_intercepts=add_intercepts, normalize_X=normalize_X, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress,
             l=2, g=[expit, smooth_ReLU],
-            f=NegLogLikelihoods.hurdle_poisson
+            f=NegLogLikelihoods.hurdle_poisson,
+            df=NegLogLikelihoodGradients.hurdle_poisson, dg=[expit_derivative, smooth_ReLU_derivative],
+            d2f=NegLogLikelihoodHessians.hurdle_poisson, d2g=[expit_second_derivative, smooth_ReLU_second_derivative]
         )
         self.model_type = "Hurdle Poisson"
         self.parameters = [
@@ -80,16 +87,18 @@ class ZeroInflatedPoisson(CorrelatedModel):
     >>> zp.optimize_params()
     """
     def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, offset=None, weights=None,
-                 add_intercepts=True, normalize_X=True):
+                 add_intercepts=True, normalize_X=True, stack_X=None, sparse_X=False, dtype=None, compress=False):
         LOG.info("Initializing a Zero-Inflated Poisson Model")
         assert len(d) == 2
         assert len(X) == 2
         super().__init__(
-            m=m, n=n, d=d, Y=Y.astype(np.number), X=X, spline_specs=spline_specs,
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs,
             group_id=group_id, offset=offset, weights=weights,
-            normalize_X=normalize_X, add_intercepts=add_intercepts,
-            l=2, g=[lambda x: np.exp(x) / (1 + np.exp(x)), np.exp],
-            f=NegLogLikelihoods.zi_poisson
+            normalize_X=normalize_X, add_intercepts=add_intercepts, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress,
+            l=2, g=[expit, np.exp],
+            f=NegLogLikelihoods.zi_poisson,
+            df=NegLogLikelihoodGradients.zi_poisson, dg=[expit_derivative, np.exp],
+            d2f=NegLogLikelihoodHessians.zi_poisson, d2g=[expit_second_derivative, np.exp]
         )
         self.model_type = "Zero-Inflated Poisson"
         self.parameters = [
@@ -109,16 +118,18 @@ class ZeroInflatedPoissonSmoothReLU(CorrelatedModel):
     rather than a log link for the Poisson mean.
     """
     def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, offset=None, weights=None,
-                 add_intercepts=True, normalize_X=True):
+                 add_intercepts=True, normalize_X=True, stack_X=None, sparse_X=False, dtype=None, compress=False):
         LOG.info("Initializing a Zero-Inflated Poisson SmoothReLU Model")
         assert len(d) == 2
         assert len(X) == 2
         super().__init__(
-            m=m, n=n, d=d, Y=Y.astype(np.number), X=X, spline_specs=spline_specs,
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs,
             group_id=group_id, offset=offset, weights=weights,
-            add_intercepts=add_intercepts, normalize_X=normalize_X,
+            add_intercepts=add_intercepts, normalize_X=normalize_X, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress,
             l=2, g=[expit, smooth_ReLU],
-            f=NegLogLikelihoods.zi_poisson
+            f=NegLogLikelihoods.zi_poisson,
+            df=NegLogLikelihoodGradients.zi_poisson, dg=[expit_derivative, smooth_ReLU_derivative],
+            d2f=NegLogLikelihoodHessians.zi_poisson, d2g=[expit_second_derivative, smooth_ReLU_second_derivative]
         )
         self.model_type = "Zero-Inflated Poisson Smooth ReLU"
         self.parameters = [
@@ -137,15 +148,17 @@ class NegativeBinomial(CorrelatedModel):
     A Negative Binomial Model.
     """
     def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, offset=None, weights=None,
-                 add_intercepts=True, normalize_X=True):
+                 add_intercepts=True, normalize_X=True, stack_X=None, sparse_X=False, dtype=None, compress=False):
         LOG.info("Initializing a negative binomial model.")
         assert len(d) == 2
         assert len(X) == 2
         super().__init__(
-            m=m, n=n, d=d, Y=Y.astype(np.number), X=X, spline_specs=spline_specs, group_id=group_id, offset=offset,
-            add_intercepts=add_intercepts, normalize_X=normalize_X, weights=weights,
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs, group_id=group_id, offset=offset,
+            add_intercepts=add_intercepts, normalize_X=normalize_X, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress, weights=weights,
             l=2, g=[np.exp, np.exp],
-            f=NegLogLikelihoods.nbinom
+            f=NegLogLikelihoods.nbinom,
+            df=NegLogLikelihoodGradients.nbinom, dg=[np.exp, np.exp],
+            d2f=NegLogLikelihoodHessians.nbinom, d2g=[np.exp, np.exp]
         )
         self.model_type = "Negative Binomial"
         self.parameters = [
@@ -159,20 +172,53 @@ class NegativeBinomial(CorrelatedModel):
         return theta
 
 
+class ZeroInflatedNegativeBinomial(CorrelatedModel):
+    """
+    A Zero-Inflated Negative Binomial Model, for over-dispersed
+    outcomes with structural zeros.
+    """
+    def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, offset=None, weights=None,
+                 add_intercepts=True, normalize_X=True, stack_X=None, sparse_X=False, dtype=None, compress=False):
+        LOG.info("Initializing a Zero-Inflated Negative Binomial Model")
+        assert len(d) == 3
+        assert len(X) == 3
+        super().__init__(
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs,
+            group_id=group_id, offset=offset, weights=weights,
+            normalize_X=normalize_X, add_intercepts=add_intercepts, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress,
+            l=3, g=[expit, np.exp, np.exp],
+            f=NegLogLikelihoods.zi_nbinom,
+            df=NegLogLikelihoodGradients.zi_nbinom, dg=[expit_derivative, np.exp, np.exp],
+            d2f=NegLogLikelihoodHessians.zi_nbinom, d2g=[expit_second_derivative, np.exp, np.exp]
+        )
+        self.model_type = "Zero-Inflated Negative Binomial"
+        self.parameters = [
+            "Probability of Structural Zero", "Mean of Negative Binomial", "Over-Dispersion Parameter Variance"
+        ]
+
+    @staticmethod
+    def mean_outcome(P):
+        p = P[0]
+        theta = P[1]
+        return (1 - p) * theta
+
+
 class Logistic(CorrelatedModel):
     """
     A logistic regression model.
     """
     def __init__(self, m, n, d, Y, X, spline_specs=None, group_id=None, weights=None,
-                 add_intercepts=True, normalize_X=True, offset=None):
+                 add_intercepts=True, normalize_X=True, offset=None, stack_X=None, sparse_X=False, dtype=None, compress=False):
         LOG.info("Initializing a logistic regression model.")
         assert len(d) == 1
         assert len(X) == 1
         super().__init__(
-            m=m, n=n, d=d, Y=Y.astype(np.number), X=X, spline_specs=spline_specs, group_id=group_id,
-            add_intercepts=add_intercepts, normalize_X=normalize_X, weights=weights, offset=offset,
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs, group_id=group_id,
+            add_intercepts=add_intercepts, normalize_X=normalize_X, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress, weights=weights, offset=offset,
             l=1, g=[expit],
-            f=NegLogLikelihoods.logistic
+            f=NegLogLikelihoods.logistic,
+            df=NegLogLikelihoodGradients.logistic, dg=[expit_derivative],
+            d2f=NegLogLikelihoodHessians.logistic, d2g=[expit_second_derivative]
         )
         self.model_type = "Logistic"
         self.parameters = [
@@ -184,11 +230,78 @@ class Logistic(CorrelatedModel):
         return P[0]  # The probability of being a 1
 
 
+class Binomial(CorrelatedModel):
+    """
+    A binomial model for the number of successes out of a number of trials,
+    e.g. for binary data aggregated into cells. The outcomes are stored as
+    the proportions of successes, and the weights are multiplied by the
+    trials relative to their mean, so that the likelihood is averaged over
+    the trials like over the rows of the binary data, and the fit is that of
+    a logistic model on the binary data, with one row per trial.
+    """
+    def __init__(self, m, n, d, Y, X, trials=None, spline_specs=None, group_id=None, weights=None,
+                 add_intercepts=True, normalize_X=True, offset=None, stack_X=None, sparse_X=False, dtype=None,
+                 compress=False):
+        """
+        Args:
+            Y: (np.ndarray) number of successes, of shape (m, n)
+            trials: (np.ndarray) number of trials of shape (m, n), by default 1
+            for every row, see ccount.core.CorrelatedModel for the other arguments
+        """
+        LOG.info("Initializing a binomial model.")
+        assert len(d) == 1
+        assert len(X) == 1
+        Y, weights = self.binomial_data(Y=Y, trials=trials, weights=weights)
+        super().__init__(
+            m=m, n=n, d=d, Y=Y, X=X, spline_specs=spline_specs, group_id=group_id,
+            add_intercepts=add_intercepts, normalize_X=normalize_X, stack_X=stack_X, sparse_X=sparse_X, dtype=dtype, compress=compress, weights=weights, offset=offset,
+            l=1, g=[expit],
+            f=NegLogLikelihoods.binomial,
+            df=NegLogLikelihoodGradients.binomial, dg=[expit_derivative],
+            d2f=NegLogLikelihoodHessians.binomial, d2g=[expit_second_derivative]
+        )
+        self.model_type = "Binomial"
+        self.parameters = [
+            "Probability"
+        ]
+
+    @staticmethod
+    def binomial_data(Y, trials=None, weights=None):
+        """
+        Args:
+            Y: (np.ndarray) number of successes
+            trials: (np.ndarray) number of trials, or None for one trial each
+            weights: (np.ndarray) weights of the rows, or None
+
+        Returns:
+            tuple of the proportions of successes, 0 without trials, and the
+            weights times the trials relative to their mean
+        """
+        Y = np.asarray(Y, dtype=float)
+        trials = np.ones(Y.shape) if trials is None else np.asarray(trials, dtype=float)
+        if trials.shape != Y.shape:
+            raise ValueError(f"trials must have the shape of the outcomes {Y.shape}, got {trials.shape}.")
+        if (Y < 0).any() or (Y > trials).any():
+            raise ValueError("The successes must be between 0 and the number of trials.")
+        if trials.sum() <= 0:
+            raise ValueError("There are no trials.")
+        proportions = np.divide(Y, trials, out=np.zeros(Y.shape), where=trials > 0)
+        trials = trials / trials.mean()
+        weights = trials if weights is None else weights * trials
+        return proportions, weights
+
+    @staticmethod
+    def mean_outcome(P):
+        return P[0]  # The probability of a success in one trial
+
+
 MODEL_DICT = {
     'hurdle_poisson': HurdlePoisson,
     'hurdle_poisson_relu': HurdlePoissonSmoothReLU,
     'negative_binomial': NegativeBinomial,
+    'zero_inflated_negative_binomial': ZeroInflatedNegativeBinomial,
     'zero_inflated_poisson': ZeroInflatedPoisson,
     'zero_inflated_poisson_relu': ZeroInflatedPoissonSmoothReLU,
-    'logistic': Logistic
+    'logistic': Logistic,
+    'binomial': Binomial
 }
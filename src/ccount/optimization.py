@@ -5,9 +5,11 @@
 
     Optimization module for the Correlated Count.
 """
+import itertools
 import numpy as np
 import scipy.optimize as sopt
 from . import utils
+from .telemetry import Trace, PrintSink
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -20,22 +22,73 @@ class OptimizationInterface:
         * optimize over random effect U,
         * compute the empirical covariance matrix for U.
     """
-    def __init__(self, cm, n_iteration_print=10):
+    def __init__(self, cm, n_iteration_print=None, trace=None):
         """Optimization interface initialization method.
 
         Parameters
         ----------
         cm : ccount.core.CorrelatedModel
             Correlated model interface.
-        n_iteration_print : int
-            Will print the objective function value every n_iteration_print iters
+        n_iteration_print : int, optional
+            If given, print the objective function value every n_iteration_print
+            iterations, see `ccount.telemetry.PrintSink`.
+        trace : ccount.telemetry.Trace, optional
+            Trace to record the iterations of the optimization in.
 
         """
         self.cm = cm
-        self.EVALUATIONS = 0
-        self.TOTAL_BETA_EVALUATIONS = 0
-        self.TOTAL_U_EVALUATIONS = 0
+        self.trace = trace if trace is not None else Trace()
         self.n_iteration_print = n_iteration_print
+        if n_iteration_print is not None:
+            self.trace.add_sink(PrintSink(every=n_iteration_print))
+        # last point that the objective and gradient were evaluated at,
+        # so that the iterations can be recorded without evaluating them again
+        self._last_objective = (None, None)
+        self._last_gradient = (None, None)
+        # Hessian with respect to the linear predictor at the last
+        # point that a Hessian-vector product was requested for
+        self._hessian_vec = None
+        self._hessian_eta = None
+        # Hessians of the random effects from the last random effects step,
+        # with the fixed effects, random effects and D they were computed at
+        self._group_hessian_U = None
+
+    @property
+    def TOTAL_BETA_EVALUATIONS(self):
+        return self.trace.evaluations.get("beta", 0)
+
+    @property
+    def TOTAL_U_EVALUATIONS(self):
+        return self.trace.evaluations.get("U", 0)
+
+    @property
+    def TOTAL_D_EVALUATIONS(self):
+        return self.trace.evaluations.get("D", 0)
+
+    @property
+    def TOTAL_JOINT_EVALUATIONS(self):
+        return self.trace.evaluations.get("joint", 0)
+
+    def remember_objective(self, vec, val):
+        self.trace.count()
+        if np.isrealobj(vec):
+            self._last_objective = (vec.copy(), val)
+        return val
+
+    def remember_gradient(self, vec, grad):
+        self.trace.count(evaluations=0, gradient_evaluations=1)
+        self._last_gradient = (vec.copy(), grad)
+        return grad
+
+    def record_iteration(self, iteration, vec):
+        """Records an iteration of scipy.optimize at vec, with the objective
+        and gradient if they were last evaluated there."""
+        objective, gradient_norm = None, None
+        if self._last_objective[0] is not None and np.array_equal(self._last_objective[0], vec):
+            objective = float(self._last_objective[1])
+        if self._last_gradient[0] is not None and np.array_equal(self._last_gradient[0], vec):
+            gradient_norm = float(np.linalg.norm(self._last_gradient[1]))
+        self.trace.record(iteration=iteration, objective=objective, gradient_norm=gradient_norm)
 
     def objective_beta(self, vec):
         """Objective function for fitting the fixed effects.
@@ -50,23 +103,28 @@ class OptimizationInterface:
         float
             Objective function value.
         """
-        beta = utils.vec_to_beta(vec, self.cm.d)
-        return self.cm.neg_log_likelihood(beta=beta)
+        return self.remember_objective(vec, self.cm.neg_log_likelihood(beta=vec))
 
     def gradient_beta(self, vec, eps=1e-10):
         """Gradient function for fitting the fixed effects.
+        Uses the analytic gradient of the model when the likelihood and link
+        derivatives are available, otherwise falls back to the complex step.
 
         Parameters
         ----------
         vec : array_like
             Provided vectorized fixed effects.
         eps : float
+            Step size for the complex step fallback.
 
         Returns
         -------
         numpy.ndarray
             Gradient at current fixed effects.
         """
+        if self.cm.has_gradient:
+            return self.remember_gradient(vec, self.cm.gradient_beta(beta=vec, flat=True))
+
         g_vec = np.zeros(vec.size)
         c_vec = vec + 0j
         for i in range(vec.size):
@@ -74,7 +132,48 @@ class OptimizationInterface:
             g_vec[i] = self.objective_beta(c_vec).imag/eps
             c_vec[i] -= eps*1j
 
-        return g_vec
+        return self.remember_gradient(vec, g_vec)
+
+    def hessian_beta_vector(self, vec, p):
+        """Hessian-vector product for fitting the fixed effects. The Hessian
+        with respect to the linear predictor is cached for the current fixed
+        effects, so repeated products within one Newton step only cost two
+        products with the covariates.
+
+        Parameters
+        ----------
+        vec : array_like
+            Provided vectorized fixed effects.
+        p : array_like
+            Vector to multiply the Hessian with.
+
+        Returns
+        -------
+        numpy.ndarray
+            Hessian at the current fixed effects times p.
+        """
+        self.cache_hessian_eta(vec, beta=vec)
+        return self.cm.hessian_beta_vector(vec=p, H_eta=self._hessian_eta)
+
+    def cache_hessian_eta(self, vec, **kwargs):
+        """Computes the Hessian with respect to the linear predictor, unless
+        it was already computed for the same optimization variables.
+
+        Parameters
+        ----------
+        vec : array_like
+            Current optimization variables, used as the key of the cache.
+        kwargs
+            Fixed and random effects to pass on to `hessian_eta`.
+        """
+        if self._hessian_vec is None or not np.array_equal(vec, self._hessian_vec):
+            self._hessian_vec = vec.copy()
+            self._hessian_eta = self.cm.hessian_eta(**kwargs)
+
+    def clear_hessian_eta(self):
+        """Drops the cached Hessian with respect to the linear predictor."""
+        self._hessian_vec = None
+        self._hessian_eta = None
 
     def objective_U(self, vec):
         """Objective function for fitting the random effects.
@@ -90,22 +189,29 @@ class OptimizationInterface:
             Objective function value.
         """
         U = vec.reshape(self.cm.U.shape)
-        return self.cm.neg_log_likelihood(U=U)
+        return self.remember_objective(vec, self.cm.neg_log_likelihood(U=U))
 
     def gradient_U(self, vec, eps=1e-10):
         """Gradient function for fitting the random effects.
+        Uses the analytic gradient of the model when the likelihood and link
+        derivatives are available, otherwise falls back to the complex step.
 
         Parameters
         ----------
         vec : array_like
             Provided vectorized random effects.
         eps : float
+            Step size for the complex step fallback.
 
         Returns
         -------
         numpy.ndarray
             Gradient at current random effects.
         """
+        if self.cm.has_gradient:
+            U = vec.reshape(self.cm.U.shape)
+            return self.remember_gradient(vec, self.cm.gradient_U(U=U).flatten())
+
         g_vec = np.zeros(vec.size)
         c_vec = vec + 0j
         for i in range(vec.size):
@@ -113,68 +219,378 @@ class OptimizationInterface:
             g_vec[i] = self.objective_U(c_vec).imag/eps
             c_vec[i] -= eps*1j
 
-        return g_vec
+        return self.remember_gradient(vec, g_vec)
+
+    def optimize_joint(self, maxiter=1e3, tol=1e-8, max_step_halvings=30):
+        """
+        Optimize the fixed and random effects together with damped Newton steps.
+        The joint Hessian has a dense block for the fixed effects and a block
+        diagonal block for the random effects, one small block per group, so
+        each Newton step eliminates the random effects group by group and only
+        solves a dense system the size of the fixed effects (Schur complement).
 
-    def optimize_beta(self, maxiter=1e3):
+        Args:
+            maxiter: (int)
+                Maximum number of Newton iterations. Can be None.
+            tol: (float)
+                Stop when no fixed or random effect moves by more than tol.
+            max_step_halvings: (int)
+                Maximum number of step halvings in the line search.
+        """
+        if not self.cm.has_hessian:
+            raise ValueError("Optimizing beta and U jointly needs the derivatives of the likelihood and links.")
+        LOG.info("Optimizing beta and U jointly with Newton steps.")
+        if maxiter is None:
+            maxiter = np.inf
+        cm = self.cm
+        size = cm.l * cm.n
+
+        def to_groups(arr):
+            return arr.transpose(1, 0, 2).reshape((cm.num_groups, size))
+
+        def from_groups(arr):
+            return arr.reshape((cm.num_groups, cm.l, cm.n)).transpose(1, 0, 2)
+
+        def floor_eigenvalues(w):
+            # flip and floor the eigenvalues so that the step is a descent direction
+            w = np.abs(w)
+            return np.maximum(w, 1e-10*np.maximum(w.max(axis=-1, keepdims=True), 1e-10))
+
+        self.trace.start("joint")
+        beta = cm.beta_vec.copy()
+        U = cm.U.copy()
+        obj = cm.neg_log_likelihood(beta=beta, U=U)
+        self.trace.count()
+        i = 0
+        while i < maxiter:
+            grad_beta, grad_U = cm.gradient_beta_U(beta=beta, U=U)
+            self.trace.count(evaluations=0, gradient_evaluations=1)
+            grad_U = to_groups(grad_U)
+            self.trace.record(iteration=i, objective=float(obj),
+                              gradient_norm=float(np.sqrt(grad_beta.dot(grad_beta) + np.sum(grad_U ** 2))))
+            A, B, C = cm.hessian_beta_U_blocks(beta=beta, U=U)
+            if not all(np.isfinite(arr).all() for arr in [grad_beta, grad_U, A, B, C]):
+                LOG.warning("The derivatives for the joint Newton step are not finite, stopping at the current point.")
+                break
+
+            # eliminate the random effects, then solve for the fixed effects
+            w, V = np.linalg.eigh(C)
+            w = floor_eigenvalues(w)
+            C_inv_B = np.einsum('gij,gjp->gip', V, np.einsum('gji,gjp->gip', V, B) / w[:, :, None])
+            C_inv_grad = np.einsum('gij,gj->gi', V, np.einsum('gji,gj->gi', V, grad_U) / w)
+            w, V = np.linalg.eigh(A - np.einsum('giq,gip->qp', B, C_inv_B))
+            w = floor_eigenvalues(w)
+            step_beta = -V.dot(V.T.dot(grad_beta - np.einsum('gip,gi->p', B, C_inv_grad)) / w)
+            step_U = -(C_inv_grad + C_inv_B.dot(step_beta))
+
+            slope = grad_beta.dot(step_beta) + np.sum(grad_U * step_U)
+            max_step = max(np.max(np.abs(step_beta), initial=0.), np.max(np.abs(step_U), initial=0.))
+            if max_step <= tol or -slope <= 1e-14 * np.abs(obj):
+                break
+
+            t = 1.
+            for h in range(max_step_halvings):
+                trial_beta = beta + t * step_beta
+                trial_U = U + from_groups(t * step_U)
+                trial_obj = cm.neg_log_likelihood(beta=trial_beta, U=trial_U)
+                self.trace.count()
+                if trial_obj <= obj + 1e-4 * t * slope:
+                    break
+                t *= 0.5
+            else:
+                LOG.info("Line search for the joint Newton step failed.")
+                break
+            beta, U, obj = trial_beta, trial_U, trial_obj
+            i += 1
+            LOG.debug(f"iteration {i} objective {obj}")
+            if t * max_step <= tol:
+                break
+        cm.update_params(beta=beta, U=U)
+
+    def optimize_beta(self, maxiter=1e3, method=None, tol=1e-8):
         """
         Optimize fixed effects.
 
         Args:
             maxiter: (int)
                 Maximum number of iterations. Can be None.
+            method: (str)
+                One of "L-BFGS-B", or "newton", which takes trust region Newton
+                steps with exact Hessian-vector products and usually converges in
+                far fewer iterations. Defaults to "L-BFGS-B".
+            tol: (float)
+                Gradient norm tolerance for the "newton" method.
         """
+        if method is None:
+            method = "L-BFGS-B"
+        if method not in ["L-BFGS-B", "newton"]:
+            raise ValueError(f"Unknown method {method} for optimizing beta.")
+        if method == "newton" and not self.cm.has_hessian:
+            raise ValueError("The newton method for beta needs the derivatives of the likelihood and links.")
+
         LOG.info("Optimizing beta.")
-        self.EVALUATIONS = 1
-        print('{0:4s}    {1:9s}'.format('Iteration', 'Objective Function Value'))
-        result = sopt.minimize(self.objective_beta,
-                               utils.beta_to_vec(self.cm.beta),
-                               jac=self.gradient_beta,
-                               method="L-BFGS-B",
-                               callback=self.callback_beta,
-                               options={'maxiter': maxiter})
-        self.cm.update_params(beta=utils.vec_to_beta(result.x, self.cm.d))
-        self.TOTAL_BETA_EVALUATIONS += self.EVALUATIONS
+        self.trace.start("beta")
+        callback = self.iteration_callback()
+        if method == "newton":
+            result = sopt.minimize(self.objective_beta,
+                                   self.cm.beta_vec,
+                                   jac=self.gradient_beta,
+                                   hessp=self.hessian_beta_vector,
+                                   method="trust-ncg",
+                                   callback=callback,
+                                   options={'maxiter': maxiter, 'gtol': tol})
+            self.clear_hessian_eta()
+        else:
+            result = sopt.minimize(self.objective_beta,
+                                   self.cm.beta_vec,
+                                   jac=self.gradient_beta,
+                                   method="L-BFGS-B",
+                                   callback=callback,
+                                   options={'maxiter': maxiter})
+        self.cm.update_params(beta=result.x)
 
-    def optimize_U(self, maxiter=1e3):
+    def optimize_U(self, maxiter=1e3, method=None):
         """
         Optimize random effects.
 
         Args:
             maxiter: (int)
                 Maximum number of iterations. Can be None.
+            method: (str)
+                One of "newton", which solves the problem for every group
+                separately with batched Newton steps, or "L-BFGS-B", which solves
+                for all of the random effects at once. By default uses "newton"
+                when the model has an analytic Hessian.
         """
+        if method is None:
+            method = "newton" if self.cm.has_hessian else "L-BFGS-B"
+        if method == "newton":
+            self.optimize_U_newton(maxiter=maxiter)
+            return
+        if method != "L-BFGS-B":
+            raise ValueError(f"Unknown method {method} for optimizing U.")
+
         LOG.info("Optimizing U.")
-        self.EVALUATIONS = 1
-        print('{0:4s}    {1:9s}'.format('Iteration', 'Objective Function Value'))
+        self.trace.start("U")
         result = sopt.minimize(self.objective_U,
                                self.cm.U.flatten(),
                                jac=self.gradient_U,
                                method="L-BFGS-B",
-                               callback=self.callback_U,
+                               callback=self.iteration_callback(),
                                options={'maxiter': maxiter})
         self.cm.update_params(U=result.x.reshape(self.cm.U.shape))
-        self.TOTAL_U_EVALUATIONS += self.EVALUATIONS
 
-    def compute_D(self):
-        """Compute the sample covariance of the random effects.
+    def optimize_U_newton(self, maxiter=1e3, tol=1e-8, max_step_halvings=30):
+        """
+        Optimize random effects with damped Newton steps. Given the fixed effects
+        and D, the objective separates by group, so every group takes its own
+        Newton step and line search on its small (l*n)-dimensional problem.
+        All of the groups are updated at once with batched linear algebra.
+
+        Args:
+            maxiter: (int)
+                Maximum number of Newton iterations. Can be None.
+            tol: (float)
+                Stop when no random effect moves by more than tol.
+            max_step_halvings: (int)
+                Maximum number of step halvings in the line search. Groups
+                that cannot decrease their objective keep their current value.
+        """
+        LOG.info("Optimizing U with group-wise Newton steps.")
+        cm = self.cm
+        self.trace.start("U")
+        U, H = self.newton_U(
+            objective=cm.group_neg_log_likelihood,
+            gradient=cm.gradient_U,
+            hessian=cm.group_hessian_U,
+            U=cm.U, maxiter=maxiter, tol=tol, max_step_halvings=max_step_halvings
+        )
+        cm.update_params(U=U)
+        # keep the Hessians at the solution for the Laplace approximation
+        self._group_hessian_U = (cm.beta_vec.copy(), U, cm.D, H) if H is not None else None
+
+    def newton_U(self, objective, gradient, hessian, U, maxiter=1e3, tol=1e-8, max_step_halvings=30, H=None):
+        """
+        Minimizes an objective that separates by group in the random effects
+        with damped Newton steps, taking every group's step and line search
+        at once with batched linear algebra.
+
+        Args:
+            objective: (callable)
+                Function of U returning the objective of each group.
+            gradient: (callable)
+                Function of U returning the gradient, shaped like U.
+            hessian: (callable)
+                Function of U returning the Hessian blocks of the groups,
+                shaped like `ccount.core.CorrelatedModel.group_hessian_U`.
+            U: (np.ndarray)
+                Starting random effects.
+            maxiter: (int)
+                Maximum number of Newton iterations. Can be None.
+            tol: (float)
+                Stop when no random effect moves by more than tol.
+            max_step_halvings: (int)
+                Maximum number of step halvings in the line search. Groups
+                that cannot decrease their objective keep their current value.
+            H: (np.ndarray)
+                Hessian blocks at the starting random effects, if already known.
+
+        Returns:
+            U: (np.ndarray) the solution
+            H: (np.ndarray) the Hessian blocks at the solution, or None if
+                the iterations stopped before checking convergence there
+        """
+        if maxiter is None:
+            maxiter = np.inf
+        cm = self.cm
+        size = cm.l * cm.n
+
+        def to_groups(arr):
+            return arr.transpose(1, 0, 2).reshape((cm.num_groups, size))
+
+        def from_groups(arr):
+            return arr.reshape((cm.num_groups, cm.l, cm.n)).transpose(1, 0, 2)
+
+        U = U.copy()
+        obj = objective(U=U)
+        self.trace.count()
+        i = 0
+        while i < maxiter:
+            grad = to_groups(gradient(U=U))
+            self.trace.count(evaluations=0, gradient_evaluations=1)
+            self.trace.record(iteration=i, objective=float(obj.sum()), gradient_norm=float(np.linalg.norm(grad)))
+            if H is None:
+                H = hessian(U=U)
+            # groups whose derivatives are not finite, e.g. when the fixed
+            # effects have diverged, keep their random effects
+            finite = np.isfinite(grad).all(axis=1) & np.isfinite(H).all(axis=(1, 2))
+            H_finite = H
+            if not finite.all():
+                LOG.warning(f"{np.sum(~finite)} of {cm.num_groups} groups have non-finite derivatives "
+                            f"and keep their random effects.")
+                H_finite = np.where(finite[:, None, None], H, np.identity(size))
+                grad = np.where(finite[:, None], grad, 0.)
+            # make every block positive definite by flipping and flooring
+            # its eigenvalues, so that each step is a descent direction
+            w, V = np.linalg.eigh(H_finite)
+            w = np.abs(w)
+            w = np.maximum(w, 1e-10*np.maximum(w.max(axis=1, keepdims=True), 1e-10))
+            step = -np.einsum('gij,gj->gi', V,
+                              np.einsum('gji,gj->gi', V, grad) / w)
+            slope = np.sum(grad * step, axis=1)
+            # groups that have already converged, or whose expected decrease
+            # is below the precision of their objective, do not take a step
+            accepted = ((np.max(np.abs(step), axis=1) <= tol) |
+                        (-slope <= 1e-14 * np.abs(obj)))
+            if accepted.all():
+                return U, H
+
+            t = np.where(accepted, 0., 1.)
+            new_obj = obj.copy()
+            for h in range(max_step_halvings):
+                trial = U + from_groups(t[:, None] * step)
+                trial_obj = objective(U=trial)
+                self.trace.count()
+                ok = ~accepted & (trial_obj <= obj + 1e-4 * t * slope)
+                new_obj[ok] = trial_obj[ok]
+                accepted |= ok
+                if accepted.all():
+                    break
+                t[~accepted] *= 0.5
+            t[~accepted] = 0.
+            update = from_groups(t[:, None] * step)
+            U += update
+            H = None
+            obj = new_obj
+            i += 1
+            LOG.debug(f"iteration {i} objective {obj.sum()}")
+            if np.max(np.abs(update)) <= tol:
+                break
+        return U, None
+
+    def compute_D(self, method=None, maxiter=10, tol=1e-6):
+        """Compute the covariance matrix of the random effects.
+
+        Args:
+            method: (str)
+                One of "covariance", the sample covariance of the random effects,
+                or "laplace", which maximizes the Laplace approximation of the
+                marginal likelihood for the current fixed and random effects.
+                Defaults to "covariance".
+            maxiter: (int)
+                Maximum number of fixed point updates for the "laplace" method.
+            tol: (float)
+                Relative tolerance on D for the "laplace" method.
         """
+        if method is None:
+            method = "covariance"
+        if method == "laplace":
+            self.compute_D_laplace(maxiter=maxiter, tol=tol)
+            return
+        if method != "covariance":
+            raise ValueError(f"Unknown method {method} for computing D.")
+
         LOG.info("Computing D.")
+        self.trace.start("D")
         if self.cm.n == 1:
             D = np.array([[[np.cov(self.cm.U[k].T)]] for k in range(self.cm.l)])
         else:
             D = np.array([np.cov(self.cm.U[k].T) for k in range(self.cm.l)])
         self.cm.update_params(D=D)
+        self.trace.record(iteration=0)
 
-    def callback_beta(self, X):
-        if self.EVALUATIONS % 10 == 0:
-            print('{0:4d}        {1: 3.6f}'.format(
-                self.EVALUATIONS, self.objective_beta(X))
-            )
-        self.EVALUATIONS += 1
+    def compute_D_laplace(self, maxiter=10, tol=1e-6):
+        """Estimate D by maximizing the Laplace approximation of the marginal
+        likelihood, with the random effects of each group integrated out around
+        their mode under N(0, D). Every iteration moves the modes with batched
+        Newton steps, warm started from the previous ones, and then takes the
+        fixed point update of D from `ccount.core.CorrelatedModel.laplace_update_D`.
+        The first iteration reuses the Hessians kept from the random effects step.
+        The random effects of the model are left where they are.
 
-    def callback_U(self, X):
-        if self.EVALUATIONS % 10 == 0:
-            print('{0:4d}        {1: 3.6f}'.format(
-                self.EVALUATIONS, self.objective_U(X))
+        Args:
+            maxiter: (int)
+                Maximum number of updates of D.
+            tol: (float)
+                Stop when the relative change in D is below tol.
+        """
+        if not self.cm.has_hessian:
+            raise ValueError("The laplace method for D needs the derivatives of the likelihood and links.")
+        LOG.info("Computing D with the Laplace approximation.")
+        cm = self.cm
+        self.trace.start("D")
+        U = cm.U
+        H_data = None
+        cached = self._group_hessian_U
+        if cached is not None and cached[1] is cm.U and np.array_equal(cached[0], cm.beta_vec):
+            H_data = cached[3] - cm.block_diag_D(cm.D_factorization(cached[2]).inv) / cm.num_groups
+
+        D = cm.D
+        for i in range(int(maxiter)):
+            U, H = self.newton_U(
+                objective=lambda U: cm.laplace_group_objective(U=U, D=D),
+                gradient=lambda U: cm.laplace_gradient_U(U=U, D=D),
+                hessian=lambda U: cm.laplace_hessian_U(U=U, D=D),
+                U=U, H=cm.laplace_hessian_U(D=D, H_data=H_data) if H_data is not None else None
             )
-        self.EVALUATIONS += 1
+            H_data = None
+            if H is None:
+                H = cm.laplace_hessian_U(U=U, D=D)
+            new_D = cm.laplace_update_D(U=U, H=H)
+            error = np.linalg.norm(new_D - D) / np.linalg.norm(new_D)
+            D = new_D
+            self.trace.record(iteration=i, D_change=float(error))
+            if error <= tol:
+                break
+        cm.update_params(D=D)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f"Laplace negative log marginal likelihood "
+                      f"{cm.laplace_neg_log_marginal(U=U)} after {i + 1} updates")
+
+    def iteration_callback(self):
+        """Callback for scipy.optimize that records every iteration in the trace."""
+        iteration = itertools.count(1)
+
+        def callback(X):
+            self.record_iteration(next(iteration), X)
+        return callback
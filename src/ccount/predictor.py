@@ -0,0 +1,230 @@
+"""
+Compiled predictions from a fitted model, for scoring new data many times.
+The normalization of the covariates is folded into the fixed effects, the
+spline bases are frozen and the group ids are resolved with a hash index,
+so that scoring only does the products of the design with the fixed effects.
+
+A predictor can be saved as a compact artifact without the training data:
+a directory with one .npy file per array, which can be memory-mapped on
+loading, and a JSON file with the specification of the model.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import xspline
+
+from ccount import link_functions, utils
+from ccount.models import MODEL_DICT
+
+ARTIFACT_VERSION = 1
+ARTIFACT_ARRAYS = ['beta_vec', 'U', 'D', 'group_id', 'X_mean', 'X_std']
+
+
+class Predictor:
+    """
+    Predictions of a fitted ccount.core.CorrelatedModel. The predictor holds
+    copies of the fitted parameters, so later updates of the model do not change it.
+    """
+    def __init__(self, model):
+        """
+        Args:
+            model: (ccount.core.CorrelatedModel) fitted model
+        """
+        self.model_class = type(model)
+        self.compile(
+            d=model.d, ci=model.ci, g=model.g,
+            beta_vec=model.beta_vec.copy(), U=model.U.copy(), D=model.D.copy(),
+            group_id=model.unique_group_id.copy(),
+            X_mean=utils.beta_to_vec(model.X_mean), X_std=utils.beta_to_vec(model.X_std),
+            xs=model.xs
+        )
+
+    def compile(self, d, ci, g, beta_vec, U, D, group_id, X_mean, X_std, xs):
+        """
+        Sets up the predictor from the parts of a fitted model.
+
+        Args:
+            d: (np.ndarray) number of fixed effects for each parameter and outcome
+            ci: (int) 1 if the fixed effects start with an intercept, else 0
+            g: (list) link function of each parameter
+            beta_vec: (np.ndarray) flat fixed effects
+            U: (np.ndarray) random effects for each group
+            D: (np.ndarray) covariance matrix of the random effects of each parameter
+            group_id: (np.ndarray) sorted unique group ids of the random effects
+            X_mean: (np.ndarray) flat means of the covariates
+            X_std: (np.ndarray) flat standard deviations of the covariates
+            xs: (list of list of list of xspline.XSpline) spline of each
+                parameter and outcome, or None
+        """
+        self.l, self.n = d.shape
+        self.d = d
+        self.ci = ci
+        self.g = g
+        self.mean_outcome = self.model_class.mean_outcome
+        self.beta_vec = beta_vec
+        self.U = U
+        self.D = D
+        self.group_id = group_id
+        self.X_mean = X_mean
+        self.X_std = X_std
+        self.xs = xs
+
+        # X_normalized.dot(beta) = const + X.dot(coef), with the intercept in const,
+        # see the X_scale and X_shift of ccount.core.CorrelatedModel
+        covariates = np.ones(beta_vec.size, dtype=bool)
+        for start in np.cumsum(d.ravel()) - d.ravel():
+            covariates[start:start + ci] = False
+        X_scale = np.ones(beta_vec.size)
+        X_shift = np.zeros(beta_vec.size)
+        X_scale[covariates] = 1 / X_std[covariates]
+        X_shift[covariates] = X_mean[covariates] / X_std[covariates]
+        beta = utils.vec_to_beta(beta_vec, d)
+        coef = utils.vec_to_beta(beta_vec * X_scale, d)
+        shift = utils.vec_to_beta(X_shift, d)
+        self.const = np.array([
+            [coef[k][j][:ci].sum() - shift[k][j].dot(beta[k][j]) for j in range(self.n)]
+            for k in range(self.l)
+        ])
+        self.coef = [[coef[k][j][ci:] for j in range(self.n)] for k in range(self.l)]
+        self.group_index = pd.Index(group_id)
+
+    def lookup_groups(self, group_id):
+        """
+        Args:
+            group_id: (np.ndarray) integer group id of each observation
+
+        Returns:
+            tuple of the rows of self.U for the observations, and whether the
+            model was fit on their groups
+        """
+        index = self.group_index.get_indexer(group_id)
+        return index, index >= 0
+
+    def linear_predictor(self, X_kj, S_kj, k, j, m):
+        """
+        Linear predictor of the fixed effects for parameter k and outcome j.
+
+        Args:
+            X_kj: (np.ndarray or scipy.sparse matrix) covariates, or None
+            S_kj: (list of np.ndarray) spline bases, or None
+            k: (int) index of the parameter
+            j: (int) index of the outcome
+            m: (int) number of observations
+
+        Returns:
+            np.ndarray of length m
+        """
+        eta = np.full(m, self.const[k, j])
+        start = 0
+        for block in ([X_kj] if X_kj is not None else []) + (S_kj if S_kj is not None else []):
+            eta += np.asarray(block.dot(self.coef[k][j][start:start + block.shape[1]])).ravel()
+            start += block.shape[1]
+        assert start == self.coef[k][j].size, "The covariates do not match those of the model."
+        return eta
+
+    def spline_bases(self, spline_specs):
+        """
+        Args:
+            spline_specs: (list of list of list of dict) with the 'spline_var' of each spline, or None
+
+        Returns:
+            list of list of list of np.ndarray of the spline bases, or None
+        """
+        if spline_specs is None:
+            return None
+        return [[
+            [self.xs[k][j][i].design_mat(g['spline_var'])[:, 1:] for i, g in enumerate(g_dict)]
+            if g_dict is not None else None for j, g_dict in enumerate(s)]
+            for k, s in enumerate(spline_specs)]
+
+    def predict(self, X, m, spline_specs=None, group_id=None, offset=None):
+        """
+        Predict the outcome matrix for new data, the same way as
+        ccount.core.CorrelatedModel.predict.
+
+        Args:
+            X: (list of list of np.ndarray) covariates for each parameter and outcome,
+                or None instead of an array if there are no covariates
+            m: (int) number of observations
+            spline_specs: (list of list of list of dict) optional, with the 'spline_var' of each spline
+            group_id: (np.ndarray) optional integer group id of each observation
+            offset: (list of np.ndarray) optional offset for each parameter
+
+        Returns:
+            np.ndarray of the predictions of shape (m, n)
+        """
+        if group_id is None:
+            group_id = np.arange(m)
+        S = self.spline_bases(spline_specs)
+        index, found = self.lookup_groups(np.asarray(group_id))
+        P = np.empty((self.l, m, self.n))
+        for k in range(self.l):
+            for j in range(self.n):
+                P[k, :, j] = self.linear_predictor(
+                    X[k][j], S[k][j] if S is not None else None, k, j, m
+                ) + np.where(found, self.U[k, index, j], 0.)
+            P[k] = self.g[k](P[k])
+            if offset is not None and offset[k] is not None:
+                P[k] *= offset[k]
+        return self.mean_outcome(P=P)
+
+    def save(self, path):
+        """
+        Saves the predictor as an artifact, see the module docstring.
+
+        Args:
+            path: (str) directory to write the artifact to, created if needed
+        """
+        model_type = [key for key, model_class in MODEL_DICT.items() if model_class is self.model_class]
+        if len(model_type) == 0:
+            raise ValueError(f"Only the models in MODEL_DICT can be saved, not {self.model_class}.")
+        spec = {
+            'version': ARTIFACT_VERSION,
+            'model_type': model_type[0],
+            'd': self.d.tolist(),
+            'ci': self.ci,
+            'links': [link_functions.link_name(g) for g in self.g],
+            'splines': None if self.xs is None else [[
+                [{'knots': x.knots.tolist(), 'degree': x.degree, 'l_linear': x.l_linear, 'r_linear': x.r_linear}
+                 for x in xs_kj] if xs_kj is not None else None for xs_kj in xs_k] for xs_k in self.xs
+            ]
+        }
+        os.makedirs(path, exist_ok=True)
+        for name in ARTIFACT_ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'model.json'), 'w') as f:
+            json.dump(spec, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Loads a predictor from an artifact.
+
+        Args:
+            path: (str) directory of the artifact
+            mmap_mode: (str) memory-map mode of the arrays, see numpy.load,
+                or None to read them into memory
+
+        Returns:
+            ccount.predictor.Predictor
+        """
+        with open(os.path.join(path, 'model.json')) as f:
+            spec = json.load(f)
+        if spec['version'] != ARTIFACT_VERSION:
+            raise ValueError(f"Cannot load an artifact of version {spec['version']}.")
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                  for name in ARTIFACT_ARRAYS}
+        xs = None if spec['splines'] is None else [[
+            [xspline.XSpline(knots=np.array(x['knots']), degree=x['degree'],
+                             l_linear=x['l_linear'], r_linear=x['r_linear']) for x in xs_kj]
+            if xs_kj is not None else None for xs_kj in xs_k] for xs_k in spec['splines']
+        ]
+        predictor = cls.__new__(cls)
+        predictor.model_class = MODEL_DICT[spec['model_type']]
+        predictor.compile(
+            d=np.array(spec['d']), ci=spec['ci'], g=[link_functions.LINKS[name] for name in spec['links']],
+            xs=xs, **arrays
+        )
+        return predictor
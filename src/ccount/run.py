@@ -6,6 +6,7 @@ import pandas as pd
 from typing import Optional, List
 import multiprocessing as mp
 
+from ccount.bootstrap import BootstrapEngine, draw_bootstrap_samples
 from ccount.models import MODEL_DICT
 
 LOG = logging.getLogger(__name__)
@@ -32,7 +33,8 @@ def initialize_model(model_type, **kwargs):
 
 
 def convert_df_to_model(model_type, df, outcome_variables,
-                        fixed_effects, random_effect, spline=None, offset=None, weight=None, **kwargs):
+                        fixed_effects, random_effect, spline=None, offset=None, weight=None, dtype=None,
+                        compress=False, trials=None, **kwargs):
     """
     Convert a data frame to a correlated model.
 
@@ -47,6 +49,12 @@ def convert_df_to_model(model_type, df, outcome_variables,
         random_effect: (str)
         offset: (list)
         weight: (list)
+        dtype: (numpy.dtype) optional floating point type to store the data in,
+            e.g. numpy.float32, see ccount.core.CorrelatedModel
+        compress: (bool) collapse identical rows into one weighted row,
+            see ccount.core.CorrelatedModel
+        trials: (list) optional number of trials column for each outcome, whose
+            outcome columns are then the number of successes, for the binomial model
 
     Returns:
         ccount.core.CorrelatedModel
@@ -108,6 +116,9 @@ def convert_df_to_model(model_type, df, outcome_variables,
 
     if weight is not None:
         weight = np.asarray(df[[weight for i in range(Y.shape[1])]])
+    if trials is not None:
+        assert type(trials) == list and len(trials) == len(outcome_variables)
+        kwargs.update(trials=np.asarray(df[trials]))
     d = np.array([[x.shape[1] if x is not None else 0 for x in k] for k in X])
 
     return initialize_model(
@@ -118,17 +129,17 @@ def convert_df_to_model(model_type, df, outcome_variables,
         Y=Y, X=X, spline_specs=spline, group_id=group_id,
         offset=offsets,
         weights=weight,
+        dtype=dtype,
+        compress=compress,
         **kwargs
     )
 
 
-def get_predictions_from_df(model, df,
-                            fixed_effects, random_effect, spline=None, offset=None):
+def prediction_data_from_df(df, fixed_effects, random_effect, spline=None, offset=None):
     """
-    Add predictions to a dataset from a model that has already been fit.
+    Get the arguments for making predictions with a model that has already been fit from a dataset.
 
     Args:
-        model: ccount.core.CorrelatedModel
         df: pd.DataFrame
         fixed_effects: list of list of list of str
         random_effect: str
@@ -136,8 +147,8 @@ def get_predictions_from_df(model, df,
         offset: list of str
 
     Returns:
-        np.array of predictions
-
+        dict of the arguments X, m, spline_specs, group_id and offset of
+        ccount.core.CorrelatedModel.predict
     """
     for f in fixed_effects:
         for g in f:
@@ -160,14 +171,74 @@ def get_predictions_from_df(model, df,
     else:
         offsets = None
     group_id = np.asarray(df[[random_effect]]).astype(int).ravel()
-    return np.transpose(
-        model.predict(
-            X=X, m=len(df),
-            spline_specs=spline,
-            group_id=group_id,
-            offset=offsets
-        )
+    return dict(X=X, m=len(df), spline_specs=spline, group_id=group_id, offset=offsets)
+
+
+def get_predictions_from_df(model, df,
+                            fixed_effects, random_effect, spline=None, offset=None):
+    """
+    Add predictions to a dataset from a model that has already been fit.
+
+    Args:
+        model: ccount.core.CorrelatedModel
+        df: pd.DataFrame
+        fixed_effects: list of list of list of str
+        random_effect: str
+        spline: list of list of str
+        offset: list of str
+
+    Returns:
+        np.array of predictions
+
+    """
+    data = prediction_data_from_df(
+        df=df, fixed_effects=fixed_effects, random_effect=random_effect,
+        spline=spline, offset=offset
     )
+    return np.transpose(model.predict(**data))
+
+
+def get_predictions_iter_from_df(model, df,
+                                 fixed_effects, random_effect, spline=None, offset=None,
+                                 chunk_size=100000):
+    """
+    Streams predictions for a dataset from a model that has already been fit, like
+    get_predictions_from_df but for one chunk of rows of the dataset at a time.
+
+    Args:
+        model: ccount.core.CorrelatedModel
+        df: pd.DataFrame
+        fixed_effects: list of list of list of str
+        random_effect: str
+        spline: list of list of str
+        offset: list of str
+        chunk_size: int number of rows in each chunk
+
+    Yields:
+        np.array of predictions for the next chunk of rows
+    """
+    assert chunk_size > 0
+    for start in range(0, len(df), chunk_size):
+        yield get_predictions_from_df(
+            model=model, df=df.iloc[start:start + chunk_size],
+            fixed_effects=fixed_effects, random_effect=random_effect,
+            spline=spline, offset=offset
+        )
+
+
+def optimize_model(task):
+    """
+    Optimizes a model in a worker process.
+
+    Args:
+        task: (tuple) of a ccount.core.CorrelatedModel and the arguments for its optimize_params
+
+    Returns:
+        ccount.core.CorrelatedModel
+    """
+    model, optimize_kwargs = task
+    model.optimize_params(**optimize_kwargs)
+    return model
 
 
 class ModelRun:
@@ -177,7 +248,12 @@ class ModelRun:
                  max_iters: int = 100, max_beta_iters: int = 10, max_U_iters: int = 10,
                  rel_tol: Optional[float] = None,
                  optimize_beta: bool = True, optimize_U: bool = True, compute_D: bool = True,
-                 bootstraps: int = None, bootstrap_dfs: List[pd.DataFrame] = None):
+                 bootstraps: int = None, bootstrap_dfs: List[pd.DataFrame] = None,
+                 beta_method: Optional[str] = None, U_method: Optional[str] = None,
+                 joint: bool = False, D_method: Optional[str] = None,
+                 dtype=None, bootstrap_method: str = 'index',
+                 warm_start: bool = True, bootstrap_max_iters: Optional[int] = None,
+                 compress: bool = False, trials: Optional[List[str]] = None):
 
         self.model_type = model_type
         self.training_df = training_df
@@ -189,6 +265,9 @@ class ModelRun:
         self.spline = spline
         self.offset = offset
         self.weight = weight
+        self.dtype = dtype
+        self.compress = compress
+        self.trials = trials
 
         self.max_iters = max_iters
         self.max_beta_iters = max_beta_iters
@@ -197,9 +276,16 @@ class ModelRun:
         self.optimize_beta = optimize_beta
         self.optimize_U = optimize_U
         self.compute_D = compute_D
+        self.beta_method = beta_method
+        self.U_method = U_method
+        self.joint = joint
+        self.D_method = D_method
 
         self.bootstraps = bootstraps
         self.bootstrap_dfs = bootstrap_dfs
+        self.bootstrap_method = bootstrap_method
+        self.warm_start = warm_start
+        self.bootstrap_max_iters = bootstrap_max_iters
         if self.bootstraps is None and self.bootstrap_dfs is not None:
             self.bootstraps = len(self.bootstrap_dfs)
         if self.bootstrap_dfs is not None:
@@ -209,6 +295,7 @@ class ModelRun:
         self.model = None
         self.draws = None
         self.models = list()
+        self.bootstrap_samples = list()
 
         self.initialize()
 
@@ -229,18 +316,31 @@ class ModelRun:
         LOG.info("Optimizing main model.")
         self.optimize(model=self.model)
 
+        if len(self.bootstrap_samples) > 0:
+            engine = BootstrapEngine(model=self.model, pools=pools, method=self.bootstrap_method)
+            fits = engine.fit(self.bootstrap_samples, warm_start=self.warm_start,
+                              **self.optimize_kwargs(bootstrap=True))
+            self.models = [self.model.replicate(beta=beta, U=U, D=D, compute_P=False)
+                           for beta, U, D in fits]
+            return
+
+        if self.warm_start:
+            for mod in self.models:
+                mod.warm_start(self.model)
         if pools > 1:
-            pool = mp.Pool(pools)
-            self.models = pool.map(self.optimize, self.models)
-            pool.close()
+            with mp.Pool(pools) as pool:
+                self.models = pool.map(optimize_model, [
+                    (mod, self.optimize_kwargs(bootstrap=True)) for mod in self.models
+                ])
         else:
             for i, mod in enumerate(self.models):
                 LOG.info(f"Optimizing bootstrap model {i}.")
-                self.optimize(model=self.models[i])
+                self.models[i].optimize_params(**self.optimize_kwargs(bootstrap=True))
 
     def predict(self, alpha=0.05):
         """
-        Creates predictions for the prediction data frame.
+        Creates predictions for the prediction data frame. With more than one outcome,
+        the columns are named by statistic and outcome, e.g. 'mean_y'.
         Args:
             alpha: (float) confidence level for the confidence interval
         Returns:
@@ -248,20 +348,44 @@ class ModelRun:
         """
         assert 0 < alpha < 1
         predictions = self.predictions(model=self.model)
+        stats = {'mean': predictions}
         if len(self.models) > 0:
-            self.draws = np.vstack([
-                self.predictions(model=mod) for mod in self.models
-            ])
-            # TODO: Make this work for n > 1 outcomes -- adjust axis
-            return pd.DataFrame({
-                'mean': predictions[0],
+            self.draws = self.bootstrap_predictions()
+            stats.update({
                 'lower': np.quantile(self.draws, q=alpha/2, axis=0),
                 'upper': np.quantile(self.draws, q=1-alpha/2, axis=0)
             })
-        else:
-            return pd.DataFrame({
-                'mean': predictions[0]
-            })
+        if len(self.outcome_variables) == 1:
+            return pd.DataFrame({name: stat[0] for name, stat in stats.items()})
+        return pd.DataFrame({
+            f'{name}_{outcome}': stat[j]
+            for name, stat in stats.items() for j, outcome in enumerate(self.outcome_variables)
+        })
+
+    def bootstrap_predictions(self):
+        """
+        Helper function to get the predictions of all of the bootstrap models. The fits
+        of the built-in bootstraps share the specification of the main model, so they
+        are predicted together from one design of the prediction data frame.
+
+        Returns:
+            np.array of shape (bootstraps, outcomes, observations)
+        """
+        if len(self.bootstrap_samples) == 0:
+            return np.stack([self.predictions(model=mod) for mod in self.models])
+        data = prediction_data_from_df(
+            df=self.prediction_df,
+            fixed_effects=self.fixed_effects,
+            random_effect=self.random_effect,
+            spline=self.spline,
+            offset=self.offset,
+        )
+        draws = self.model.predict_draws(
+            betas=np.stack([mod.beta_vec for mod in self.models]),
+            Us=np.stack([mod.U for mod in self.models]),
+            **data
+        )
+        return draws.transpose(0, 2, 1)
 
     def convert(self, df):
         """
@@ -281,7 +405,10 @@ class ModelRun:
             random_effect=self.random_effect,
             spline=self.spline,
             offset=self.offset,
-            weight=self.weight
+            weight=self.weight,
+            dtype=self.dtype,
+            compress=self.compress,
+            trials=self.trials
         )
 
     def optimize(self, model):
@@ -293,13 +420,31 @@ class ModelRun:
         Returns:
             None
         """
-        model.optimize_params(
-            max_iters=self.max_iters, max_beta_iters=self.max_beta_iters,
+        model.optimize_params(**self.optimize_kwargs())
+        return model
+
+    def optimize_kwargs(self, bootstrap=False):
+        """
+        Helper function for the arguments of optimize_params based on the attributes of this ModelRun.
+
+        Args:
+            bootstrap: (bool) arguments for the bootstrap models, which run at most
+                bootstrap_max_iters iterations if it is given
+
+        Returns:
+            dict
+        """
+        max_iters = self.max_iters
+        if bootstrap and self.bootstrap_max_iters is not None:
+            max_iters = self.bootstrap_max_iters
+        return dict(
+            max_iters=max_iters, max_beta_iters=self.max_beta_iters,
             max_U_iters=self.max_U_iters, rel_tol=self.rel_tol,
             optimize_beta=self.optimize_beta, optimize_U=self.optimize_U,
-            compute_D=self.compute_D
+            compute_D=self.compute_D, beta_method=self.beta_method,
+            U_method=self.U_method, joint=self.joint,
+            D_method=self.D_method
         )
-        return model
 
     def predictions(self, model):
         """
@@ -320,18 +465,18 @@ class ModelRun:
 
     def bootstrap_data(self, bootstrap_dfs: Optional[List[pd.DataFrame]] = None):
         """
-        Bootstraps the data with self.bootstraps samples.
+        Bootstraps the data with self.bootstraps samples. Without bootstrap_dfs the
+        rows of every group are resampled with replacement from the main model, stored
+        as row indices or row weights depending on self.bootstrap_method rather than
+        as new models.
         """
-        for i in range(self.bootstraps):
-            if bootstrap_dfs is None:
-                df_i = self.training_df.groupby(
-                    self.random_effect, group_keys=False
-                ).apply(
-                    lambda x: x.sample(len(x), replace=True)
-                )
-            else:
-                df_i = bootstrap_dfs[i].copy()
-            self.models.append(self.convert(df=df_i))
+        if bootstrap_dfs is None:
+            self.bootstrap_samples = draw_bootstrap_samples(
+                model=self.model, num=self.bootstraps, method=self.bootstrap_method
+            )
+        else:
+            for i in range(self.bootstraps):
+                self.models.append(self.convert(df=bootstrap_dfs[i].copy()))
 
     def summarize(self, **kwargs):
         self.model.summarize(**kwargs)
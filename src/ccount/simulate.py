@@ -1,6 +1,32 @@
 import numpy as np
-from scipy.stats import rv_discrete
-from scipy.special import gamma
+
+
+def sample_truncated_poisson(mu, rng=None):
+    """
+    Draw from zero-truncated Poisson distributions, vectorized over the means.
+    Uses that for a Poisson process with rate mu on [0, 1] with at least one
+    event, the time t of the first event follows an exponential distribution
+    truncated to [0, 1], and the number of events after it is Poisson with mean
+    mu * (1 - t). Both are drawn by inversion, without rejection.
+
+    Parameters
+    ----------
+        mu : array_like
+            Positive means of the (untruncated) Poisson distributions
+        rng : numpy.random.Generator, optional
+            Random number generator, by default the global numpy random state
+
+    Returns
+    -------
+        np.ndarray of positive integers shaped like mu
+    """
+    mu = np.asarray(mu, dtype=float)
+    uniform = rng.random(mu.shape) if rng is not None else np.random.random_sample(mu.shape)
+    # first event time, -log(1 - U * (1 - exp(-mu))) / mu, in a stable form
+    t = -np.log1p(uniform * np.expm1(-mu)) / mu
+    rest = np.maximum(mu * (1. - t), 0.)
+    poisson = rng.poisson if rng is not None else np.random.poisson
+    return 1 + poisson(rest)
 
 
 class Simulation:
@@ -64,7 +90,14 @@ class HurdlePoissonSimulation(Simulation):
     """
     Simulate data from a Hurdle Correlated Poisson model
     """
-    def __init__(self, **kwargs):
+    def __init__(self, rng=None, **kwargs):
+        """
+        Parameters
+        ----------
+            rng : numpy.random.Generator, optional
+                Random number generator for the truncated Poisson draws,
+                by default the global numpy random state
+        """
         super().__init__(**kwargs)
 
         self.update_params(
@@ -73,13 +106,7 @@ class HurdlePoissonSimulation(Simulation):
             D=np.identity(n=self.n),
             p=0.5
         )
-
-        class TruncatedPoisson(rv_discrete):
-            """Modified Poisson RV so that it cannot produce 0's."""
-            def _pmf(self, k, mu):
-                return (mu ** k) / ((np.exp(mu) - 1) * gamma(k.astype(int)+1))
-
-        self.truncated_poisson = TruncatedPoisson(name='truncated_poisson', a=1, b=np.inf)
+        self.rng = rng
 
         # Simulation results
         self.u = None
@@ -97,7 +124,7 @@ class HurdlePoissonSimulation(Simulation):
                       for j in range(self.n)]
         self.Y_zeros = 1 - np.random.binomial(size=(self.n, self.m),
                                               p=self.p, n=1)
-        self.Y_poisson = self.truncated_poisson.rvs(mu=self.theta)
+        self.Y_poisson = sample_truncated_poisson(mu=self.theta, rng=self.rng)
         self.Y_hp = self.Y_zeros * self.Y_poisson
 
         return self.Y_hp.T
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+    telemetry
+    ~~~~~~~~~
+
+    Structured trace of the optimization of a correlated model. Every step of
+    the optimization (beta, U, joint, D) records one entry per iteration with
+    values that the optimizer has already computed, and the entries are passed
+    on to any number of sinks, e.g. to log or print them.
+"""
+import logging
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+LOG = logging.getLogger(__name__)
+
+
+def peak_memory():
+    """Peak resident memory of the process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux and the other platforms
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class Trace:
+    """Trace of the optimization of a model.
+
+    Attributes
+    ----------
+    records : list of dict
+        One entry per iteration with the keys `step`, `call` (number of the
+        call of the step), `iteration`, `objective`, `gradient_norm` (None if
+        not computed), `evaluations` and `gradient_evaluations` (counted since
+        the start of the call), `time` (seconds since the start of the call),
+        `peak_memory` (bytes) and any extra values of the step.
+    evaluations : dict
+        Total number of objective evaluations of each step.
+    gradient_evaluations : dict
+        Total number of gradient evaluations of each step.
+    sinks : list of callable
+        Functions called with every new entry.
+    """
+    def __init__(self, sinks=None):
+        self.records = list()
+        self.evaluations = dict()
+        self.gradient_evaluations = dict()
+        self.calls = dict()
+        self.sinks = list(sinks) if sinks is not None else list()
+        self.step = None
+        self._start_time = None
+        self._start_evaluations = 0
+        self._start_gradient_evaluations = 0
+
+    def add_sink(self, sink):
+        """Add a function that is called with every new entry."""
+        self.sinks.append(sink)
+
+    def start(self, step):
+        """Start a call of an optimization step, e.g. "beta"."""
+        self.step = step
+        self.calls[step] = self.calls.get(step, 0) + 1
+        self.evaluations.setdefault(step, 0)
+        self.gradient_evaluations.setdefault(step, 0)
+        self._start_time = time.perf_counter()
+        self._start_evaluations = self.evaluations[step]
+        self._start_gradient_evaluations = self.gradient_evaluations[step]
+
+    def count(self, evaluations=1, gradient_evaluations=0):
+        """Count evaluations of the objective and gradient of the current step."""
+        if self.step is None:
+            return
+        self.evaluations[self.step] += evaluations
+        self.gradient_evaluations[self.step] += gradient_evaluations
+
+    def record(self, iteration, objective=None, gradient_norm=None, **kwargs):
+        """Record an iteration of the current step and pass it to the sinks."""
+        entry = dict(
+            step=self.step,
+            call=self.calls[self.step],
+            iteration=iteration,
+            objective=objective,
+            gradient_norm=gradient_norm,
+            evaluations=self.evaluations[self.step] - self._start_evaluations,
+            gradient_evaluations=self.gradient_evaluations[self.step] - self._start_gradient_evaluations,
+            time=time.perf_counter() - self._start_time,
+            peak_memory=peak_memory(),
+            **kwargs
+        )
+        self.records.append(entry)
+        for sink in self.sinks:
+            sink(entry)
+
+    def to_frame(self):
+        """Return the records as a pandas.DataFrame."""
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+
+class LoggingSink:
+    """Sink that logs every entry of a trace at the given level."""
+    def __init__(self, logger=LOG, level=logging.DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, entry):
+        self.logger.log(self.level, " ".join(f"{key}={value}" for key, value in entry.items()))
+
+
+class PrintSink:
+    """Sink that prints the objective of every `every`-th iteration."""
+    def __init__(self, every=10):
+        self.every = every
+
+    def __call__(self, entry):
+        if entry['iteration'] % self.every == 0 and entry['objective'] is not None:
+            print('{0:5s} {1:4d}        {2: 3.6f}'.format(entry['step'], entry['iteration'], entry['objective']))
@@ -83,3 +83,36 @@ def split(vec, sizes):
     assert sizes.dtype == int
     assert vec.shape == (np.sum(sizes),)
     return np.split(vec, np.cumsum(sizes)[:-1])
+
+
+def sparse_row_key(X):
+    """Columns that identify the rows of a sparse matrix, without densifying
+    it. Each row is described by the column indices and the values of its
+    non-zero entries, padded to the largest number of entries in a row, so
+    that two rows are equal exactly when their keys are.
+
+    Parameters
+    ----------
+    X : scipy.sparse.spmatrix
+        Sparse matrix of shape (m, d).
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (m, 2 * w) where w is the largest number of non-zero
+        entries in a row.
+    """
+    # canonical form, with sorted indices and no explicit zeros
+    X = X.tocsr(copy=True)
+    X.has_canonical_format = False
+    X.sum_duplicates()
+    X.eliminate_zeros()
+    nnz = np.diff(X.indptr)
+    width = int(nnz.max()) if nnz.size > 0 else 0
+    rows = np.repeat(np.arange(X.shape[0]), nnz)
+    position = np.arange(X.nnz) - np.repeat(X.indptr[:-1], nnz)
+    key = np.zeros((X.shape[0], 2 * width))
+    key[:, :width] = -1.
+    key[rows, position] = X.indices
+    key[rows, width + position] = X.data
+    return key
@@ -0,0 +1,142 @@
+import pytest
+import numpy as np
+
+from ccount.bootstrap import BootstrapEngine, draw_bootstrap_indices, draw_bootstrap_samples
+from ccount.models import MODEL_DICT
+
+from test_models import make_model
+
+# test problem
+model_type = 'zero_inflated_poisson'
+m = 200
+
+
+def test_draw_bootstrap_indices():
+    cm = make_model(model_type, m=m)
+    index = draw_bootstrap_indices(cm, rng=np.random.default_rng(0))
+    assert index.size == cm.m
+    assert np.array_equal(cm.group_id[index], cm.group_id)
+
+
+def test_resample():
+    cm = make_model(model_type, m=m)
+    index = np.sort(draw_bootstrap_indices(cm, rng=np.random.default_rng(0)))
+    resampled = cm.resample(index)
+    assert np.array_equal(resampled.Y, cm.Y[index])
+    assert np.array_equal(resampled.X[1][0], cm.X[1][0][index])
+    assert np.array_equal(resampled.group_sizes, cm.group_sizes)
+    assert resampled.opt_interface.cm is resampled
+    assert np.all(resampled.beta_vec == 0.)
+
+
+def test_reweight_matches_resample():
+    cm = make_model(model_type, m=m)
+    index = draw_bootstrap_samples(cm, num=1, method='index', rng=np.random.default_rng(0))[0]
+    weights = draw_bootstrap_samples(cm, num=1, method='weights', rng=np.random.default_rng(0))[0]
+    assert weights.sum() == cm.m
+    resampled = cm.resample(index)
+    reweighted = cm.reweight(weights)
+    assert reweighted.Y is cm.Y
+    beta = 0.1 * np.random.randn(cm.beta_vec.size)
+    U = 0.1 * np.random.randn(*cm.U.shape)
+    assert np.isclose(resampled.neg_log_likelihood(beta=beta, U=U), reweighted.neg_log_likelihood(beta=beta, U=U))
+    assert np.allclose(resampled.gradient_beta(beta=beta, U=U, flat=True),
+                       reweighted.gradient_beta(beta=beta, U=U, flat=True))
+
+
+def test_draw_bootstrap_samples_method():
+    cm = make_model(model_type, m=m)
+    with pytest.raises(ValueError):
+        draw_bootstrap_samples(cm, num=1, method='jackknife')
+
+
+@pytest.mark.parametrize("stack_X", [None, 'dense', 'sparse'])
+@pytest.mark.parametrize("method", ['index', 'weights'])
+def test_bootstrap_engine_pools(stack_X, method):
+    cm = make_model(model_type, m=m, stack_X=stack_X)
+    samples = draw_bootstrap_samples(cm, num=3, method=method, rng=np.random.default_rng(0))
+    kwargs = dict(max_iters=2, max_beta_iters=5, max_U_iters=5)
+    serial = BootstrapEngine(model=cm, pools=1, method=method).fit(samples, **kwargs)
+    parallel = BootstrapEngine(model=cm, pools=2, method=method).fit(samples, **kwargs)
+    for (beta, U, D), (beta_p, U_p, D_p) in zip(serial, parallel):
+        assert np.allclose(beta, beta_p)
+        assert np.allclose(U, U_p)
+        assert np.allclose(D, D_p)
+    replicate = cm.replicate(*serial[0])
+    assert np.array_equal(replicate.beta_vec, serial[0][0])
+    assert replicate.Y is cm.Y
+    assert replicate.P.shape == cm.P.shape
+    replicate = cm.replicate(*serial[0], compute_P=False)
+    assert replicate.P is None
+    assert cm.P is not None
+    assert np.array_equal(replicate.U, serial[0][1])
+
+
+def test_warm_start_maps_groups():
+    cm = make_model(model_type, m=m)
+    cm.update_params(U=np.random.randn(*cm.U.shape), D=2. * cm.D)
+    # drop the first group and replace the last one with a new group
+    other = make_model(model_type, m=m, group_id=np.repeat([1, 2, 7, 7], 50))
+    other.warm_start(cm)
+    assert np.array_equal(other.beta_vec, cm.beta_vec)
+    assert np.array_equal(other.D, cm.D)
+    assert np.array_equal(other.U[:, :2], cm.U[:, 1:3])
+    assert np.all(other.U[:, 2] == 0.)
+
+
+def test_bootstrap_engine_warm_start():
+    cm = make_model(model_type, m=m)
+    kwargs = dict(max_iters=10, max_beta_iters=10, max_U_iters=10)
+    cm.optimize_params(**kwargs)
+    samples = draw_bootstrap_samples(cm, num=2, rng=np.random.default_rng(0))
+    cold = BootstrapEngine(model=cm).fit(samples, warm_start=False, **kwargs)
+    warm = BootstrapEngine(model=cm).fit(samples, **dict(kwargs, max_iters=3))
+    for (beta, U, D), (beta_w, U_w, D_w) in zip(cold, warm):
+        assert np.linalg.norm(beta_w - beta) < 1e-2 * np.linalg.norm(beta)
+
+
+def make_compressed_model(compress=True):
+    np.random.seed(0)
+    rows = np.random.randint(0, 20, size=200)
+    Y = np.random.poisson(lam=2., size=(20, 2))[rows]
+    X = [[np.random.randn(20, 2)[rows] for j in range(2)] for k in range(2)]
+    group_id = (np.arange(20) % 4)[rows]
+    return MODEL_DICT['zero_inflated_poisson'](m=200, n=2, d=np.array([[2, 2], [2, 2]]), Y=Y, X=X,
+                                               group_id=group_id, compress=compress)
+
+
+def test_bootstrap_compressed():
+    cm = make_compressed_model()
+    assert cm.m == 20
+    index = draw_bootstrap_samples(cm, num=1, method='index', rng=np.random.default_rng(0))[0]
+    weights = draw_bootstrap_samples(cm, num=1, method='weights', rng=np.random.default_rng(0))[0]
+    # as many observations as every group has, drawn from its rows
+    assert index.size == cm.num_obs
+    assert np.array_equal(np.bincount(cm.group_id[index]), np.bincount(cm.group_id, weights=cm.counts))
+    assert np.isclose(np.sum(weights * cm.counts), cm.num_obs)
+
+    resampled = cm.resample(index)
+    reweighted = cm.reweight(weights)
+    assert resampled.num_obs == reweighted.num_obs == cm.num_obs
+    # the resample stays compressed, with the draws of each row in its counts
+    assert resampled.m <= cm.m and resampled.counts.sum() == cm.num_obs
+    assert np.array_equal(resampled.counts, np.bincount(index)[np.bincount(index) > 0])
+    beta = 0.1 * np.random.randn(cm.beta_vec.size)
+    U = 0.1 * np.random.randn(*cm.U.shape)
+    assert np.isclose(resampled.neg_log_likelihood(beta=beta, U=U), reweighted.neg_log_likelihood(beta=beta, U=U))
+
+    # rows are drawn as often as the observations they stand for
+    draws = np.mean(draw_bootstrap_samples(cm, num=2000, method='weights', rng=np.random.default_rng(1)), axis=0)
+    assert np.allclose(draws, 1., atol=0.2)
+
+
+@pytest.mark.parametrize("method", ['index', 'weights'])
+def test_bootstrap_engine_compressed(method):
+    cm = make_compressed_model()
+    samples = draw_bootstrap_samples(cm, num=2, method=method, rng=np.random.default_rng(0))
+    kwargs = dict(max_iters=2, max_beta_iters=5, max_U_iters=5)
+    serial = BootstrapEngine(model=cm, pools=1, method=method).fit(samples, **kwargs)
+    parallel = BootstrapEngine(model=cm, pools=2, method=method).fit(samples, **kwargs)
+    for (beta, U, D), (beta_p, U_p, D_p) in zip(serial, parallel):
+        assert np.allclose(beta, beta_p)
+        assert np.allclose(U, U_p)
@@ -119,3 +119,30 @@ def test_correlated_model_neg_log_likelihood(group_id, beta, U, D):
     assert np.abs(cm.neg_log_likelihood() -
                   0.5*np.mean(np.sum((cm.Y - cm.P[0])**2, axis=1)) -
                   0.5*np.sum(cm.U[0]*cm.U[0])/cm.m) < 1e-10
+
+
+@pytest.mark.parametrize("D", [np.array([[[2., 0.5, 0.], [0.5, 1., 0.], [0., 0., 3.]]]),
+                               np.array([[[1., 1., 0.], [1., 1., 0.], [0., 0., 0.]]]),
+                               np.zeros((1, 3, 3))])
+def test_d_factorization(D):
+    factor = core.DFactorization(D)
+    for k in range(D.shape[0]):
+        assert np.linalg.norm(factor.inv[k] - np.linalg.pinv(D[k])) < 1e-10
+        eigvals = np.linalg.eigvalsh(D[k])
+        eigvals = eigvals[np.abs(eigvals) > 1e-12]
+        assert np.abs(factor.logdet[k] - np.sum(np.log(eigvals))) < 1e-10
+
+
+def test_correlated_model_D_factorization_cache():
+    cm = core.CorrelatedModel(m, n, l, d, Y, X,
+                              [lambda x: x] * l,
+                              lambda y, p: 0.5*(y - p[0])**2)
+    factor = cm.D_factorization()
+    assert cm.D_factorization() is factor
+    assert np.linalg.norm(factor.inv - cm.D) < 1e-10
+
+    D = np.array([np.identity(n) * 2.] * l)
+    cm.update_params(D=D)
+    assert cm.D_factorization() is not factor
+    assert np.linalg.norm(cm.D_factorization().inv - 0.5 * np.identity(n)) < 1e-10
+    assert cm.D_factorization(D=np.array([np.identity(n)] * l)) is not cm.D_factorization()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    test_likelihoods
+    ~~~~~~~~~~~~~~~~
+
+    Test the likelihoods module
+"""
+import numpy as np
+import pytest
+from scipy.special import loggamma
+from ccount import likelihoods
+from ccount.likelihoods import (
+    LikelihoodContext, NegLogLikelihoods, NegLogLikelihoodGradients, NegLogLikelihoodHessians
+)
+
+from test_models import make_model
+
+
+LIKELIHOODS = ['hurdle_poisson', 'zi_poisson', 'nbinom', 'zi_nbinom']
+
+
+def naive_neg_log_likelihood(family, Y, P):
+    if family == 'hurdle_poisson':
+        p, theta = P
+        ll = np.where(Y == 0, np.log(p), np.log(1 - p) - theta + Y * np.log(theta) - np.log(1 - np.exp(-theta)))
+    elif family == 'zi_poisson':
+        p, theta = P
+        ll = np.where(Y == 0, np.log(p + (1 - p) * np.exp(-theta)), np.log(1 - p) - theta + Y * np.log(theta))
+    elif family == 'zi_nbinom':
+        p, theta, k = P[0], P[1], 1 / P[2]
+        ll = np.where(Y == 0, np.log(p + (1 - p) * (1 + theta / k) ** -k),
+                      np.log(1 - p) - naive_neg_log_likelihood('nbinom', Y, P[1:]))
+    else:
+        theta, k = P[0], 1 / P[1]
+        ll = (loggamma(Y + k) - loggamma(k) + k * np.log(k) - k * np.log(k + theta) +
+              Y * np.log(theta) - Y * np.log(theta + k))
+    return -ll
+
+
+@pytest.mark.parametrize("family", LIKELIHOODS)
+@pytest.mark.parametrize("use_numexpr", [False, True])
+def test_likelihood_kernels(family, use_numexpr, monkeypatch):
+    if use_numexpr and likelihoods.numexpr is None:
+        pytest.skip("numexpr is not installed")
+    monkeypatch.setattr(likelihoods, 'USE_NUMEXPR', use_numexpr)
+    np.random.seed(0)
+    Y = np.random.poisson(lam=2., size=(50, 2)) * np.random.binomial(n=1, p=0.7, size=(50, 2))
+    P = np.array([np.random.uniform(0.1, 0.9, size=Y.shape), np.random.uniform(0.5, 5., size=Y.shape)])
+    if family == 'nbinom':
+        P = P[::-1]
+    elif family == 'zi_nbinom':
+        P = np.concatenate([P, np.random.uniform(0.1, 3., size=(1,) + Y.shape)])
+    f = getattr(NegLogLikelihoods, family)
+    assert np.allclose(f(Y, P), naive_neg_log_likelihood(family, Y, P))
+
+    # the gradient is the complex step derivative of the likelihood, and the
+    # Hessian that of the gradient
+    df = getattr(NegLogLikelihoodGradients, family)(Y, P)
+    d2f = getattr(NegLogLikelihoodHessians, family)(Y, P)
+    for k in range(P.shape[0]):
+        step = np.zeros(P.shape, dtype=complex)
+        step[k] = 1e-20j
+        assert np.allclose(f(Y, P + step).imag / 1e-20, df[k])
+        step[k] = 1e-6
+        assert np.allclose((getattr(NegLogLikelihoodGradients, family)(Y, P + step.real) - df) / 1e-6,
+                           d2f[:, k], rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("family", LIKELIHOODS)
+def test_likelihood_kernels_extreme(family):
+    Y = np.array([0, 0, 1, 5, 100])
+    P = np.array([[1e-300, 1 - 1e-12, 1e-300, 1 - 1e-12, 0.5],
+                  [1e-12, 800., 1e-12, 800., 1e-200]])
+    if family == 'nbinom':
+        P = np.array([P[1], [1e-8, 1e8, 1e-8, 1e8, 1.]])
+    elif family == 'zi_nbinom':
+        P = np.array([P[0], P[1], [1e-8, 1e8, 1e-8, 1e8, 1.]])
+    with np.errstate(divide='raise', invalid='raise'):
+        nll = getattr(NegLogLikelihoods, family)(Y, P)
+    assert np.isfinite(nll).all()
+
+
+def test_likelihood_context():
+    cm = make_model('zero_inflated_poisson')
+    context = cm.likelihood_data(cm.f)
+    assert isinstance(context, LikelihoodContext)
+    assert cm.likelihood_data(cm.df) is context
+    assert (context.zero == (cm.Y == 0)).all()
+    assert (context.Y_positive == cm.Y[cm.Y > 0]).all()
+    assert not context.binary
+    P = cm.compute_P(X=cm.X, m=cm.m, group_sizes=cm.group_sizes, offset=cm.offset)
+    assert np.allclose(cm.f(context, P), cm.f(cm.Y, P))
+
+    # rebuilt for new data only
+    assert cm.reweight(np.ones(cm.m)).likelihood_data(cm.f).Y is cm.Y
+    resampled = cm.resample(np.arange(cm.m // 2))
+    assert (resampled.likelihood_data(cm.f).Y == cm.Y[:cm.m // 2]).all()
+    # functions without a context get the data
+    assert cm.likelihood_data(lambda Y, P: Y) is cm.Y
+
+
+def test_nbinom_zero_nll():
+    theta = np.array([2., 2., 2., 2., 1e-300])
+    alpha = np.array([0., 1e-300, 1., np.inf, 1e-300])
+    with np.errstate(divide='raise', invalid='raise'):
+        s = likelihoods.nbinom_zero_nll(theta, alpha)
+    assert np.allclose(s, [2., 2., np.log(3.), 0., 1e-300], rtol=1e-12, atol=0.)
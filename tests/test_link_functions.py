@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+    test_link_functions
+    ~~~~~~~~~~~~~~~~~~~
+
+    Test the link_functions module
+"""
+import numpy as np
+from ccount.link_functions import expit, expit_derivative, expit_second_derivative
+
+
+def test_expit_extreme():
+    x = np.array([-4000., -40., 0., 3., 40., 4000.])
+    with np.errstate(divide='raise', invalid='raise', over='raise'):
+        values = [expit(x), expit_derivative(x), expit_second_derivative(x)]
+        complex_step = [f(x + 1e-20j).imag / 1e-20 for f in [expit, expit_derivative]]
+    assert all(np.isfinite(v).all() for v in values)
+    assert np.allclose(complex_step, values[1:], rtol=1e-12, atol=1e-300)
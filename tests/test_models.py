@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""
+    test_models
+    ~~~~~~~~~~~
+
+    Test the models module
+"""
+import numpy as np
+import pytest
+from scipy import sparse
+import ccount.utils as utils
+from ccount.models import MODEL_DICT
+
+# test problem
+m = 20
+n = 2
+num_groups = 4
+
+
+def num_parameters(model_type):
+    if model_type in ['logistic', 'binomial']:
+        return 1
+    return 3 if model_type == 'zero_inflated_negative_binomial' else 2
+
+
+def make_model(model_type, m=m, group_id=None, **kwargs):
+    np.random.seed(0)
+    l = num_parameters(model_type)
+    d = np.array([[2] * n] * l)
+    if model_type == 'logistic':
+        Y = np.random.binomial(n=1, p=0.5, size=(m, n))
+    elif model_type == 'binomial':
+        trials = np.random.randint(0, 5, size=(m, n))
+        Y = np.random.binomial(n=trials, p=0.4)
+        kwargs.update(trials=trials)
+    elif model_type == 'zero_inflated_negative_binomial':
+        Y = np.random.negative_binomial(n=2, p=0.4, size=(m, n)) * np.random.binomial(n=1, p=0.7, size=(m, n))
+    else:
+        Y = np.random.poisson(lam=2., size=(m, n)) * np.random.binomial(n=1, p=0.7, size=(m, n))
+    X = [[np.random.randn(m, d[k, j]) for j in range(n)] for k in range(l)]
+    if group_id is None:
+        group_id = np.repeat(np.arange(num_groups), m // num_groups)
+    return MODEL_DICT[model_type](m=m, n=n, d=d, Y=Y, X=X, group_id=group_id, **kwargs)
+
+
+def random_params(cm):
+    beta = [[0.3 * np.random.randn(cm.d[k, j]) for j in range(cm.n)] for k in range(cm.l)]
+    U = 0.3 * np.random.randn(*cm.U.shape)
+    return beta, U
+
+
+def make_spline_model(model_type, **kwargs):
+    """Model with a spline on the first outcome of every parameter, and its spline specifications."""
+    np.random.seed(1)
+    l = num_parameters(model_type)
+    spline_specs = [[[{'spline_var': np.random.rand(m), 'knots_type': 'domain', 'knots_num': 3,
+                       'degree': 3, 'l_linear': False, 'r_linear': False}]] + [None] * (n - 1)] * l
+    return make_model(model_type, spline_specs=spline_specs, **kwargs), spline_specs
+
+
+def make_prediction_data(cm, spline_specs, new_m=25):
+    """Arguments of predict for new data, including a group that the model was not fit on."""
+    new_specs = [[[dict(spline_specs[0][0][0], spline_var=np.random.rand(new_m))]] + [None] * (n - 1)] * cm.l
+    return dict(
+        X=[[np.random.randn(new_m, 2) for j in range(n)] for k in range(cm.l)],
+        m=new_m,
+        spline_specs=new_specs,
+        group_id=np.random.choice(np.append(cm.unique_group_id, 99), size=new_m),
+        offset=[np.random.uniform(0.5, 2., size=(new_m, 1)) for k in range(cm.l)]
+    )
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_gradient_beta(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(U=U)
+    vec = utils.beta_to_vec(beta)
+    analytic = cm.opt_interface.gradient_beta(vec)
+
+    cm.df = None
+    complex_step = cm.opt_interface.gradient_beta(vec)
+    assert np.linalg.norm(analytic - complex_step) < 1e-8
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_gradient_U(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta)
+    analytic = cm.opt_interface.gradient_U(U.flatten())
+
+    cm.df = None
+    complex_step = cm.opt_interface.gradient_U(U.flatten())
+    assert np.linalg.norm(analytic - complex_step) < 1e-8
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_group_hessian_U(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta, U=U, D=np.array([np.identity(n) * 2.] * cm.l))
+    H = cm.group_hessian_U()
+    assert H.shape == (cm.num_groups, cm.l * cm.n, cm.l * cm.n)
+
+    # finite differences of the analytic gradient
+    eps = 1e-6
+    for k in range(cm.l):
+        for j in range(cm.n):
+            U_plus = U.copy()
+            U_plus[k, :, j] += eps
+            U_minus = U.copy()
+            U_minus[k, :, j] -= eps
+            fd = (cm.gradient_U(U=U_plus) - cm.gradient_U(U=U_minus)) / (2 * eps)
+            fd = fd.transpose(1, 0, 2).reshape((cm.num_groups, cm.l * cm.n))
+            assert np.linalg.norm(H[:, :, k * cm.n + j] - fd) < 1e-6
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_group_neg_log_likelihood(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta, U=U)
+    group_values = cm.group_neg_log_likelihood()
+    assert group_values.shape == (cm.num_groups,)
+    assert np.abs(group_values.sum() - cm.neg_log_likelihood()) < 1e-10
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_optimize_U_newton(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta)
+    cm.opt_interface.optimize_U(method="L-BFGS-B")
+    lbfgs_U = cm.U.copy()
+
+    cm.update_params(U=np.zeros(cm.U.shape))
+    cm.opt_interface.optimize_U(method="newton")
+    assert np.linalg.norm(cm.gradient_U()) < 1e-6
+    assert cm.neg_log_likelihood() <= cm.neg_log_likelihood(U=lbfgs_U) + 1e-10
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_compute_P_buffered(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    P = cm.compute_P(X=cm.X, m=cm.m, group_sizes=cm.group_sizes, offset=cm.offset,
+                     beta=beta, U=U)
+    P_buffered = cm.compute_P(X=cm.X, m=cm.m, group_sizes=cm.group_sizes, offset=cm.offset,
+                              beta=beta, U=U, buffered=True)
+    assert np.linalg.norm(P - P_buffered) < 1e-12
+    # random effects for fewer groups than the data
+    for buffered in [False, True]:
+        with pytest.raises(ValueError, match="U must have one row for each of the 4 groups"):
+            cm.compute_P(X=cm.X, m=cm.m, group_sizes=cm.group_sizes, offset=cm.offset,
+                         beta=beta, U=U[:, :-1], buffered=buffered)
+    # the second call reuses the same memory
+    P_again = cm.compute_P(X=cm.X, m=cm.m, group_sizes=cm.group_sizes, offset=cm.offset,
+                           beta=beta, U=U, buffered=True)
+    assert np.shares_memory(P_buffered, P_again)
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+@pytest.mark.parametrize("stack_X", ['dense', 'sparse'])
+def test_model_stack_X(model_type, stack_X):
+    cm = make_model(model_type)
+    cm_stacked = make_model(model_type, stack_X=stack_X)
+    assert cm_stacked.X_stacked.shape == (cm.l * cm.n * cm.m, np.sum(cm.d))
+
+    beta, U = random_params(cm)
+    vec = utils.beta_to_vec(beta)
+    for model in [cm, cm_stacked]:
+        model.update_params(U=U)
+    assert np.abs(cm.neg_log_likelihood(beta=beta) - cm_stacked.neg_log_likelihood(beta=vec)) < 1e-12
+    assert np.linalg.norm(cm.gradient_beta(beta=beta, flat=True) -
+                          cm_stacked.gradient_beta(beta=vec, flat=True)) < 1e-12
+
+    cm.update_params(beta=beta)
+    cm_stacked.update_params(beta=vec)
+    assert all(np.shares_memory(b, cm_stacked.beta_vec) for b_k in cm_stacked.beta for b in b_k)
+    cm.opt_interface.optimize_beta(maxiter=5)
+    cm_stacked.opt_interface.optimize_beta(maxiter=5)
+    assert np.linalg.norm(cm.beta_vec - cm_stacked.beta_vec) < 1e-8
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+@pytest.mark.parametrize("stack_X", [None, 'sparse'])
+def test_model_sparse_X(model_type, stack_X):
+    cm, spline_specs = make_spline_model(model_type)
+    cm_sparse = make_model(model_type, spline_specs=spline_specs, sparse_X=True, stack_X=stack_X)
+    assert all(sparse.isspmatrix_csr(X_kj) for X_k in cm_sparse.X for X_kj in X_k)
+
+    beta, U = random_params(cm)
+    for model in [cm, cm_sparse]:
+        model.update_params(U=U)
+    assert np.abs(cm.neg_log_likelihood(beta=beta) - cm_sparse.neg_log_likelihood(beta=beta)) < 1e-10
+    assert np.linalg.norm(cm.gradient_beta(beta=beta, flat=True) -
+                          cm_sparse.gradient_beta(beta=beta, flat=True)) < 1e-10
+
+
+def test_model_sparse_splines():
+    np.random.seed(1)
+    specs = [{'spline_var': np.random.rand(m), 'knots_type': 'domain', 'knots_num': knots_num,
+              'degree': 3, 'l_linear': False, 'r_linear': False} for knots_num in [3, 5]]
+    spline_specs = [[specs, None], [None, None]]
+    cm = make_model('zero_inflated_poisson', spline_specs=spline_specs)
+    cm_sparse = make_model('zero_inflated_poisson', spline_specs=spline_specs, sparse_X=True)
+    S = cm_sparse.spline_X(spline_specs)[0][0]
+    S_dense = cm.spline_X(spline_specs)[0][0]
+    assert sparse.isspmatrix_csr(S)
+    assert S.nnz == np.count_nonzero(S_dense) <= m * 2 * (3 + 1)
+    assert np.array_equal(S.toarray(), S_dense)
+    # the covariates of the model end with the sparse spline bases
+    assert sparse.isspmatrix_csr(cm_sparse.X[0][0])
+    assert cm_sparse.X[0][0][:, -S.shape[1]:].nnz == S.nnz
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+@pytest.mark.parametrize("stack_X", [None, 'sparse'])
+def test_model_hessian_beta_vector(model_type, stack_X):
+    cm = make_model(model_type, stack_X=stack_X)
+    beta, U = random_params(cm)
+    cm.update_params(U=U)
+    vec = utils.beta_to_vec(beta)
+    p = np.random.randn(vec.size)
+    Hp = cm.opt_interface.hessian_beta_vector(vec, p)
+
+    eps = 1e-6
+    fd = (cm.gradient_beta(beta=vec + eps * p, flat=True) -
+          cm.gradient_beta(beta=vec - eps * p, flat=True)) / (2 * eps)
+    assert np.linalg.norm(Hp - fd) < 1e-6 * max(1., np.linalg.norm(fd))
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_optimize_beta_newton(model_type):
+    cm = make_model(model_type, m=400)
+    beta, U = random_params(cm)
+    cm.update_params(U=U)
+    cm.opt_interface.optimize_beta(method="newton")
+    newton_beta = cm.beta_vec.copy()
+    assert np.linalg.norm(cm.gradient_beta(flat=True)) < 1e-6
+
+    cm.update_params(beta=np.zeros_like(newton_beta))
+    cm.opt_interface.optimize_beta(method="L-BFGS-B")
+    assert cm.neg_log_likelihood(beta=newton_beta) <= cm.neg_log_likelihood() + 1e-8
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_hessian_beta_U_blocks(model_type):
+    cm = make_model(model_type)
+    beta, U = random_params(cm)
+    vec = utils.beta_to_vec(beta)
+    A, B, C = cm.hessian_beta_U_blocks(beta=vec, U=U)
+
+    eps = 1e-6
+    for c in range(vec.size):
+        e = np.zeros(vec.size)
+        e[c] = eps
+        grad_beta_plus, grad_U_plus = cm.gradient_beta_U(beta=vec + e, U=U)
+        grad_beta_minus, grad_U_minus = cm.gradient_beta_U(beta=vec - e, U=U)
+        assert np.linalg.norm(A[:, c] - (grad_beta_plus - grad_beta_minus) / (2 * eps)) < 1e-6
+        fd = ((grad_U_plus - grad_U_minus) / (2 * eps)).transpose(1, 0, 2).reshape(B.shape[:2])
+        assert np.linalg.norm(B[:, :, c] - fd) < 1e-6
+    assert np.allclose(C, cm.group_hessian_U(beta=vec, U=U))
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+@pytest.mark.parametrize("sparse_X,stack_X", [(True, None), (True, 'sparse'), (False, 'dense')])
+def test_model_hessian_beta_U_blocks_design(model_type, sparse_X, stack_X):
+    cm = make_model(model_type, sparse_X=sparse_X, stack_X=stack_X)
+    beta, U = random_params(cm)
+    vec = utils.beta_to_vec(beta)
+    A, B, C = cm.hessian_beta_U_blocks(beta=vec, U=U)
+
+    # the columns are the Hessian-vector products with the unit vectors
+    H_eta = cm.hessian_eta(beta=vec, U=U)
+    zero_U = np.zeros(cm.U.shape)
+    for c, e in enumerate(np.identity(vec.size)):
+        H_beta, H_U = cm.hessian_beta_U_vector(vec_beta=e, vec_U=zero_U, H_eta=H_eta)
+        assert np.allclose(A[:, c], H_beta)
+        assert np.allclose(B[:, :, c], H_U.transpose(1, 0, 2).reshape(B.shape[:2]))
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_optimize_joint(model_type):
+    cm = make_model(model_type, m=400)
+    cm.opt_interface.optimize_joint()
+    grad_beta, grad_U = cm.gradient_beta_U()
+    assert np.linalg.norm(grad_beta) < 1e-6
+    assert np.linalg.norm(grad_U) < 1e-6
+
+    joint_obj = cm.neg_log_likelihood()
+    cm.update_params(beta=np.zeros_like(cm.beta_vec), U=np.zeros_like(cm.U))
+    cm.optimize_params(max_iters=20, compute_D=False)
+    assert joint_obj <= cm.neg_log_likelihood() + 1e-8
+
+
+def laplace_marginal(cm, D):
+    U, H = cm.opt_interface.newton_U(
+        objective=lambda U: cm.laplace_group_objective(U=U, D=D),
+        gradient=lambda U: cm.laplace_gradient_U(U=U, D=D),
+        hessian=lambda U: cm.laplace_hessian_U(U=U, D=D),
+        U=cm.U
+    )
+    return cm.laplace_neg_log_marginal(U=U, D=D)
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_compute_D_laplace(model_type):
+    cm = make_model(model_type, m=100)
+    U = 0.3 * np.random.randn(*cm.U.shape)
+    cm.update_params(U=U)
+    H_data = cm.group_hessian_data_U()
+    assert np.allclose(cm.laplace_hessian_U(H_data=H_data),
+                       cm.m * cm.group_hessian_U() + (1 - cm.m / cm.num_groups) * cm.block_diag_D(np.linalg.inv(cm.D)))
+
+    cm.opt_interface.compute_D(method="laplace", maxiter=500, tol=1e-10)
+    assert np.allclose(cm.U, U)
+    D = cm.D
+    assert np.all(np.linalg.eigvalsh(D) > 0)
+    val = laplace_marginal(cm, D)
+    for scale in [0.8, 1.25]:
+        assert val < laplace_marginal(cm, scale * D)
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_model_dtype(model_type):
+    cm = make_model(model_type)
+    cm_32 = make_model(model_type, dtype=np.float32)
+    assert cm_32.Y.dtype == np.float32
+    assert all(X_kj.dtype == np.float32 for X_k in cm_32.X for X_kj in X_k)
+
+    beta, U = random_params(cm)
+    vec = utils.beta_to_vec(beta)
+    P = cm_32.compute_P(X=cm_32.X, m=cm_32.m, group_sizes=cm_32.group_sizes, offset=cm_32.offset,
+                        beta=vec, U=U, buffered=True)
+    assert P.dtype == np.float32
+    val = cm_32.neg_log_likelihood(beta=vec, U=U)
+    assert val.dtype == np.float64
+    assert np.abs(val - cm.neg_log_likelihood(beta=vec, U=U)) < 1e-5 * np.abs(val)
+    grad = cm.gradient_beta(beta=vec, U=U, flat=True)
+    assert np.linalg.norm(cm_32.gradient_beta(beta=vec, U=U, flat=True) - grad) < 1e-5 * np.linalg.norm(grad)
+
+
+def test_model_dtype_not_float():
+    with pytest.raises(ValueError):
+        make_model('logistic', dtype=int)
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+@pytest.mark.parametrize("sparse_X", [False, True])
+def test_predict_draws(model_type, sparse_X):
+    cm = make_model(model_type, sparse_X=sparse_X)
+    new_m = 30
+    X = [[np.random.randn(new_m, 2) for j in range(n)] for k in range(cm.l)]
+    # includes a group that the model was not fit on
+    group_id = np.random.choice(np.append(cm.unique_group_id, 99), size=new_m)
+    offset = [np.random.uniform(0.5, 2., size=(new_m, 1)) for k in range(cm.l)]
+    params = [random_params(cm) for i in range(3)]
+    expected = list()
+    for beta, U in params:
+        cm.update_params(beta=beta, U=U)
+        expected.append(cm.predict(X=X, m=new_m, spline_specs=None, group_id=group_id, offset=offset))
+    draws = cm.predict_draws(
+        X=X, m=new_m, spline_specs=None, group_id=group_id, offset=offset,
+        betas=np.stack([utils.beta_to_vec(beta) for beta, U in params]),
+        Us=np.stack([U for beta, U in params])
+    )
+    assert draws.shape == (3, new_m, n)
+    assert np.allclose(draws, np.stack(expected))
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_predict_iter(model_type):
+    cm, spline_specs = make_spline_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta, U=U)
+    data = make_prediction_data(cm, spline_specs)
+    expected = cm.predict(**data)
+    chunks = list(cm.predict_iter(**data, chunk_size=7))
+    assert [chunk.shape[0] for chunk in chunks] == [7, 7, 7, 4]
+    assert np.allclose(np.vstack(chunks), expected, rtol=1e-12, atol=0.)
+
+
+def make_duplicated_model(model_type, **kwargs):
+    np.random.seed(1)
+    l = num_parameters(model_type)
+    num_unique = 40
+    rows = np.random.randint(0, num_unique, size=200)
+    if model_type == 'logistic':
+        Y = np.random.binomial(n=1, p=0.5, size=(num_unique, n))
+    elif model_type == 'binomial':
+        trials = np.random.randint(1, 5, size=(num_unique, n))
+        Y = np.random.binomial(n=trials, p=0.4)
+        kwargs.update(trials=trials[rows])
+    else:
+        Y = np.random.negative_binomial(n=2, p=0.4, size=(num_unique, n))
+    X = [[np.random.randn(num_unique, 2)[rows] for j in range(n)] for k in range(l)]
+    group_id = np.arange(num_unique) % num_groups
+    return MODEL_DICT[model_type](m=rows.size, n=n, d=np.array([[2] * n] * l), Y=Y[rows], X=X,
+                                  group_id=group_id[rows], **kwargs)
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_compress(model_type):
+    cm = make_duplicated_model(model_type)
+    cc = make_duplicated_model(model_type, compress=True)
+    assert cc.m == 40 and cc.num_obs == cm.m == cc.counts.sum()
+    assert np.allclose(cc.W.sum(axis=0), cm.W.sum(axis=0))
+
+    beta, U = random_params(cm)
+    vec = utils.beta_to_vec(beta)
+    for model in [cm, cc]:
+        model.update_params(beta=beta, U=U)
+    assert np.isclose(cc.neg_log_likelihood(), cm.neg_log_likelihood())
+    assert np.allclose(cc.gradient_beta(flat=True), cm.gradient_beta(flat=True))
+    assert np.allclose(cc.laplace_group_objective(), cm.laplace_group_objective())
+
+    for model in [cm, cc]:
+        model.update_params(beta=vec * 0, U=U * 0)
+        model.optimize_params(max_iters=2, max_beta_iters=50, max_U_iters=50)
+    assert np.allclose(cc.beta_vec, cm.beta_vec, atol=1e-5)
+    assert np.allclose(cc.U, cm.U, atol=1e-5)
+    assert np.allclose(cc.D, cm.D, atol=1e-5)
+
+
+def test_compress_sparse_X():
+    cm = make_duplicated_model('zero_inflated_poisson')
+    cc = make_duplicated_model('zero_inflated_poisson', compress=True, sparse_X=True)
+    assert cc.m == 40 and all(sparse.issparse(X_kj) for X_k in cc.X for X_kj in X_k)
+    beta, U = random_params(cm)
+    assert np.isclose(cc.neg_log_likelihood(beta=beta, U=U), cm.neg_log_likelihood(beta=beta, U=U))
+
+
+def test_binomial_matches_expanded_logistic():
+    np.random.seed(2)
+    cells = 30
+    trials = np.random.randint(0, 8, size=(cells, 1))
+    successes = np.random.binomial(n=trials, p=0.3)
+    x = np.random.randn(cells, 2)
+    group_id = np.arange(cells) % 3
+    binomial = MODEL_DICT['binomial'](m=cells, n=1, d=np.array([[2]]), Y=successes, X=[[x]],
+                                      trials=trials, group_id=group_id)
+    # one row per trial
+    rows = np.repeat(np.arange(cells), trials.ravel())
+    outcome = np.concatenate([np.arange(t) < s for t, s in zip(trials.ravel(), successes.ravel())]).astype(int)
+    logistic = MODEL_DICT['logistic'](m=rows.size, n=1, d=np.array([[2]]), Y=outcome[:, None], X=[[x[rows]]],
+                                      group_id=group_id[rows])
+    for model in [binomial, logistic]:
+        model.optimize_params(max_iters=3, max_beta_iters=50, max_U_iters=50)
+    # the covariates are normalized over the cells and over the trials, so compare predictions
+    new_x = np.random.randn(10, 2)
+    new_group_id = np.arange(10) % 3
+    assert np.allclose(binomial.predict(X=[[new_x]], m=10, spline_specs=None, group_id=new_group_id),
+                       logistic.predict(X=[[new_x]], m=10, spline_specs=None, group_id=new_group_id), atol=1e-5)
+    assert np.allclose(binomial.U, logistic.U, atol=1e-5)
+    assert np.allclose(binomial.D, logistic.D, atol=1e-5)
+
+
+def test_binomial_data():
+    Y, W = MODEL_DICT['binomial'].binomial_data(Y=np.array([[1], [0], [3]]), trials=np.array([[2], [0], [4]]))
+    assert np.allclose(Y.ravel(), [0.5, 0., 0.75])
+    assert np.allclose(W.ravel(), [1., 0., 2.])
+    with pytest.raises(ValueError):
+        MODEL_DICT['binomial'].binomial_data(Y=np.array([[3]]), trials=np.array([[2]]))
+
+
+def test_zinb_recovers_parameters():
+    np.random.seed(0)
+    m = 5000
+    # structural zeros with probability 0.3, negative binomial with mean 3 and over-dispersion 0.5
+    Y = np.random.negative_binomial(n=2, p=0.4, size=(m, 1)) * np.random.binomial(n=1, p=0.7, size=(m, 1))
+    X = [[np.random.randn(m, 1)] for k in range(3)]
+    cm = MODEL_DICT['zero_inflated_negative_binomial'](m=m, n=1, d=np.array([[1]] * 3), Y=Y, X=X,
+                                                       group_id=np.zeros(m, dtype=int))
+    cm.optimize_params(max_iters=1, optimize_U=False, compute_D=False)
+    intercepts = [cm.beta[k][0][0] for k in range(3)]
+    assert np.allclose([1 / (1 + np.exp(-intercepts[0])), np.exp(intercepts[1]), np.exp(intercepts[2])],
+                       [0.3, 3., 0.5], rtol=0.1)
+
+
+def test_zinb_degenerate_fixed_effects(caplog):
+    # the zero inflation of a bootstrap replicate diverged, so that the
+    # probabilities of a structural zero are exactly 0 or 1
+    cm = make_model('zero_inflated_negative_binomial', m=100)
+    beta, U = random_params(cm)
+    beta[0] = [np.array([0., 4000., -4000.]) for j in range(cm.n)]
+    cm.update_params(beta=beta)
+    cm.optimize_params(max_iters=1, optimize_beta=False)
+    assert np.isfinite(cm.U).all() and np.isfinite(cm.D).all()
+    assert "non-finite derivatives" in caplog.text
@@ -10,6 +10,8 @@ import pytest
 import ccount.core as core
 import ccount.utils as utils
 
+from test_models import make_model
+
 
 # dimension settings
 m = 5
@@ -106,3 +108,41 @@ def test_optimization_compute_D(cm):
     cm.opt_interface.optimize_U()
     cm.opt_interface.compute_D()
     assert np.linalg.norm(cm.D - np.cov(cm.U.flatten())) < 1e-8
+
+
+@pytest.mark.parametrize("beta_method", ["L-BFGS-B", "newton"])
+def test_optimization_trace(beta_method):
+    cm = make_model('zero_inflated_poisson', m=400)
+    entries = list()
+    cm.trace.add_sink(entries.append)
+    cm.optimize_params(max_iters=2, max_beta_iters=20, max_U_iters=20, beta_method=beta_method)
+    records = cm.trace.records
+    assert entries == records
+    assert [r['call'] for r in records if r['step'] == 'D'] == [1, 2]
+    for step in ['beta', 'U']:
+        steps = [r for r in records if r['step'] == step]
+        assert len(steps) > 0
+        assert all(r['time'] >= 0. and r['evaluations'] <= cm.trace.evaluations[step] for r in steps)
+        assert all(r['objective'] is not None for r in steps)
+        # the objective decreases within every call
+        for call in [1, 2]:
+            objective = [r['objective'] for r in steps if r['call'] == call]
+            assert np.all(np.diff(objective) <= 1e-12)
+    assert all(r['gradient_norm'] is not None for r in records if r['step'] == 'U')
+    assert cm.opt_interface.TOTAL_BETA_EVALUATIONS == cm.trace.evaluations['beta'] > 0
+    assert cm.opt_interface.TOTAL_U_EVALUATIONS == cm.trace.evaluations['U'] > 0
+    assert cm.opt_interface.TOTAL_D_EVALUATIONS == 0
+    assert len(cm.trace.to_frame()) == len(records)
+
+
+def test_optimization_trace_laplace():
+    cm = make_model('zero_inflated_poisson', m=400)
+    cm.optimize_params(max_iters=2, max_beta_iters=20, max_U_iters=20, D_method="laplace")
+    opt = cm.opt_interface
+    # the random effects refit within the Laplace updates of D are counted
+    # for D, and not for the random effects step
+    assert opt.TOTAL_U_EVALUATIONS == cm.trace.evaluations['U'] > 0
+    assert opt.TOTAL_D_EVALUATIONS == cm.trace.evaluations['D'] > 0
+    steps = [r for r in cm.trace.records if r['step'] == 'D']
+    assert len(steps) > 0
+    assert all(r['evaluations'] <= opt.TOTAL_D_EVALUATIONS for r in steps)
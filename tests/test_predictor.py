@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+    test_predictor
+    ~~~~~~~~~~~~~~
+
+    Test the predictor module
+"""
+import numpy as np
+import pytest
+import ccount.utils as utils
+from ccount.models import MODEL_DICT
+from ccount.predictor import Predictor
+
+from test_models import make_spline_model, make_prediction_data, random_params
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+@pytest.mark.parametrize("sparse_X", [False, True])
+def test_predictor(model_type, sparse_X):
+    cm, spline_specs = make_spline_model(model_type, sparse_X=sparse_X)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta, U=U)
+    predictor = Predictor(cm)
+    data = make_prediction_data(cm, spline_specs)
+    expected = cm.predict(**data)
+    assert np.allclose(predictor.predict(**data), expected)
+    # the predictor keeps the parameters it was built with
+    cm.update_params(beta=utils.beta_to_vec(beta) + 1.)
+    assert np.allclose(predictor.predict(**data), expected)
+
+
+@pytest.mark.parametrize("model_type", list(MODEL_DICT.keys()))
+def test_predictor_artifact(model_type, tmp_path):
+    cm, spline_specs = make_spline_model(model_type)
+    beta, U = random_params(cm)
+    cm.update_params(beta=beta, U=U)
+    Predictor(cm).save(str(tmp_path))
+    predictor = Predictor.load(str(tmp_path))
+    assert isinstance(predictor.U, np.memmap)
+    assert np.array_equal(predictor.D, cm.D)
+    data = make_prediction_data(cm, spline_specs)
+    assert np.allclose(predictor.predict(**data), cm.predict(**data))
@@ -2,7 +2,7 @@ import pytest
 import pandas as pd
 import numpy as np
 
-from ccount.run import ModelRun
+from ccount.run import ModelRun, get_predictions_iter_from_df
 from ccount.processing import resample_data
 
 
@@ -35,6 +35,23 @@ def test_model_run(df):
     assert len(predictions) == len(df)
 
 
+def test_model_run_beta_newton(df):
+    m = ModelRun(
+        model_type='logistic',
+        training_df=df,
+        prediction_df=df,
+        outcome_variables=['y'],
+        fixed_effects=[[['x1', 'x2']]],
+        random_effect='group',
+        optimize_U=False,
+        compute_D=False,
+        max_iters=1,
+        beta_method='newton'
+    )
+    m.run()
+    assert np.linalg.norm(m.model.gradient_beta(flat=True)) < 1e-6
+
+
 def test_model_run_bootstrap(df):
     np.random.seed(10)
     m = ModelRun(
@@ -75,6 +92,50 @@ def test_model_run_bootstrap_pools(df):
     assert (predictions['upper'] > predictions['mean']).all()
 
 
+def test_model_run_bootstrap_weights(df):
+    np.random.seed(10)
+    m = ModelRun(
+        model_type='logistic',
+        training_df=df,
+        prediction_df=df,
+        outcome_variables=['y'],
+        fixed_effects=[[['x1', 'x2']]],
+        random_effect='group',
+        optimize_U=False,
+        compute_D=False,
+        bootstraps=10,
+        bootstrap_method='weights'
+    )
+    assert len(m.bootstrap_samples) == 10
+    m.run()
+    predictions = m.predict()
+    assert len(predictions) == len(df)
+    assert (predictions['lower'] < predictions['mean']).all()
+    assert (predictions['upper'] > predictions['mean']).all()
+
+
+def test_model_run_bootstrap_max_iters(df):
+    np.random.seed(10)
+    m = ModelRun(
+        model_type='logistic',
+        training_df=df,
+        prediction_df=df,
+        outcome_variables=['y'],
+        fixed_effects=[[['x1', 'x2']]],
+        random_effect='group',
+        optimize_U=False,
+        compute_D=False,
+        bootstraps=10,
+        bootstrap_max_iters=2
+    )
+    assert m.optimize_kwargs(bootstrap=True)['max_iters'] == 2
+    assert m.optimize_kwargs()['max_iters'] == 100
+    m.run()
+    predictions = m.predict()
+    assert (predictions['lower'] < predictions['mean']).all()
+    assert (predictions['upper'] > predictions['mean']).all()
+
+
 def test_model_run_bootstrap_dfs(df):
     np.random.seed(10)
     df = pd.DataFrame({
@@ -106,3 +167,96 @@ def test_model_run_bootstrap_dfs(df):
     assert len(predictions['lower'].unique()) == 1
     assert len(predictions['mean'].unique()) == 1
     assert len(predictions['upper'].unique()) == 1
+
+
+def test_model_run_bootstrap_outcomes():
+    np.random.seed(10)
+    x1 = np.random.randn(200)
+    df = pd.DataFrame({
+        'x1': x1,
+        'group': np.repeat([0, 1, 2, 3], repeats=50),
+        'y1': np.random.poisson(np.exp(0.5 + 0.3 * x1)),
+        'y2': np.random.poisson(np.exp(1. - 0.3 * x1))
+    })
+    m = ModelRun(
+        model_type='zero_inflated_poisson',
+        training_df=df,
+        prediction_df=df,
+        outcome_variables=['y1', 'y2'],
+        fixed_effects=[[None, None], [['x1'], ['x1']]],
+        random_effect='group',
+        max_iters=3,
+        bootstraps=10
+    )
+    m.run()
+    predictions = m.predict()
+    assert m.draws.shape == (10, 2, len(df))
+    assert list(predictions.columns) == ['mean_y1', 'mean_y2', 'lower_y1', 'lower_y2', 'upper_y1', 'upper_y2']
+    for outcome in ['y1', 'y2']:
+        assert (predictions[f'lower_{outcome}'] < predictions[f'upper_{outcome}']).all()
+
+
+def test_get_predictions_iter_from_df(df):
+    m = ModelRun(
+        model_type='logistic',
+        training_df=df,
+        prediction_df=df,
+        outcome_variables=['y'],
+        fixed_effects=[[['x1', 'x2']]],
+        random_effect='group',
+        optimize_U=False,
+        compute_D=False
+    )
+    m.run()
+    chunks = list(get_predictions_iter_from_df(
+        model=m.model, df=df, fixed_effects=m.fixed_effects, random_effect=m.random_effect, chunk_size=30
+    ))
+    assert len(chunks) == 4
+    assert np.allclose(np.hstack(chunks), m.predictions(model=m.model))
+
+
+def test_model_run_compress(df):
+    # every row three times
+    training_df = pd.concat([df, df, df], ignore_index=True)
+    kwargs = dict(
+        model_type='logistic',
+        prediction_df=df,
+        outcome_variables=['y'],
+        fixed_effects=[[['x1', 'x2']]],
+        random_effect='group',
+        optimize_U=False,
+        compute_D=False,
+        bootstraps=2
+    )
+    m = ModelRun(training_df=training_df, compress=True, **kwargs)
+    assert m.model.m == len(df) and m.model.num_obs == len(training_df)
+    m.run()
+    expected = ModelRun(training_df=training_df, **kwargs)
+    expected.run()
+    assert np.allclose(m.model.beta_vec, expected.model.beta_vec, atol=1e-6)
+    assert np.allclose(m.predict()['mean'], expected.predict()['mean'], atol=1e-6)
+
+
+def test_model_run_binomial_trials():
+    np.random.seed(0)
+    df = pd.DataFrame({'x1': np.random.randn(100), 'group': 0})
+    df['y'] = np.random.binomial(n=1, p=1 / (1 + np.exp(-df['x1'])))
+    # the binary outcomes of every value of x1 in one row
+    df = df.assign(x1=np.round(df['x1']), x2=0.)
+    cells = df.groupby(['x1', 'x2', 'group'], as_index=False).agg(y=('y', 'sum'), trials=('y', 'size'))
+    kwargs = dict(
+        prediction_df=cells,
+        fixed_effects=[[['x1']]],
+        random_effect='group',
+        optimize_U=False,
+        compute_D=False
+    )
+    m = ModelRun(model_type='binomial', training_df=cells, outcome_variables=['y'], trials=['trials'],
+                 bootstraps=2, **kwargs)
+    assert m.model.m == len(cells)
+    m.run()
+    expected = ModelRun(model_type='logistic', training_df=df, outcome_variables=['y'], **kwargs)
+    expected.run()
+    predictions = m.predict()
+    assert np.allclose(predictions['mean'], expected.predict()['mean'], atol=1e-4)
+    assert (predictions['lower'] <= predictions['upper']).all()
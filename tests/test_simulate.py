@@ -1,7 +1,9 @@
 import pytest
 import numpy as np
 
-from ccount.simulate import Simulation, ZIPoissonSimulation
+from ccount.simulate import (
+    Simulation, ZIPoissonSimulation, HurdlePoissonSimulation, sample_truncated_poisson
+)
 
 
 @pytest.fixture
@@ -50,3 +52,22 @@ def test_poisson_simulation(m, n, d, poisson_sim):
 
     assert s.u.shape == (m, n)
     assert all([i.shape == (m,) for i in s.theta])
+
+
+@pytest.mark.parametrize("mu", [1e-3, 0.5, 3., 50.])
+def test_sample_truncated_poisson(mu):
+    rng = np.random.default_rng(0)
+    draws = sample_truncated_poisson(np.full(200000, mu), rng=rng)
+    assert draws.min() >= 1
+    mean = mu / (-np.expm1(-mu))
+    variance = mean * (1 + mu - mean)
+    assert abs(draws.mean() - mean) < 5 * np.sqrt(variance / draws.size)
+
+
+def test_hurdle_poisson_simulation(m, n, d):
+    np.random.seed(0)
+    s = HurdlePoissonSimulation(m=m, n=n, d=d, rng=np.random.default_rng(0))
+    sim = s.simulate()
+    assert sim.shape == (m, n)
+    assert (s.Y_poisson >= 1).all()
+    assert ((sim == 0) == (s.Y_zeros.T == 0)).all()
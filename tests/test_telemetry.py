@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+    test_telemetry
+    ~~~~~~~~~~~~~~
+
+    Test the telemetry module
+"""
+import pytest
+from ccount import telemetry
+
+
+@pytest.mark.parametrize("platform,scale", [("linux", 1024), ("darwin", 1)])
+def test_peak_memory(platform, scale, monkeypatch):
+    class Usage:
+        ru_maxrss = 1000
+
+    class Resource:
+        RUSAGE_SELF = 0
+
+        @staticmethod
+        def getrusage(who):
+            return Usage
+
+    monkeypatch.setattr(telemetry, 'resource', Resource)
+    monkeypatch.setattr(telemetry.sys, 'platform', platform)
+    assert telemetry.peak_memory() == 1000 * scale
@@ -29,3 +29,21 @@ def test_beta_transform(vec, d):
     beta = utils.vec_to_beta(vec, d)
     vec_recover = utils.beta_to_vec(beta)
     assert np.linalg.norm(vec - vec_recover) < 1e-10
+
+
+def test_sparse_row_key():
+    from scipy import sparse
+    dense = np.array([[0., 1., 2.], [0., 1., 2.], [0., 0., 0.], [3., 0., 0.], [0., 1., 2.]])
+    # the first row has unsorted indices and the second an explicit zero,
+    # which do not change the key of the rows
+    X = sparse.csr_matrix((np.array([2., 1., 0., 1., 2., 3., 1., 2.]),
+                           np.array([2, 1, 0, 1, 2, 0, 1, 2]),
+                           np.array([0, 2, 5, 5, 6, 8])), shape=(5, 3))
+    assert np.array_equal(X.toarray(), dense)
+    key = utils.sparse_row_key(X)
+    assert key.shape == (5, 4)
+    _, inverse = np.unique(key, axis=0, return_inverse=True)
+    _, expected = np.unique(dense, axis=0, return_inverse=True)
+    # the same rows are equal
+    inverse, expected = inverse.ravel(), expected.ravel()
+    assert np.array_equal(inverse[:, None] == inverse, expected[:, None] == expected)